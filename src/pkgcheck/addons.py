@@ -4,28 +4,96 @@ from collections import OrderedDict, defaultdict
 from copy import copy
 from functools import partial
 from itertools import chain, filterfalse
+from operator import attrgetter
 
-from pkgcore import const
 from snakeoil.cli.arghparse import StoreBool
 from snakeoil.cli.exceptions import UserException
 from snakeoil.containers import ProtectedSet
 from snakeoil.demandload import demandload
 from snakeoil.iterables import expandable_chain
-from snakeoil.osutils import abspath, listdir_files, pjoin
+from snakeoil.osutils import abspath, pjoin
 from snakeoil.sequences import iflatten_instance
 from snakeoil.strings import pluralism as _pl
 
-from . import base
+from . import __version__, base, cache, feeds
 
 demandload(
+    'bisect:bisect_right',
+    'hashlib',
+    'multiprocessing',
     'os',
-    'pickle',
+    're',
+    'stat',
     'pkgcore.restrictions:packages,values',
-    'pkgcore.ebuild:misc,domain,profiles,repo_objs',
+    'pkgcore.ebuild:atom,misc,domain,profiles,repo_objs',
     'pkgcore.log:logger',
 )
 
 
+class LRUCache(object):
+    """Mapping retaining a limited number of the most recently used entries.
+
+    Lookups via ``in`` and :meth:`get` are tracked as hits or misses, direct
+    item access isn't since it's generally preceded by a membership test.
+
+    :param maxsize: maximum number of entries stored, None for no limit
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups * 100 if lookups else 0
+        return (
+            f'{self.hits} hit{_pl(self.hits)}, '
+            f'{self.misses} miss{_pl(self.misses, plural="es")}, '
+            f'{self.evictions} eviction{_pl(self.evictions)} '
+            f'({rate:.1f}% hit rate)')
+
+
 class ArchesAddon(base.Addon):
 
     @staticmethod
@@ -77,41 +145,286 @@ class ArchesAddon(base.Addon):
 
 
 class QueryCacheAddon(base.Template):
+    """Cache of dependency queries kept across packages.
+
+    Queries are cached as the positions of their matches among the versions
+    in the repo index instead of package objects so cached queries don't
+    keep packages evicted from the index alive.
+    """
 
     priority = 1
 
+    # memory used per cached query including its atom key, measured at
+    # roughly 1.1KB on average for atoms from a range of dependency strings,
+    # used to convert cache sizes given in megabytes to a number of entries
+    entry_size = 1150
+
     @staticmethod
     def mangle_argparser(parser):
         group = parser.add_argument_group('query caching')
+        group.add_argument(
+            '--query-cache-size', default='50000', metavar='SIZE',
+            help='maximum size of the query cache',
+            docs="""
+                Maximum size of the package query cache, either as a number
+                of entries or as an approximate amount of memory when suffixed
+                with M or MB (e.g. 100M). Least recently used queries are
+                dropped when the cache is full. Each entry uses roughly 1KB,
+                i.e. about 55MB for the default size.
+            """)
         group.add_argument(
             '--reset-caching-per', dest='query_caching_freq',
-            choices=('version', 'package', 'category'), default='package',
-            help='control how often the cache is cleared '
-                 '(version, package or category)')
+            choices=('version', 'package', 'category'), default=None,
+            help='additionally clear the cache per version, package, or category')
 
     @staticmethod
     def check_args(parser, namespace):
-        namespace.query_caching_freq = {
-            'version': base.versioned_feed,
-            'package': base.package_feed,
-            'category': base.repository_feed,
-            }[namespace.query_caching_freq]
+        size = namespace.query_cache_size.upper()
+        try:
+            if size.endswith(('M', 'MB')):
+                size = int(float(size.rstrip('MB')) * 1024 * 1024) // QueryCacheAddon.entry_size
+            else:
+                size = int(size)
+        except ValueError:
+            parser.error(f'invalid query cache size: {namespace.query_cache_size!r}')
+        if size < 0:
+            parser.error(f'invalid query cache size: {namespace.query_cache_size!r}')
+        namespace.query_cache_size = size
+
+        if namespace.query_caching_freq is not None:
+            namespace.query_caching_freq = {
+                'version': base.versioned_feed,
+                'package': base.package_feed,
+                'category': base.category_feed,
+                }[namespace.query_caching_freq]
 
     def __init__(self, options):
         super().__init__(options)
-        self.query_cache = {}
-        # XXX this should be logging debug info
+        self.query_cache = LRUCache(options.query_cache_size)
+        # bitsets of the profiles any of the matches for a query are visible
+        # in, derived from the queries so they're reset along with them
+        self.query_visibility = LRUCache(options.query_cache_size)
+        self.caches = (
+            ('query cache', self.query_cache),
+            ('query visibility', self.query_visibility),
+        )
+        # only act as a sink when the cache is forcibly cleared
         self.feed_type = self.options.query_caching_freq
 
     def feed(self, item, reporter):
-        # XXX as should this.
         self.query_cache.clear()
+        self.query_visibility.clear()
+
+
+class RepoIndexAddon(base.Addon):
+    """Index of the packages in the search repo kept for the entire scan.
+
+    The versions of a package, along with their lazily loaded metadata such
+    as slots, keywords, and IUSE, are pulled from the repo on first access
+    and kept sorted. Atoms are then matched against the versions of their
+    package instead of running a repo query for each one while other
+    restrictions fall back to querying the repo directly.
+
+    Matching methods mirror the repo API so the index can be used as a
+    drop-in replacement for the search repo. Only the most recently used
+    packages are kept in order to bound memory usage since their versions
+    hold onto loaded metadata.
+    """
+
+    # maximum number of packages indexed at once
+    maxsize = 4096
+
+    def __init__(self, options):
+        super().__init__(options)
+        self._pkgs = LRUCache(self.maxsize)
+        self.caches = (('package index', self._pkgs),)
+
+    def versions(self, key):
+        """Return the sorted versions of a package for a given key."""
+        pkgs = self._pkgs.get(key)
+        if pkgs is None:
+            pkgs = self._pkgs[key] = tuple(
+                sorted(self.options.search_repo.itermatch(atom.atom(key))))
+        return pkgs
+
+    def itermatch(self, restrict):
+        if isinstance(restrict, atom.atom):
+            return (pkg for pkg in self.versions(restrict.key) if restrict.match(pkg))
+        return self.options.search_repo.itermatch(restrict)
+
+    def match(self, restrict):
+        return list(self.itermatch(restrict))
+
+    def has_match(self, restrict):
+        for pkg in self.itermatch(restrict):
+            return True
+        return False
+
+
+class LineScannerAddon(base.Addon):
+    """Shared regex scanner for the lines of ebuilds.
+
+    Ebuild checks register their patterns with the scanner which matches all
+    of them against the text of an ebuild at once, instead of each check
+    looping over every line in python. Patterns are compiled in multiline
+    mode and shouldn't match across newlines. Results are memoized for the
+    most recently scanned ebuild so the checks fed the same entry share them.
+
+    Patterns can be registered with literal prefilter tokens, at least one of
+    which has to occur in any match. The tokens are searched for in the
+    ebuild text first and the pattern is only run if one of them is found,
+    skipping the regex entirely for the majority of ebuilds.
+    """
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.patterns = []
+        self.prefilters = []
+        self._entry = None
+        self._results = None
+
+    def register(self, pattern, flags=0, prefilter=None):
+        """Register a pattern to be matched against ebuild lines.
+
+        :param prefilter: iterable of literal strings, at least one of which
+            is contained in every match of the pattern
+        :return: pattern id used to look up its matches
+        """
+        self.patterns.append(re.compile(pattern, flags | re.MULTILINE))
+        self.prefilters.append(tuple(prefilter) if prefilter is not None else None)
+        self._entry = None
+        return len(self.patterns) - 1
+
+    def scan(self, entry):
+        """Match all registered patterns against an ebuild.
+
+        :param entry: (package, lines) tuple as passed to ebuild checks
+        :return: list of the matches for each pattern, as (line number, match
+            object) tuples for the first match on each line
+        """
+        if entry is not self._entry:
+            pkg, lines = entry
+            if isinstance(lines, feeds.EbuildText):
+                text, starts = lines.text, lines.offsets
+            else:
+                text = ''.join(lines)
+                starts = []
+                offset = 0
+                for line in lines:
+                    starts.append(offset)
+                    offset += len(line)
+            results = []
+            found = {}
+            for regex, tokens in zip(self.patterns, self.prefilters):
+                matches = []
+                if tokens is not None:
+                    for token in tokens:
+                        if token not in found:
+                            found[token] = token in text
+                        if found[token]:
+                            break
+                    else:
+                        results.append(matches)
+                        continue
+                lineno = 0
+                for match in regex.finditer(text):
+                    i = bisect_right(starts, match.start())
+                    if i != lineno:
+                        lineno = i
+                        matches.append((lineno, match))
+                results.append(matches)
+            self._entry, self._results = entry, results
+        return self._results
+
+    def matches(self, entry, pattern_id):
+        """Return the matches for a registered pattern in an ebuild."""
+        return self.scan(entry)[pattern_id]
+
+
+class PkgDirSnapshot(object):
+    """Stat data for the files in a package directory.
+
+    The directory is walked once using :func:`os.scandir` with the entries
+    in the package directory itself and everything under its files/
+    subdirectory being recorded. Symlinks aren't followed.
+
+    :ivar path: package directory path
+    :ivar entries: mapping of paths relative to the package directory to
+        their stat data
+    :ivar dirs: mapping of relative directory paths to the sorted names of
+        the entries they contain, the package directory itself is keyed by
+        the empty string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirs = {}
+        self._scan('')
+
+    def _scan(self, relpath):
+        try:
+            with os.scandir(pjoin(self.path, relpath)) as it:
+                dir_entries = sorted(it, key=lambda x: x.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        names = self.dirs[relpath] = []
+        for entry in dir_entries:
+            path = pjoin(relpath, entry.name) if relpath else entry.name
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            names.append(entry.name)
+            self.entries[path] = st
+            if stat.S_ISDIR(st.st_mode) and (relpath or entry.name == 'files'):
+                self._scan(path)
+
+    def listdir(self, relpath=''):
+        """Return the names of the entries in a given directory."""
+        return self.dirs.get(relpath, [])
+
+
+class PkgDirAddon(base.Addon):
+    """Filesystem snapshots of package directories.
+
+    Package feed checks scanning package directories share the snapshot
+    taken for the package currently being fed instead of each hitting the
+    filesystem.
+    """
+
+    def __init__(self, options):
+        super().__init__(options)
+        self._pkgset = None
+        self._snapshot = None
+
+    def snapshot(self, pkgset):
+        """Return the directory snapshot for a given package.
+
+        :param pkgset: sequence of package versions as passed to package
+            feed checks
+        """
+        if pkgset is not self._pkgset:
+            self._snapshot = PkgDirSnapshot(os.path.dirname(pkgset[0].path))
+            self._pkgset = pkgset
+        return self._snapshot
 
 
 class profile_data(object):
+    """Profile data used for checking packages.
+
+    :param keywords: keywords accepted by the profile, used along with
+        masked_keys to determine visibility without evaluating the full
+        filter for packages no profile masks
+    :param masked_keys: set of package keys masked in any profile
+
+    Profiles registered with a ProfileAddon are assigned a unique bit used
+    to represent them in visibility bitsets.
+    """
 
     def __init__(self, profile_name, key, provides, vfilter,
-                 iuse_effective, use, pkg_use, masked_use, forced_use, lookup_cache, insoluble):
+                 iuse_effective, use, pkg_use, masked_use, forced_use, lookup_cache, insoluble,
+                 keywords=None, masked_keys=None):
         self.key = key
         self.name = profile_name
         self.provides_repo = provides
@@ -123,7 +436,20 @@ class profile_data(object):
         self.forced_use = forced_use
         self.cache = lookup_cache
         self.insoluble = insoluble
-        self.visible = vfilter.match
+        self.bit = 0
+        if keywords is None or masked_keys is None:
+            self.visible = vfilter.match
+        else:
+            self._filter_visible = vfilter.match
+            self._keywords = frozenset(keywords)
+            self._masked_keys = masked_keys
+
+    def visible(self, pkg):
+        """Determine if a package is visible in the profile."""
+        if pkg.key in self._masked_keys:
+            return self._filter_visible(pkg)
+        # unmasked packages only depend on their keywords
+        return not self._keywords.isdisjoint(pkg.keywords)
 
     def identify_use(self, pkg, known_flags):
         # note we're trying to be *really* careful about not creating
@@ -138,6 +464,64 @@ class profile_data(object):
         return immutable, enabled
 
 
+def _profile_flags(profile, stable_key, default_masked_use, chunked_data_cache):
+    """Generate the USE flag filters for a profile.
+
+    :return: tuple of unfrozen masked, stable masked, forced, and stable
+        forced USE flag mappings
+    """
+    immutable_flags = profile.masked_use.clone(unfreeze=True)
+    immutable_flags.add_bare_global((), default_masked_use)
+    immutable_flags.optimize(cache=chunked_data_cache)
+
+    stable_immutable_flags = profile.stable_masked_use.clone(unfreeze=True)
+    stable_immutable_flags.add_bare_global((), default_masked_use)
+    stable_immutable_flags.optimize(cache=chunked_data_cache)
+
+    enabled_flags = profile.forced_use.clone(unfreeze=True)
+    enabled_flags.add_bare_global((), (stable_key,))
+    enabled_flags.optimize(cache=chunked_data_cache)
+
+    stable_enabled_flags = profile.stable_forced_use.clone(unfreeze=True)
+    stable_enabled_flags.add_bare_global((), (stable_key,))
+    stable_enabled_flags.optimize(cache=chunked_data_cache)
+
+    return (immutable_flags, stable_immutable_flags, enabled_flags, stable_enabled_flags)
+
+
+def _profile_files(path):
+    """Yield the files of a profile node, including directory-form files.
+
+    Subdirectories named like profile files, e.g. package.mask, are walked
+    recursively while all others, e.g. child profiles, are skipped.
+    """
+    try:
+        entries = sorted(os.scandir(path), key=attrgetter('name'))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir():
+            if entry.name.startswith(('package.', 'use.')):
+                yield from cache.iter_files(entry.path)
+        else:
+            yield entry.path
+
+
+# profiles inherited by forked worker processes
+_worker_profiles = None
+
+
+def _profile_flags_worker(tasks):
+    """Generate the USE flag filters for a batch of profiles in a worker process.
+
+    Profiles in a batch share the chunked data cache as done for serial runs.
+    """
+    chunked_data_cache = {}
+    return [
+        _profile_flags(_worker_profiles[i][1], stable_key, default_masked_use, chunked_data_cache)
+        for i, stable_key, default_masked_use in tasks]
+
+
 class ProfileAddon(base.Addon):
 
     required_addons = (ArchesAddon,)
@@ -159,11 +543,21 @@ class ProfileAddon(base.Addon):
             docs="""
                 Significantly decreases profile load time by caching and reusing
                 the resulting filters rather than rebuilding them for each run.
+                Cached filters are stored per profile and only rebuilt for
+                profiles with changed files.
 
                 Caches are used by default. In order to forcibly refresh them,
                 enable this option. Conversely, if caches are unwanted disable
                 this instead.
             """)
+        group.add_argument(
+            '--profile-jobs', type=int, default=1,
+            help='number of processes to generate profile filters in',
+            docs="""
+                Number of worker processes to use for generating the USE flag
+                filters of profiles lacking cached filters, defaults to 1
+                meaning they're generated serially in the main process.
+            """)
         group.add_argument(
             '-p', '--profiles', metavar='PROFILE', action='csv_negations',
             dest='profiles',
@@ -195,6 +589,9 @@ class ProfileAddon(base.Addon):
             if not os.path.isdir(profiles_dir):
                 parser.error(f"invalid profiles base: {profiles_dir!r}")
 
+        if namespace.profile_jobs < 1:
+            parser.error(f'invalid number of profile jobs: {namespace.profile_jobs}')
+
         selected_profiles = namespace.profiles
         if selected_profiles is None:
             selected_profiles = ((), ())
@@ -239,16 +636,12 @@ class ProfileAddon(base.Addon):
         if namespace.cache is None and namespace.default_target is None:
             namespace.cache = False
 
-        # initialize cache dir
-        cache_dir = pjoin(const.USER_CACHE_PATH, 'pkgcheck')
-        namespace.cache_file = pjoin(cache_dir, 'profiles.pickle')
-        if ((namespace.cache is None or namespace.cache) and
-                not os.path.exists(cache_dir)):
-            try:
-                os.makedirs(cache_dir)
-            except IOError as e:
-                raise UserException(
-                    f'failed creating profiles cache: {cache_dir!r}: {e.strerror}')
+        # separate cache files are used for every profiles directory
+        profiles_base = profiles_dir
+        if profiles_base is None:
+            profiles_base = pjoin(namespace.target_repo.location, 'profiles')
+        profiles_hash = hashlib.sha1(profiles_base.encode()).hexdigest()
+        namespace.cache_file = pjoin(cache.CACHE_DIR, 'profiles', f'{profiles_hash}.pickle')
         namespace.forced_cache = bool(namespace.cache)
 
         # We hold onto the profiles as we're going, due to the fact that
@@ -293,67 +686,93 @@ class ProfileAddon(base.Addon):
         profile_filters = defaultdict(list)
         chunked_data_cache = {}
         cached_profile_filters = {}
-
-        # try loading cached profile filters
-        if options.cache is None:
-            try:
-                with open(options.cache_file, 'rb') as f:
-                    cached_profile_filters = pickle.load(f)
-            except (EOFError, FileNotFoundError):
-                pass
-
+        cache_modified = False
+        node_digests = {}
+
+        # try loading cached profile filters, forced refreshes only rebuild
+        # the filters of selected profiles while keeping all other entries
+        if options.cache is not False:
+            data = cache.load(options.cache_file)
+            if isinstance(data, dict):
+                cached_profile_filters = data
+
+        # determine which profiles lack current cached filters
+        arch_data = {}
+        cached_flags = {}
+        missing = []
         for k in self.desired_arches:
             if k.lstrip("~") not in self.desired_arches:
                 continue
             stable_key = k.lstrip("~")
+            default_masked_use = tuple(set(
+                x for x in self.official_arches if x != stable_key))
+            arch_data[k] = (stable_key, default_masked_use)
+
+            for profile_name, profile in options.arch_profiles.get(k, []):
+                digest = self._profile_digest(
+                    profile, (stable_key, sorted(default_masked_use)), node_digests)
+                cached_profile = None
+                if options.cache is None:
+                    cached_profile = cached_profile_filters.get(profile_name, None)
+                if cached_profile is not None and cached_profile[0] == digest:
+                    cached_flags[profile_name] = cached_profile[1]
+                else:
+                    missing.append((profile_name, profile, digest, k))
+
+        # generate missing filters, in parallel if multiple jobs are enabled
+        jobs = min(getattr(options, 'profile_jobs', 1), len(missing))
+        if jobs > 1:
+            global _worker_profiles
+            # workers are forked so they inherit the profile objects
+            _worker_profiles = missing
+            # split into contiguous batches, keeping profiles of the same arch
+            # together since they share most of their cached data
+            tasks = [(i, *arch_data[k]) for i, (_, _, _, k) in enumerate(missing)]
+            size = -(-len(tasks) // jobs)
+            batches = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+            try:
+                ctx = multiprocessing.get_context('fork')
+                with ctx.Pool(len(batches)) as pool:
+                    flags = list(chain.from_iterable(
+                        pool.map(_profile_flags_worker, batches)))
+            finally:
+                _worker_profiles = None
+        else:
+            flags = [
+                _profile_flags(profile, *arch_data[k], chunked_data_cache)
+                for _, profile, _, k in missing]
+
+        for (profile_name, profile, digest, k), profile_flags in zip(missing, flags):
+            cached_flags[profile_name] = profile_flags
+            # update the cache unless explicitly disabled
+            if options.cache is not False:
+                # TODO: fix pickling ImmutableDict objects
+                # Grab a shallow copy of each profile mapping before it gets
+                # frozen to dump into the cache; otherwise loading the dumped dict
+                # fails due to its immutability.
+                cached_profile_filters[profile_name] = (
+                    digest, tuple(copy(x) for x in profile_flags))
+                cache_modified = True
+
+        # package keys masked by any profile, visibility for all other
+        # packages only depends on keywords
+        masked_keys = set()
+        for k in arch_data:
+            for profile_name, profile in options.arch_profiles.get(k, []):
+                masked_keys.update(x.key for x in profile.masks)
+
+        for k, (stable_key, default_masked_use) in arch_data.items():
             unstable_key = "~" + stable_key
             stable_r = packages.PackageRestriction(
                 "keywords", values.ContainmentMatch2((stable_key,)))
             unstable_r = packages.PackageRestriction(
                 "keywords", values.ContainmentMatch2((stable_key, unstable_key,)))
 
-            default_masked_use = tuple(set(
-                x for x in self.official_arches if x != stable_key))
-
             for profile_name, profile in options.arch_profiles.get(k, []):
                 vfilter = domain.generate_filter(profile.masks, profile.unmasks)
 
-                cached_profile = cached_profile_filters.get(profile_name, None)
-                if cached_profile:
-                    immutable_flags = cached_profile[0]
-                    stable_immutable_flags = cached_profile[1]
-                    enabled_flags = cached_profile[2]
-                    stable_enabled_flags = cached_profile[3]
-                else:
-                    # force cache updates unless explicitly disabled
-                    if options.cache is None:
-                        options.cache = True
-
-                    immutable_flags = profile.masked_use.clone(unfreeze=True)
-                    immutable_flags.add_bare_global((), default_masked_use)
-                    immutable_flags.optimize(cache=chunked_data_cache)
-
-                    stable_immutable_flags = profile.stable_masked_use.clone(unfreeze=True)
-                    stable_immutable_flags.add_bare_global((), default_masked_use)
-                    stable_immutable_flags.optimize(cache=chunked_data_cache)
-
-                    enabled_flags = profile.forced_use.clone(unfreeze=True)
-                    enabled_flags.add_bare_global((), (stable_key,))
-                    enabled_flags.optimize(cache=chunked_data_cache)
-
-                    stable_enabled_flags = profile.stable_forced_use.clone(unfreeze=True)
-                    stable_enabled_flags.add_bare_global((), (stable_key,))
-                    stable_enabled_flags.optimize(cache=chunked_data_cache)
-
-                    if options.cache:
-                        # TODO: fix pickling ImmutableDict objects
-                        # Grab a shallow copy of each profile mapping before it gets
-                        # frozen to dump into the cache; otherwise loading the dumped dict
-                        # fails due to its immutability.
-                        cached_profile_filters[profile_name] = (
-                            copy(immutable_flags), copy(stable_immutable_flags),
-                            copy(enabled_flags), copy(stable_enabled_flags),
-                        )
+                (immutable_flags, stable_immutable_flags,
+                 enabled_flags, stable_enabled_flags) = cached_flags[profile_name]
 
                 # make profile data mappings immutable
                 immutable_flags.freeze()
@@ -387,7 +806,8 @@ class ProfileAddon(base.Addon):
                     profile.pkg_use,
                     stable_immutable_flags, stable_enabled_flags,
                     stable_cache,
-                    ProtectedSet(unstable_insoluble)))
+                    ProtectedSet(unstable_insoluble),
+                    (stable_key,), masked_keys))
 
                 profile_filters[unstable_key].append(profile_data(
                     profile_name, unstable_key,
@@ -398,19 +818,19 @@ class ProfileAddon(base.Addon):
                     profile.pkg_use,
                     immutable_flags, enabled_flags,
                     ProtectedSet(stable_cache),
-                    unstable_insoluble))
+                    unstable_insoluble,
+                    (stable_key, unstable_key), masked_keys))
 
         # dump cached profile filters
-        if options.cache:
+        if cache_modified:
             try:
-                with open(options.cache_file, 'wb+') as f:
-                    pickle.dump(cached_profile_filters, f)
-            except IOError as e:
-                msg = f'failed dumping profiles cache: {cache_file!r}: {e.strerror}'
+                cache.dump(cached_profile_filters, options.cache_file)
+            except OSError as e:
+                msg = f'failed dumping profiles cache: {options.cache_file!r}: {e.strerror}'
                 if not options.forced_cache:
                     logger.warn(msg)
                 else:
-                    raise CliException(msg)
+                    raise UserException(msg)
 
         profile_evaluate_dict = {}
         for key, profile_list in profile_filters.items():
@@ -427,6 +847,29 @@ class ProfileAddon(base.Addon):
         self.profile_evaluate_dict = profile_evaluate_dict
         self.profile_filters = profile_filters
 
+        for i, profile in enumerate(self):
+            profile.bit = 1 << i
+        self._visibility = LRUCache()
+        self.caches = (('profile visibility', self._visibility),)
+
+    @staticmethod
+    def _profile_digest(profile, settings, node_digests):
+        """Hash the files of all the nodes in a profile's stack.
+
+        :param settings: extra data affecting the generated filters
+        :param node_digests: mapping of profile node paths to their digests
+            shared across profiles
+        """
+        chksum = hashlib.sha256(repr((__version__, settings)).encode())
+        for node in profile.stack:
+            digest = node_digests.get(node.path)
+            if digest is None:
+                node_chksum = hashlib.sha256(node.path.encode())
+                cache.hash_files(node_chksum, _profile_files(node.path), node.path)
+                digest = node_digests[node.path] = node_chksum.digest()
+            chksum.update(digest)
+        return chksum.hexdigest()
+
     def identify_profiles(self, pkg):
         # yields groups of profiles; the 'groups' are grouped by the ability to share
         # the use processing across each of 'em.
@@ -442,6 +885,23 @@ class ProfileAddon(base.Addon):
                 l.append(l2)
         return l
 
+    def visibility(self, pkg):
+        """Return a bitset of the profiles a package is visible in."""
+        # same versions from different repos can have different visibility,
+        # package objects aren't used as keys to avoid keeping them alive
+        key = (pkg.cpvstr, pkg.repo.repo_id, tuple(pkg.keywords))
+        bits = self._visibility.get(key)
+        if bits is None:
+            bits = 0
+            for keyword in set(pkg.keywords):
+                keys = (keyword,) if keyword[0] in '~-' else (keyword, f'~{keyword}')
+                for profile in chain.from_iterable(
+                        self.profile_filters.get(x, ()) for x in keys):
+                    if profile.visible(pkg):
+                        bits |= profile.bit
+            self._visibility[key] = bits
+        return bits
+
     def __getitem__(self, key):
         """Return profiles matching a given keyword."""
         return self.profile_filters[key]
@@ -467,10 +927,21 @@ class EvaluateDepSetAddon(base.Template):
     feed_type = base.versioned_feed
     priority = 1
 
+    @staticmethod
+    def mangle_argparser(parser):
+        group = parser.add_argument_group('depset caching')
+        group.add_argument(
+            '--depset-cache-size', type=int, default=10000, metavar='ENTRIES',
+            help='number of evaluated depsets cached across packages')
+
     def __init__(self, options, profiles):
         super().__init__(options)
         self.pkg_evaluate_depsets_cache = {}
         self.pkg_profiles_cache = {}
+        # evaluated depsets are shared across versions and packages since
+        # they're fully determined by the depset and the USE state applied
+        self.evaluated_depsets = LRUCache(getattr(options, 'depset_cache_size', 10000))
+        self.caches = (('depset cache', self.evaluated_depsets),)
         self.profiles = profiles
 
     def feed(self, item, reporter):
@@ -498,8 +969,56 @@ class EvaluateDepSetAddon(base.Template):
             immutable, enabled = profiles[0].identify_use(pkg, diuse)
             collapsed.setdefault((immutable, enabled), []).extend(profiles)
 
-        return [(depset.evaluate_depset(k[1], tristate_filter=k[0]), v)
-                for k, v in collapsed.items()]
+        depset_str = str(depset)
+        l = []
+        for (immutable, enabled), profiles in collapsed.items():
+            key = (depset_str, immutable, enabled)
+            evaluated = self.evaluated_depsets.get(key)
+            if evaluated is None:
+                evaluated = depset.evaluate_depset(enabled, tristate_filter=immutable)
+                self.evaluated_depsets[key] = evaluated
+            l.append((evaluated, profiles))
+        return l
+
+
+class UseStateAddon(base.Addon):
+    """Cache of the USE states of packages for profiles.
+
+    The USE state of a package for a given profile is fully determined by
+    the package and the profile so it's cached across checks, keyed by the
+    package's cpv, repo, and IUSE and the profile's keyword and name.
+    """
+
+    cache_size = 50000
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.use_states = LRUCache(self.cache_size)
+        self.caches = (('USE state cache', self.use_states),)
+
+    @staticmethod
+    def use_state(pkg, profile):
+        """Determine the USE state of a package for a given profile.
+
+        :return: tuple of the forced, masked, and package specific USE flags
+            set by the profile along with the enabled USE flags and IUSE
+        """
+        forced_use = profile.forced_use.pull_data(pkg)
+        masked_use = profile.masked_use.pull_data(pkg)
+        pkg_use = profile.pkg_use.pull_data(pkg)
+        use_defaults = set(x[1:] for x in pkg.iuse if x[0] == '+')
+        enabled_use = (use_defaults | profile.use | pkg_use | forced_use) - masked_use
+        use = frozenset(enabled_use & (profile.iuse_effective | pkg.iuse_effective))
+        iuse = frozenset(profile.iuse_effective.union(pkg.iuse_stripped))
+        return forced_use, masked_use, pkg_use, use, iuse
+
+    def get(self, pkg, profile):
+        """Return the cached USE state of a package for a given profile."""
+        key = (pkg.cpvstr, pkg.repo, frozenset(pkg.iuse), profile.key, profile.name)
+        state = self.use_states.get(key)
+        if state is None:
+            state = self.use_states[key] = self.use_state(pkg, profile)
+        return state
 
 
 class StableArchesAddon(base.Template):
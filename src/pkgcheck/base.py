@@ -12,17 +12,21 @@ identical to the input scope.
 """
 
 from collections import OrderedDict
-from operator import attrgetter
+from functools import lru_cache
+from itertools import chain, count
 
 from pkgcore.config import ConfigHint
 from pkgcore.package.errors import MetadataException
 from snakeoil.demandload import demandload
 
 demandload(
-    'itertools:chain',
+    'heapq',
     're',
+    'time',
 )
 
+# Repository feeds stream sequences of packages in chunks (e.g. per package
+# or category) with the feed being finished after the entire repo was fed.
 repository_feed = "repo"
 category_feed = "cat"
 package_feed = "cat/pkg"
@@ -107,6 +111,14 @@ class Template(Addon, metaclass=set_documentation):
     # The plugger sorts based on this. Should be left alone except for
     # weird pseudo-checks like the cache wiper that influence other checks.
     priority = 0
+    # Whether results only depend on the files of the package being checked
+    # and repo-wide settings, allowing them to be cached across runs.
+    cacheable = False
+    # Whether the check can be run against disjoint sets of packages, e.g. in
+    # separate processes, without duplicating results. Checks reporting
+    # results for more than the packages they're fed when finishing must
+    # disable this.
+    splittable = True
 
     def start(self, reporter):
         """Do startup here."""
@@ -137,6 +149,10 @@ class Transform(object):
     def feed(self, item, reporter):
         raise NotImplementedError
 
+    def flush(self, reporter):
+        """Pass on any buffered items without finishing."""
+        self.child.flush(reporter)
+
     def finish(self, reporter):
         """Clean up."""
         self.child.finish(reporter)
@@ -214,18 +230,30 @@ class Result(object, metaclass=set_documentation):
         attrs = getattr(self, '__attrs__', getattr(self, '__slots__', None))
         if attrs:
             try:
-                return dict((k, getattr(self, k)) for k in attrs)
+                data = dict((k, getattr(self, k)) for k in attrs)
             except AttributeError as a:
                 # rethrow so we at least know the class
                 raise AttributeError(self.__class__, str(a))
+            # Results lacking complete slot definitions can carry extra
+            # attributes used for their descriptions, keep those separately.
+            # The verbosity setting is reporter specific and gets reset.
+            extra = dict(
+                (k, v) for k, v in getattr(self, '__dict__', {}).items()
+                if k != '_verbosity' and k not in data)
+            if extra:
+                return data, extra
+            return data
         return object.__getstate__(self)
 
     def __setstate__(self, data):
+        extra = {}
+        if isinstance(data, tuple):
+            data, extra = data
         attrs = set(getattr(self, '__attrs__', getattr(self, '__slots__', [])))
         if attrs.difference(data) or len(attrs) != len(data):
             raise TypeError(
                 f"can't restore {self.__class__} due to data {data!r} not being complete")
-        for k, v in data.items():
+        for k, v in chain(data.items(), extra.items()):
             setattr(self, k, v)
 
 
@@ -413,29 +441,32 @@ class CheckRunner(object):
         self.checks = checks
         self._metadata_errors = set()
 
+    def _metadata_error(self, e, reporter):
+        exc_info = (e.pkg, e.error)
+        # only report distinct metadata errors
+        if exc_info not in self._metadata_errors:
+            self._metadata_errors.add(exc_info)
+            error_str = ': '.join(str(e.error).split('\n'))
+            reporter.add_report(MetadataError(e.pkg, e.attr, error_str))
+
     def start(self, reporter):
         for check in self.checks:
             try:
                 check.start(reporter)
             except MetadataException as e:
-                exc_info = (e.pkg, e.error)
-                # only report distinct metadata errors
-                if exc_info not in self._metadata_errors:
-                    self._metadata_errors.add(exc_info)
-                    error_str = ': '.join(str(e.error).split('\n'))
-                    reporter.add_report(MetadataError(e.pkg, e.attr, error_str))
+                self._metadata_error(e, reporter)
 
     def feed(self, item, reporter):
         for check in self.checks:
             try:
                 check.feed(item, reporter)
             except MetadataException as e:
-                exc_info = (e.pkg, e.error)
-                # only report distinct metadata errors
-                if exc_info not in self._metadata_errors:
-                    self._metadata_errors.add(exc_info)
-                    error_str = ': '.join(str(e.error).split('\n'))
-                    reporter.add_report(MetadataError(e.pkg, e.attr, error_str))
+                self._metadata_error(e, reporter)
+
+    def flush(self, reporter):
+        for check in self.checks:
+            if isinstance(check, Transform):
+                check.flush(reporter)
 
     def finish(self, reporter):
         for check in self.checks:
@@ -457,6 +488,211 @@ class CheckRunner(object):
         return f'{self.__class__.__name__}({checks})'
 
 
+class Profiler(object):
+    """Record timing data for checks and transforms.
+
+    Time spent in nested pipeline objects, e.g. the checks fed by a
+    transform, is only accounted to the innermost object.
+
+    :ivar stats: mapping of class names to lists of start, feed, and finish
+        times along with the number of feed calls and items fed
+    """
+
+    _phases = {'start': 0, 'feed': 1, 'finish': 2}
+    # feed types passing single items instead of sequences of packages
+    _single_item_feeds = frozenset([versioned_feed, ebuild_feed])
+
+    def __init__(self):
+        self.stats = {}
+        self._nested_times = [0.0]
+
+    def call(self, obj, phase, *args):
+        """Call a given pipeline object method, recording its run time."""
+        self._nested_times.append(0.0)
+        start = time.perf_counter()
+        try:
+            return getattr(obj, phase)(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested_times.pop()
+            self._nested_times[-1] += elapsed
+            name = obj.__class__.__name__
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = [0.0, 0.0, 0.0, 0, 0]
+            stats[self._phases[phase]] += elapsed - nested
+            if phase == 'feed':
+                stats[3] += 1
+                feed_type = getattr(obj, 'feed_type', getattr(obj, 'source', None))
+                stats[4] += 1 if feed_type in self._single_item_feeds else len(args[0])
+
+    def update(self, stats):
+        """Merge timing data from another profiler."""
+        for name, values in stats.items():
+            current = self.stats.setdefault(name, [0.0, 0.0, 0.0, 0, 0])
+            for i, value in enumerate(values):
+                current[i] += value
+
+
+class ProfiledCheckRunner(CheckRunner):
+    """Check runner recording timing data for everything it runs."""
+
+    def __init__(self, checks, profiler):
+        super().__init__(checks)
+        self.profiler = profiler
+
+    def start(self, reporter):
+        for check in self.checks:
+            try:
+                self.profiler.call(check, 'start', reporter)
+            except MetadataException as e:
+                self._metadata_error(e, reporter)
+
+    def feed(self, item, reporter):
+        for check in self.checks:
+            try:
+                self.profiler.call(check, 'feed', item, reporter)
+            except MetadataException as e:
+                self._metadata_error(e, reporter)
+
+    def finish(self, reporter):
+        for check in self.checks:
+            self.profiler.call(check, 'finish', reporter)
+
+
+def profile_pipe(runner, profiler):
+    """Convert a pipeline to record timing data using a given profiler."""
+    for check in runner.checks:
+        if isinstance(check, Transform):
+            check.child = profile_pipe(check.child, profiler)
+    return ProfiledCheckRunner(runner.checks, profiler)
+
+
+def _shortest_paths(source, transforms):
+    """Find the cheapest transform paths from a source to all reachable types.
+
+    :param source: (feed_type, scope, cost) tuple
+    :param transforms: sequence of transform classes
+    :return: mapping of reachable feed types to (cost, transform) tuples with
+        the transform being the last step on the path, None for the source type
+    """
+    source_type, source_scope, source_cost = source
+    feed_to_transforms = {}
+    for transform in transforms:
+        if transform.scope <= source_scope:
+            feed_to_transforms.setdefault(transform.source, []).append(transform)
+
+    paths = {source_type: (0, None)}
+    done = set()
+    # the counter breaks ties so feed types are never compared
+    counter = count(1)
+    queue = [(0, 0, source_type)]
+    while queue:
+        cost, _, feed_type = heapq.heappop(queue)
+        if feed_type in done:
+            continue
+        done.add(feed_type)
+        for transform in feed_to_transforms.get(feed_type, ()):
+            new_cost = cost + transform.cost
+            current = paths.get(transform.dest)
+            if current is None or new_cost < current[0]:
+                paths[transform.dest] = (new_cost, transform)
+                heapq.heappush(queue, (new_cost, next(counter), transform.dest))
+    return paths
+
+
+def _path_transforms(paths, feed_type):
+    """Yield the transforms leading to a given feed type."""
+    transform = paths[feed_type][1]
+    while transform is not None:
+        yield transform
+        transform = paths[transform.source][1]
+
+
+@lru_cache(maxsize=32)
+def _plan(sinks, transforms, sources):
+    """Determine how to plug sinks, transforms, and sources together.
+
+    Only the attributes affecting the result are passed in so plans can be
+    cached and reused for equivalent arguments, e.g. when scanning multiple
+    targets with the same scope.
+
+    :param sinks: tuple of (feed_type, scope, priority) tuples
+    :param transforms: tuple of transform classes
+    :param sources: tuple of (feed_type, scope, cost) tuples
+    :return: a tuple of unreachable sink indexes, a tuple of
+        (source index, transform tree, sink tree) tuples, the trees mapping
+        feed types to the transforms and sink indexes fed with them, and a
+        tuple of (source index, reachable feed types) tuples
+    """
+    # Only the cheapest source for each scope and feed type is used.
+    source_map = {}
+    for i, (feed_type, scope, cost) in enumerate(sources):
+        current = source_map.get((scope, feed_type))
+        if current is None or sources[current][2] > cost:
+            source_map[scope, feed_type] = i
+    paths = {i: _shortest_paths(sources[i], transforms) for i in source_map.values()}
+    reachable = tuple(
+        (i, tuple(sorted(source_paths))) for i, source_paths in sorted(paths.items()))
+
+    def reaches(source, sink):
+        feed_type, scope, priority = sinks[sink]
+        return feed_type in paths[source] and scope <= sources[source][1]
+
+    # Throw out unreachable sinks.
+    good_sinks = []
+    bad_sinks = []
+    for i in range(len(sinks)):
+        if any(reaches(source, i) for source in paths):
+            good_sinks.append(i)
+        else:
+            bad_sinks.append(i)
+
+    if not good_sinks:
+        return tuple(bad_sinks), (), reachable
+
+    def cost(source, sink_indexes):
+        used = set()
+        for i in sink_indexes:
+            used.update(_path_transforms(paths[source], sinks[i][0]))
+        return sources[source][2] + sum(transform.cost for transform in used)
+
+    # If we find a single pipeline driving all sinks we want to use it, even
+    # if using separate pipelines would be cheaper.
+    best_cost = None
+    assignments = {}
+    for source in paths:
+        if all(reaches(source, i) for i in good_sinks):
+            source_cost = cost(source, good_sinks)
+            if best_cost is None or source_cost < best_cost:
+                best_cost = source_cost
+                assignments = {source: good_sinks}
+
+    if not assignments:
+        # No single pipe will drive everything, use the cheapest source for
+        # each sink instead.
+        for i in good_sinks:
+            source = min(
+                (source for source in paths if reaches(source, i)),
+                key=lambda source: sources[source][2] + paths[source][sinks[i][0]][0])
+            assignments.setdefault(source, []).append(i)
+
+    pipes = []
+    for source, sink_indexes in sorted(assignments.items()):
+        used = set()
+        sink_tree = {}
+        for i in reversed(sorted(sink_indexes, key=lambda i: sinks[i][2])):
+            used.update(_path_transforms(paths[source], sinks[i][0]))
+            sink_tree.setdefault(sinks[i][0], []).append(i)
+        transform_tree = {}
+        for transform in transforms:
+            if transform in used:
+                used.discard(transform)
+                transform_tree.setdefault(transform.source, []).append(transform)
+        pipes.append((source, transform_tree, sink_tree))
+    return tuple(bad_sinks), tuple(pipes), reachable
+
+
 def plug(sinks, transforms, sources, debug=None):
     """Plug together a pipeline.
 
@@ -464,6 +700,11 @@ def plug(sinks, transforms, sources, debug=None):
     more "expensive" than using separate pipelines). If more than one
     pipeline is needed it does not try to minimize the number.
 
+    Transforms are chosen along the cheapest paths from each source to the
+    feed types required by the sinks. The plan only depends on the feed
+    types, scopes, and costs of the given objects and is cached, fresh
+    transform instances are created for every call.
+
     :param sinks: Sequence of check instances.
     :param transforms: Sequence of transform classes.
     :param sources: Sequence of source instances.
@@ -472,173 +713,29 @@ def plug(sinks, transforms, sources, debug=None):
         missing sources/transforms of the right type),
         a sequence of (source, consumer) tuples.
     """
-
-    # This is not optimized to deal with huge numbers of sinks,
-    # sources and transforms, but that should not matter (although it
-    # may be necessary to handle a lot of sinks a bit better at some
-    # point, which should be fairly easy since we only care about
-    # their type and scope).
-
     assert sinks
 
-    feed_to_transforms = {}
-    for transform in transforms:
-        feed_to_transforms.setdefault(transform.source, []).append(transform)
-
-    # Map from typename to best scope
-    best_scope = {}
-    for source in sources:
-        # (not particularly clever, if we get a ton of sources this
-        # should be optimized to do less duplicate work).
-        reachable = set()
-        todo = set([source.feed_type])
-        while todo:
-            feed_type = todo.pop()
-            reachable.add(feed_type)
-            for transform in feed_to_transforms.get(feed_type, ()):
-                if (transform.scope <= source.scope and
-                        transform.dest not in reachable):
-                    todo.add(transform.dest)
-        for feed_type in reachable:
-            scope = best_scope.get(feed_type)
-            if scope is None or scope < source.scope:
-                best_scope[feed_type] = source.scope
-
-    # Throw out unreachable sinks.
-    good_sinks = []
-    bad_sinks = []
-    for sink in sinks:
-        scope = best_scope.get(sink.feed_type)
-        if scope is None or sink.scope > scope:
-            bad_sinks.append(sink)
-        else:
-            good_sinks.append(sink)
+    bad_sinks, pipes, reachable = _plan(
+        tuple((sink.feed_type, sink.scope, sink.priority) for sink in sinks),
+        tuple(transforms),
+        tuple((source.feed_type, source.scope, source.cost) for source in sources))
 
-    if not good_sinks:
-        # No point in continuing.
-        return bad_sinks, ()
-
-    # Throw out all sources with a scope lower than the least required scope.
-    # Does not check transform requirements, may not be very useful.
-    lowest_required_scope = min(sink.scope for sink in good_sinks)
-    highest_required_scope = max(sink.scope for sink in good_sinks)
-    sources = list(s for s in sources if s.scope >= lowest_required_scope)
-    if not sources:
-        # No usable sources, abort.
-        return bad_sinks + good_sinks, ()
-
-    # All types we need to reach.
-    sink_types = set(sink.feed_type for sink in good_sinks)
-
-    # Map from scope, source typename to cheapest source.
-    source_map = {}
-    for new_source in sources:
-        current_source = source_map.get((new_source.scope,
-                                         new_source.feed_type))
-        if current_source is None or current_source.cost > new_source.cost:
-            source_map[new_source.scope, new_source.feed_type] = new_source
-
-    # Tuples of (visited_types, source, transforms, price)
-    pipes = set()
-    unprocessed = set(
-        (frozenset((source.feed_type,)), source, frozenset(), source.cost)
-        for source in source_map.values())
+    # plans are cached so they're logged here instead of while planning
     if debug is not None:
-        for pipe in unprocessed:
-            debug(f'initial: {pipe!r}')
+        for i, feed_types in reachable:
+            debug(f'source {sources[i]!r} reaches {list(feed_types)!r}')
+        for i, transform_tree, sink_tree in pipes:
+            debug(f'using source {sources[i]!r} with transforms {transform_tree!r}')
 
-    # If we find a single pipeline driving all sinks we want to use it.
-    # List of tuples of source, transforms.
-    pipes_to_run = None
-    best_cost = None
-    while unprocessed:
-        next = unprocessed.pop()
-        if next in pipes:
-            continue
-        pipes.add(next)
-        visited, source, trans, cost = next
-        if visited >= sink_types:
-            # Already reaches all sink types. Check if it is usable as
-            # single pipeline:
-            if best_cost is None or cost < best_cost:
-                pipes_to_run = [(source, trans)]
-                best_cost = cost
-            # No point in growing this further: it already reaches everything.
-            continue
-        if best_cost is not None and best_cost <= cost:
-            # No point in growing this further.
-            continue
-        for transform in transforms:
-            if (source.scope >= transform.scope and
-                    transform.source in visited and
-                    transform.dest not in visited):
-                unprocessed.add((
-                    visited.union((transform.dest,)), source,
-                    trans.union((transform,)), cost + transform.cost))
-                if debug is not None:
-                    debug(f'growing {trans!r} for {source!r} with {transform!r}')
-
-    if pipes_to_run is None:
-        # No single pipe will drive everything, try combining pipes.
-        # This is pretty stupid but effective. Map sources to
-        # pipelines they drive, try combinations of sources (using a
-        # source more than once in a combination makes no sense since
-        # we also have the "combined" pipeline in pipes).
-        source_to_pipes = {}
-        for visited, source, trans, cost in pipes:
-            source_to_pipes.setdefault(source, []).append(
-                (visited, trans, cost))
-        unprocessed = set(
-            (visited, frozenset([source]), ((source, trans),), cost)
-            for visited, source, trans, cost in pipes)
-        done = set()
-        while unprocessed:
-            next = unprocessed.pop()
-            if next in done:
-                continue
-            done.add(next)
-            visited, sources, seq, cost = next
-            if visited >= sink_types:
-                # This combination reaches everything.
-                if best_cost is None or cost < best_cost:
-                    pipes_to_run = seq
-                    best_cost = cost
-                # No point in growing this further.
-            if best_cost is not None and best_cost <= cost:
-                # No point in growing this further.
-                continue
-            for source, source_pipes in source_to_pipes.items():
-                if source not in sources:
-                    for new_visited, trans, new_cost in source_pipes:
-                        unprocessed.add((
-                            visited.union(new_visited),
-                            sources.union([source]),
-                            seq + ((source, trans),),
-                            cost + new_cost))
-
-    # Just an assert since unreachable sinks should have been thrown away.
-    assert pipes_to_run, 'did not find a solution?'
-
-    good_sinks.sort(key=attrgetter('priority'))
-
-    def build_transform(scope, feed_type, transforms):
+    def build_transform(transform_tree, sink_tree, feed_type):
         children = list(
-            # Note this relies on the cheapest pipe not having
-            # any "loops" in its transforms.
-            trans(build_transform(scope, trans.dest, transforms))
-            for trans in transforms
-            if trans.source == feed_type and trans.scope <= scope)
-        # Hacky: we modify this in place.
-        for i in reversed(range(len(good_sinks))):
-            sink = good_sinks[i]
-            if sink.feed_type == feed_type and sink.scope <= source.scope:
-                children.append(sink)
-                del good_sinks[i]
+            transform(build_transform(transform_tree, sink_tree, transform.dest))
+            for transform in transform_tree.get(feed_type, ()))
+        children.extend(sinks[i] for i in sink_tree.get(feed_type, ()))
         return CheckRunner(children)
 
     result = list(
-        (source, build_transform(source.scope, source.feed_type, transforms))
-        for source, transforms in pipes_to_run)
+        (sources[i], build_transform(transform_tree, sink_tree, sources[i].feed_type))
+        for i, transform_tree, sink_tree in pipes)
 
-    assert not good_sinks, f'sinks left: {good_sinks!r}'
-    return bad_sinks, result
+    return [sinks[i] for i in bad_sinks], result
@@ -0,0 +1,295 @@
+"""Support for data cached across pkgcheck runs."""
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+from pkgcore import const
+from pkgcore.package.errors import MetadataException
+from snakeoil.osutils import pjoin
+
+from . import __version__
+
+CACHE_DIR = pjoin(const.USER_CACHE_PATH, 'pkgcheck')
+
+
+def dump(obj, path):
+    """Atomically pickle an object to a given file.
+
+    The data is written to a temporary file in the same directory that
+    replaces the target file when complete so concurrent readers never see
+    partially written data.
+    """
+    dirname, basename = os.path.split(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=f'.{basename}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def load(path):
+    """Load pickled data from a given file.
+
+    :return: the unpickled object or None if the file doesn't exist or
+        couldn't be unpickled, e.g. due to being written by an incompatible
+        pkgcheck version
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (EOFError, OSError, pickle.UnpicklingError,
+            AttributeError, ImportError, IndexError, TypeError, ValueError):
+        return None
+
+
+def hash_files(chksum, paths, base=None):
+    """Update a given hash object using the names and content of files."""
+    for path in paths:
+        chksum.update(os.path.relpath(path, base).encode() if base else path.encode())
+        chksum.update(b'\0')
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    chksum.update(chunk)
+        except FileNotFoundError:
+            pass
+        chksum.update(b'\0')
+
+
+def iter_files(path):
+    """Yield all files under a given directory in a stable order."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            yield pjoin(root, f)
+
+
+class ResultsCache(object):
+    """Persistent cache of the results generated for packages.
+
+    Results are stored per package keyed by a hash of the files in its
+    directory, the matching versions, and the eclasses those versions
+    inherit. The entire cache is invalidated when the pkgcheck version,
+    enabled checks, related options, or repo-wide settings (profiles,
+    layout.conf, and available licenses) change.
+    """
+
+    def __init__(self, options):
+        self.repo = options.target_repo
+        repo_hash = hashlib.sha1(self.repo.location.encode()).hexdigest()
+        self.path = pjoin(CACHE_DIR, 'results', f'{repo_hash}.pickle')
+        self.config = self._config_digest(options)
+        self.hits = 0
+        self.misses = 0
+        self._eclasses = {}
+        self._modified = False
+
+        data = load(self.path)
+        if not isinstance(data, dict) or data.get('config') != self.config:
+            data = {'config': self.config, 'packages': {}}
+        self.packages = data['packages']
+
+    def _config_digest(self, options):
+        """Hash of the settings affecting the results of all packages."""
+        chksum = hashlib.sha256()
+        config = (
+            __version__,
+            sorted(f'{x.__module__}.{x.__name__}' for x in options.enabled_checks),
+            sorted((arch, sorted(path for path, profile in profiles))
+                   for arch, profiles in getattr(options, 'arch_profiles', {}).items()),
+            sorted(getattr(options, 'arches', None) or ()),
+            sorted(getattr(options, 'stable_arches', None) or ()),
+            getattr(options, 'profiles_dir', None),
+            options.verbosity,
+            options.filtered,
+        )
+        chksum.update(repr(config).encode())
+        for repo in self.repo.trees:
+            location = repo.location
+            chksum.update(location.encode())
+            hash_files(chksum, iter_files(pjoin(location, 'profiles')), location)
+            hash_files(chksum, [pjoin(location, 'metadata', 'layout.conf')], location)
+            try:
+                licenses = sorted(os.listdir(pjoin(location, 'licenses')))
+            except FileNotFoundError:
+                licenses = []
+            chksum.update('\0'.join(licenses).encode())
+        return chksum.hexdigest()
+
+    def _eclass_digest(self, eclass):
+        digest = self._eclasses.get(eclass)
+        if digest is None:
+            chksum = hashlib.sha256()
+            source = self.repo.eclass_cache.get_eclass(eclass)
+            if source is not None:
+                hash_files(chksum, [source.path])
+            digest = self._eclasses[eclass] = chksum.digest()
+        return digest
+
+    def digest(self, pkgs):
+        """Hash the content related to the given versions of a package.
+
+        :param pkgs: sequence of package versions sharing the same key
+        :return: hex digest or None if the package can't be cached
+        """
+        chksum = hashlib.sha256()
+        eclasses = set()
+        try:
+            for pkg in pkgs:
+                chksum.update(pkg.cpvstr.encode())
+                eclasses.update(pkg.inherited)
+        except MetadataException:
+            return None
+        pkgdir = os.path.dirname(pkgs[0].path)
+        hash_files(chksum, iter_files(pkgdir), pkgdir)
+        for eclass in sorted(eclasses):
+            chksum.update(eclass.encode())
+            chksum.update(self._eclass_digest(eclass))
+        return chksum.hexdigest()
+
+    def get(self, key, digest):
+        """Return the cached results for a package if they're current."""
+        entry = self.packages.get(key)
+        if digest is not None and entry is not None and entry[0] == digest:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def update(self, key, digest, results):
+        """Store the results for a package."""
+        if digest is not None:
+            self.packages[key] = (digest, tuple(results))
+            self._modified = True
+
+    def save(self):
+        """Write the cache to disk if it was modified."""
+        if not self._modified:
+            return
+        # drop entries for packages that were removed from the repo
+        for key in list(self.packages):
+            if not os.path.isdir(pjoin(self.repo.location, *key)):
+                del self.packages[key]
+        dump({'config': self.config, 'packages': self.packages}, self.path)
+        self._modified = False
+
+
+class ContentCache(object):
+    """Persistent cache of data derived from file content.
+
+    Entries are keyed by digests of the content they're derived from. The
+    entire cache is invalidated when the pkgcheck version or the given
+    config changes, e.g. a hash of other files affecting the cached data.
+    New entries are merged with those saved by other processes when saving.
+
+    :param path: cache file path, None to only cache entries in memory
+    :param config: picklable value the cached data depends on
+    :param maxsize: number of stored entries triggering the removal of those
+        unused during the current run when saving
+    """
+
+    def __init__(self, path, config=None, maxsize=100000):
+        self.path = path
+        self.config = (__version__, config)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._new = {}
+        self._used = set()
+        self.entries = self._load()
+
+    def _load(self):
+        data = load(self.path) if self.path is not None else None
+        if not isinstance(data, dict) or data.get('config') != self.config:
+            return {}
+        return data['entries']
+
+    def get(self, key):
+        """Return the cached data for a given key or None if missing."""
+        self._used.add(key)
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._used.add(key)
+        self.entries[key] = self._new[key] = value
+
+    def save(self):
+        """Write new entries to disk."""
+        if self.path is None or not self._new:
+            return
+        entries = self._load()
+        entries.update(self._new)
+        if len(entries) > self.maxsize:
+            entries = {k: v for k, v in entries.items() if k in self._used}
+        dump({'config': self.config, 'entries': entries}, self.path)
+        self.entries = entries
+        self._new = {}
+
+
+class DigestCache(ContentCache):
+    """Persistent cache of file checksums.
+
+    Digests are keyed by the device, inode, size, and modification time of
+    files so unchanged files are never rehashed. Files lacking cached
+    digests can be hashed in parallel using a given executor since hashlib
+    releases the GIL while hashing.
+
+    :param path: cache file path, None to only cache digests in memory
+    :param algo: hashlib algorithm name
+    """
+
+    def __init__(self, path, algo='sha256', **kwargs):
+        self.algo = algo
+        super().__init__(path, config=algo, **kwargs)
+
+    @staticmethod
+    def key(st):
+        """Return the cache key for a given stat result."""
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _hash(self, path):
+        chksum = hashlib.new(self.algo)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                chksum.update(chunk)
+        return chksum.digest()
+
+    def digest_files(self, files, executor=None):
+        """Return the digests for a given set of files.
+
+        :param files: iterable of (path, stat result) tuples
+        :param executor: :class:`concurrent.futures.Executor` used to hash
+            uncached files
+        :return: mapping of paths to their digests
+        """
+        digests = {}
+        uncached = []
+        for path, st in files:
+            key = self.key(st)
+            digest = self.get(key)
+            if digest is None:
+                uncached.append((path, key))
+            else:
+                digests[path] = digest
+
+        mapper = executor.map if executor is not None else map
+        paths = [path for path, key in uncached]
+        for (path, key), digest in zip(uncached, mapper(self._hash, paths)):
+            self[key] = digests[path] = digest
+        return digests
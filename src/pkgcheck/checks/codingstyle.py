@@ -2,12 +2,9 @@
 
 from collections import defaultdict
 
-from snakeoil.demandload import demandload
 from snakeoil.strings import pluralism as _pl
 
-from .. import base
-
-demandload("re")
+from .. import addons, base
 
 
 class HttpsAvailable(base.Warning):
@@ -32,6 +29,8 @@ class HttpsAvailableCheck(base.Template):
     """Scan ebuild for http:// links that should use https://."""
 
     feed_type = base.ebuild_feed
+    cacheable = True
+    required_addons = (addons.LineScannerAddon,)
     known_results = (HttpsAvailable,)
 
     SITES = (
@@ -60,23 +59,21 @@ class HttpsAvailableCheck(base.Template):
         '(www\\.)?(enlightenment|sourceware|x)\\.org',
     )
 
-    def __init__(self, options):
+    def __init__(self, options, scanner):
         super().__init__(options)
+        self.scanner = scanner
         # anchor the end of the URL so we don't get false positives,
         # e.g. http://github.com.foo.bar.com/
-        self.regex = re.compile(r'.*(\bhttp://(%s)(\s|["\'/]|$))' % r'|'.join(self.SITES))
+        self.pattern = self.scanner.register(
+            r'^.*(\bhttp://(%s)(\s|["\'/]|$))' % r'|'.join(self.SITES),
+            prefilter=('http://',))
 
     def feed(self, entry, reporter):
         pkg, lines = entry
         links = defaultdict(list)
 
-        for lineno, line in enumerate(lines):
-            if not line:
-                continue
-            # searching for multiple matches on a single line is too slow
-            matches = self.regex.match(line)
-            if matches is not None:
-                links[matches.group(1)].append(lineno + 1)
+        for lineno, matches in self.scanner.matches(entry, self.pattern):
+            links[matches.group(1)].append(lineno)
 
         for link, lines in links.items():
             reporter.add_report(HttpsAvailable(pkg, link, lines))
@@ -103,6 +100,8 @@ class PortageInternalsCheck(base.Template):
     """Scan ebuild for portage internals usage."""
 
     feed_type = base.ebuild_feed
+    cacheable = True
+    required_addons = (addons.LineScannerAddon,)
     known_results = (PortageInternals,)
 
     INTERNALS = (
@@ -116,19 +115,17 @@ class PortageInternalsCheck(base.Template):
         'prepstrip',
     )
 
-    def __init__(self, options):
+    def __init__(self, options, scanner):
         super().__init__(options)
-        self.regex = re.compile(r'^(\s*|.*[|&{(]+\s*)\b(%s)\b' % r'|'.join(self.INTERNALS))
+        self.scanner = scanner
+        self.pattern = self.scanner.register(
+            r'^([^\S\n]*|.*[|&{(]+[^\S\n]*)\b(%s)\b' % r'|'.join(self.INTERNALS),
+            prefilter=('prep',))
 
     def feed(self, entry, reporter):
         pkg, lines = entry
-        for lineno, line in enumerate(lines):
-            if not line:
-                continue
-            # searching for multiple matches on a single line is too slow
-            matches = self.regex.match(line)
-            if matches is not None:
-                reporter.add_report(PortageInternals(pkg, matches.group(2), lineno + 1))
+        for lineno, matches in self.scanner.matches(entry, self.pattern):
+            reporter.add_report(PortageInternals(pkg, matches.group(2), lineno))
 
 
 class MissingSlash(base.Error):
@@ -171,13 +168,19 @@ class PathVariablesCheck(base.Template):
     """Scan ebuild for path variables with various issues."""
 
     feed_type = base.ebuild_feed
+    cacheable = True
+    required_addons = (addons.LineScannerAddon,)
     known_results = (MissingSlash, UnnecessarySlashStrip)
     variables = ('ROOT', 'EROOT', 'D', 'ED')
 
-    def __init__(self, options):
+    def __init__(self, options, scanner):
         super().__init__(options)
-        self.missing_regex = re.compile(r'(\${(%s)})"?\w' % r'|'.join(self.variables))
-        self.unnecessary_regex = re.compile(r'(\${(%s)%%/})' % r'|'.join(self.variables))
+        self.scanner = scanner
+        prefilter = tuple(f'${{{x}' for x in self.variables)
+        self.missing_pattern = self.scanner.register(
+            r'(\${(%s)})"?\w' % r'|'.join(self.variables), prefilter=prefilter)
+        self.unnecessary_pattern = self.scanner.register(
+            r'(\${(%s)%%/})' % r'|'.join(self.variables), prefilter=prefilter)
 
     def feed(self, entry, reporter):
         pkg, lines = entry
@@ -189,15 +192,10 @@ class PathVariablesCheck(base.Template):
         missing = defaultdict(list)
         unnecessary = defaultdict(list)
 
-        for lineno, line in enumerate(lines):
-            if not line:
-                continue
-            matches = self.missing_regex.search(line)
-            if matches is not None:
-                missing[matches.group(1)].append(lineno + 1)
-            matches = self.unnecessary_regex.search(line)
-            if matches is not None:
-                unnecessary[matches.group(1)].append(lineno + 1)
+        for lineno, matches in self.scanner.matches(entry, self.missing_pattern):
+            missing[matches.group(1)].append(lineno)
+        for lineno, matches in self.scanner.matches(entry, self.unnecessary_pattern):
+            unnecessary[matches.group(1)].append(lineno)
 
         for var, lines in missing.items():
             reporter.add_report(MissingSlash(pkg, var, lines))
@@ -227,23 +225,23 @@ class AbsoluteSymlinkCheck(base.Template):
     """Scan ebuild for dosym absolute path usage instead of relative."""
 
     feed_type = base.ebuild_feed
+    cacheable = True
+    required_addons = (addons.LineScannerAddon,)
     known_results = (AbsoluteSymlink,)
 
     DIRS = ('bin', 'etc', 'lib', 'opt', 'sbin', 'srv', 'usr', 'var')
 
-    def __init__(self, options):
+    def __init__(self, options, scanner):
         super().__init__(options)
-        self.regex = re.compile(r'^\s*dosym\s+["\']?(/(%s)\S*)' % r'|'.join(self.DIRS))
+        self.scanner = scanner
+        self.pattern = self.scanner.register(
+            r'^[^\S\n]*dosym[^\S\n]+["\']?(/(%s)\S*)' % r'|'.join(self.DIRS),
+            prefilter=('dosym',))
 
     def feed(self, entry, reporter):
         pkg, lines = entry
-        for lineno, line in enumerate(lines):
-            if not line:
-                continue
-            matches = self.regex.match(line)
-            if matches is not None:
-                reporter.add_report(
-                    AbsoluteSymlink(pkg, matches.groups()[0], lineno + 1))
+        for lineno, matches in self.scanner.matches(entry, self.pattern):
+            reporter.add_report(AbsoluteSymlink(pkg, matches.group(1), lineno))
 
 
 class BadInsIntoDir(base.Warning):
@@ -268,17 +266,21 @@ class BadInsIntoCheck(base.Template):
     """Scan ebuild for bad insinto usage."""
 
     feed_type = base.ebuild_feed
+    cacheable = True
     _bad_insinto = None
     _bad_etc = ("conf", "env", "init", "pam")
     _bad_cron = ("hourly", "daily", "weekly", "d")
     _bad_paths = ("/usr/share/applications",)
 
+    required_addons = (addons.LineScannerAddon,)
     known_results = (BadInsIntoDir,)
 
-    def __init__(self, options):
+    def __init__(self, options, scanner):
         super().__init__(options)
         if self._bad_insinto is None:
             self._load_class_regex()
+        self.scanner = scanner
+        self.pattern = self.scanner.register(self._bad_insinto, prefilter=('insinto',))
 
     @classmethod
     def _load_class_regex(cls):
@@ -291,16 +293,9 @@ class BadInsIntoCheck(base.Template):
             patterns.extend(x.strip("/") for x in cls._bad_paths)
         s = "|".join(patterns)
         s = s.replace("/", "/+")
-        cls._bad_insinto = re.compile("insinto[ \t]+(/+(?:%s))(?:$|[/ \t])" % s)
+        cls._bad_insinto = "insinto[ \t]+(/+(?:%s))(?:$|[/ \t])" % s
 
     def feed(self, entry, reporter):
         pkg, lines = entry
-
-        badf = self._bad_insinto.search
-        for lineno, line in enumerate(lines):
-            if not line:
-                continue
-            matches = badf(line)
-            if matches is not None:
-                reporter.add_report(
-                    BadInsIntoDir(pkg, matches.groups()[0], lineno + 1))
+        for lineno, matches in self.scanner.matches(entry, self.pattern):
+            reporter.add_report(BadInsIntoDir(pkg, matches.group(1), lineno))
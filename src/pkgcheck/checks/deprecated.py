@@ -32,6 +32,7 @@ class DeprecatedEclass(base.Warning):
 class DeprecatedEclassReport(base.Template):
 
     feed_type = base.versioned_feed
+    cacheable = True
     known_results = (DeprecatedEclass,)
 
     blacklist = ImmutableDict({
@@ -24,6 +24,7 @@ class DroppedKeywordsReport(Template):
     """Scan packages for keyword dropping across versions."""
 
     feed_type = package_feed
+    cacheable = True
     required_addons = (ArchesAddon,)
     known_results = (DroppedKeywords,)
 
@@ -28,6 +28,7 @@ class ImlateReport(base.Template):
     """Scan for ebuilds that are lagging in stabilization."""
 
     feed_type = base.package_feed
+    cacheable = True
     required_addons = (addons.StableArchesAddon,)
     known_results = (LaggingStable,)
 
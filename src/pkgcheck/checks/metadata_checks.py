@@ -41,6 +41,7 @@ class LicenseMetadataReport(base.Template):
     known_results = (MetadataError, MissingLicense) + \
         addons.UseAddon.known_results
     feed_type = base.versioned_feed
+    cacheable = True
 
     required_addons = (addons.UseAddon, addons.ProfileAddon)
 
@@ -64,6 +65,7 @@ class IUSEMetadataReport(base.Template):
     """IUSE validity checks."""
 
     feed_type = base.versioned_feed
+    cacheable = True
     required_addons = (addons.UseAddon,)
     known_results = (MetadataError,) + addons.UseAddon.known_results
 
@@ -116,6 +118,8 @@ class MetadataReport(base.Template):
     """Scan for packages with banned/deprecated EAPIs or bad metadata."""
 
     feed_type = base.versioned_feed
+    # masked packages are reported for the entire repo when finishing
+    splittable = False
     known_results = (DeprecatedEAPI,)
 
     def feed(self, pkg, reporter):
@@ -172,13 +176,15 @@ class RequiredUSEMetadataReport(base.Template):
     """REQUIRED_USE validity checks."""
 
     feed_type = base.versioned_feed
-    required_addons = (addons.UseAddon, addons.ProfileAddon)
+    cacheable = True
+    required_addons = (addons.UseAddon, addons.ProfileAddon, addons.UseStateAddon)
     known_results = (MetadataError, RequiredUseDefaults) + addons.UseAddon.known_results
 
-    def __init__(self, options, iuse_handler, profiles):
+    def __init__(self, options, iuse_handler, profiles, use_states):
         super().__init__(options)
         self.iuse_filter = iuse_handler.get_filter('required_use')
         self.profiles = profiles
+        self.use_states = use_states
 
     def feed(self, pkg, reporter):
         # only run the check for EAPI 4 and above
@@ -202,7 +208,7 @@ class RequiredUSEMetadataReport(base.Template):
         failures = defaultdict(list)
         for keyword in keywords:
             for profile in self.profiles.get(keyword, ()):
-                src = FakeConfigurable(pkg, profile)
+                src = FakeConfigurable(pkg, profile, self.use_states.get(pkg, profile))
                 for node in pkg.required_use.evaluate_depset(src.use):
                     if not node.match(src.use):
                         failures[node].append((src.use, profile.key, profile.name))
@@ -293,6 +299,7 @@ class LocalUSECheck(base.Template):
     """Check local USE flags in metadata.xml for various issues."""
 
     feed_type = base.package_feed
+    cacheable = True
     required_addons = (addons.UseAddon,)
     known_results = addons.UseAddon.known_results + (
         UnusedLocalUSE, MatchingGlobalUSE, ProbableGlobalUSE,
@@ -431,7 +438,7 @@ class MissingUseDepDefault(base.Warning):
 class DependencyReport(base.Template):
     """Check BDEPEND, DEPEND, RDEPEND, and PDEPEND."""
 
-    required_addons = (addons.UseAddon,)
+    required_addons = (addons.UseAddon, addons.RepoIndexAddon)
     known_results = (
         MetadataError, MissingRevision, MissingUseDepDefault,
         ) + addons.UseAddon.known_results
@@ -441,9 +448,10 @@ class DependencyReport(base.Template):
     attrs = tuple((x, attrgetter(x)) for x in
                   ("bdepend", "depend", "rdepend", "pdepend"))
 
-    def __init__(self, options, iuse_handler):
+    def __init__(self, options, iuse_handler, repo_index):
         super().__init__(options)
         self.iuse_filter = iuse_handler.get_filter()
+        self.repo_index = repo_index
         self.conditional_ops = {'?', '='}
         self.use_defaults = {'(+)', '(-)'}
 
@@ -464,7 +472,7 @@ class DependencyReport(base.Template):
         stripped_use = [x.strip('?=').lstrip('!') for x in conditional_use]
         if stripped_use:
             missing_use_deps = defaultdict(set)
-            for pkg_dep in self.options.search_repo.match(strip_atom_use(atom)):
+            for pkg_dep in self.repo_index.itermatch(strip_atom_use(atom)):
                 for use in stripped_use:
                     if use not in pkg_dep.iuse_effective:
                         missing_use_deps[use].add(pkg_dep)
@@ -582,16 +590,17 @@ class MissingVirtualKeywords(base.Warning):
 class KeywordsReport(base.Template):
     """Check package keywords for sanity; empty keywords, and -* are flagged."""
 
-    required_addons = (addons.UseAddon,)
+    required_addons = (addons.UseAddon, addons.RepoIndexAddon)
     feed_type = base.versioned_feed
     known_results = (
         StupidKeywords, InvalidKeywords, UnsortedKeywords, MissingVirtualKeywords,
         MetadataError,
     )
 
-    def __init__(self, options, iuse_handler):
+    def __init__(self, options, iuse_handler, repo_index):
         super().__init__(options)
         self.iuse_filter = iuse_handler.get_filter()
+        self.repo_index = repo_index
         self.valid_arches = self.options.target_repo.known_arches
         # Note: '*' and '~*' are portage-only special KEYWORDS atm, i.e. not
         # in PMS or implemented in pkgcore.
@@ -615,7 +624,7 @@ class KeywordsReport(base.Template):
                 keywords = set()
                 rdepend = set(self.iuse_filter((atom_cls,), pkg, pkg.rdepend, reporter))
                 for x in rdepend:
-                    for p in self.options.search_repo.match(strip_atom_use(x)):
+                    for p in self.repo_index.itermatch(strip_atom_use(x)):
                         keywords.update(p.keywords)
                 keywords = keywords | {f'~{x}' for x in keywords if x in self.valid_arches}
                 missing_keywords = set(pkg.keywords) - keywords
@@ -706,6 +715,7 @@ class SrcUriReport(base.Template):
 
     required_addons = (addons.UseAddon,)
     feed_type = base.versioned_feed
+    cacheable = True
     known_results = (BadFilename, BadProto, MissingUri, MetadataError, UnknownMirror) + \
         addons.UseAddon.known_results
 
@@ -792,6 +802,7 @@ class DescriptionReport(base.Template):
     """
 
     feed_type = base.versioned_feed
+    cacheable = True
     known_results = (BadDescription,)
 
     def feed(self, pkg, reporter):
@@ -846,6 +857,7 @@ class BadRestricts(base.Warning):
 
 class RestrictsReport(base.Template):
     feed_type = base.versioned_feed
+    cacheable = True
     known_restricts = frozenset((
         "binchecks", "bindist", "fetch", "installsources", "mirror",
         "primaryuri", "splitdebug", "strip", "test", "userpriv",
@@ -1,14 +1,17 @@
+from collections import namedtuple
 import os
 
+from snakeoil.cli.arghparse import StoreBool
 from snakeoil.demandload import demandload
 from snakeoil.strings import pluralism as _pl
 
-from .. import base
+from .. import addons, base, cache
 
 demandload(
     'argparse',
     'functools:partial',
-    'itertools:chain',
+    'hashlib',
+    'io',
     'urllib.request:urlopen',
     'urllib:error@urllib_error',
     'lxml:etree',
@@ -75,7 +78,8 @@ class base_InvalidXml(base.Error):
     # message first so partial() can be easily applied
     def __init__(self, message, filename, category, package=None):
         super().__init__()
-        self.message = message
+        # lxml error logs can't be pickled, store the formatted errors instead
+        self.message = tuple(self.format_lxml_errors(message))
         self.category = category
         self.package = package
         self.filename = filename
@@ -95,7 +99,7 @@ class base_InvalidXml(base.Error):
     def short_desc(self):
         return "%s %s violates metadata.xsd:\n%s" % (
             self._label, os.path.basename(self.filename),
-            '\n'.join(self.format_lxml_errors(self.message)))
+            '\n'.join(self.message))
 
 
 class base_MetadataXmlInvalidPkgRef(base.Error):
@@ -282,11 +286,22 @@ class PkgMetadataXmlEmptyElement(MetadataXmlEmptyElement):
     threshold = base.package_feed
 
 
+# lxml error log entries can't be pickled
+_XmlError = namedtuple('_XmlError', ('line', 'column', 'type_name', 'message'))
+
+# repo independent data extracted from a metadata.xml file
+_XmlData = namedtuple('_XmlData', (
+    'misformed', 'errors', 'empty_elements', 'cat_refs', 'pkg_refs', 'indents'))
+
+
 class base_check(base.Template):
     """Base class for metadata.xml scans."""
 
     xsd_url = "https://www.gentoo.org/xml-schema/metadata.xsd"
     schema = None
+    schema_digest = None
+
+    required_addons = (addons.RepoIndexAddon,)
 
     misformed_error = None
     invalid_error = None
@@ -302,94 +317,116 @@ class base_check(base.Template):
                 '--metadata-xsd-required',
                 help="if metadata.xsd cannot be fetched (no connection for example), "
                      "treat it as a failure rather than warning and ignoring.")
+            parser.plugin.add_argument(
+                '--metadata-xml-cache', action=StoreBool, default=True,
+                help='cache metadata.xml validation results across runs',
+                docs="""
+                    Store the results of parsing and validating metadata.xml
+                    files in the pkgcheck user cache directory keyed by the
+                    hash of their content and metadata.xsd so unchanged files
+                    aren't revalidated on future runs. Package and category
+                    references are still checked against the current repo.
+                    Enabled by default.
+                """)
         except argparse.ArgumentError:
             # the arguments have already been added to the parser
             pass
 
-    def __init__(self, options):
+    def __init__(self, options, repo_index):
         super().__init__(options)
         self.repo_base = options.target_repo.location
+        self.repo_index = repo_index
         self.xsd_file = None
+        self.xml_cache = None
 
     def start(self, reporter):
+        self.pkgref_cache = {}
         if base_check.schema is None:
-            refetch = False
-            write_path = read_path = self.options.metadata_xsd
+            self._load_schema()
+        path = None
+        # results generated without a schema are only cached in memory so
+        # they don't replace the cached results of validated files
+        if (getattr(self.options, 'metadata_xml_cache', False) and
+                base_check.schema_digest is not None):
+            path = pjoin(cache.CACHE_DIR, 'metadata_xml.pickle')
+        self.xml_cache = cache.ContentCache(path, base_check.schema_digest)
+
+    def finish(self, reporter):
+        try:
+            self.xml_cache.save()
+        except OSError as e:
+            logger.warn('failed dumping metadata.xml cache: %r: %s', self.xml_cache.path, e.strerror)
+
+    def _load_schema(self):
+        refetch = False
+        write_path = read_path = self.options.metadata_xsd
+        if write_path is None:
+            read_path = pjoin(self.repo_base, 'metadata', 'xml-schema', 'metadata.xsd')
+        refetch = not os.path.isfile(read_path)
+
+        if refetch:
+            if self.options.verbosity > 0:
+                logger.warn('metadata.xsd cannot be opened from %s, will refetch', read_path)
+            logger.info("fetching metdata.xsd from %s", self.xsd_url)
+            try:
+                xsd_data = urlopen(self.xsd_url).read()
+            except urllib_error.URLError as e:
+                if self.options.metadata_xsd_required:
+                    raise Exception(
+                        "failed fetching xsd from %s: reason %s. "
+                        "Due to --metadata-xsd-required in use, bailing" %
+                        (self.xsd_url, e.reason))
+                logger.warn(
+                    "failed fetching XML Schema from %s: reason %s", self.xsd_url, e.reason)
+                self.validator = noop_validator
+                return
             if write_path is None:
-                read_path = pjoin(self.repo_base, 'metadata', 'xml-schema', 'metadata.xsd')
-            refetch = not os.path.isfile(read_path)
-
-            if refetch:
-                if self.options.verbosity > 0:
-                    logger.warn('metadata.xsd cannot be opened from %s, will refetch', read_path)
-                logger.info("fetching metdata.xsd from %s", self.xsd_url)
-                try:
-                    xsd_data = urlopen(self.xsd_url).read()
-                except urllib_error.URLError as e:
-                    if self.options.metadata_xsd_required:
-                        raise Exception(
-                            "failed fetching xsd from %s: reason %s. "
-                            "Due to --metadata-xsd-required in use, bailing" %
-                            (self.xsd_url, e.reason))
-                    logger.warn(
-                        "failed fetching XML Schema from %s: reason %s", self.xsd_url, e.reason)
-                    self.validator = noop_validator
-                    return
-                if write_path is None:
-                    self.xsd_file = NamedTemporaryFile()
-                    write_path = read_path = self.xsd_file.name
-                try:
-                    fileutils.write_file(write_path, 'wb', xsd_data)
-                except EnvironmentError as e:
-                    if self.options.metadata_xsd_required:
-                        raise Exception(
-                            "failed saving XML Schema to %s: reason %s. "
-                            "Due to --metadata-xsd-required in use, bailing" %
+                self.xsd_file = NamedTemporaryFile()
+                write_path = read_path = self.xsd_file.name
+            try:
+                fileutils.write_file(write_path, 'wb', xsd_data)
+            except EnvironmentError as e:
+                if self.options.metadata_xsd_required:
+                    raise Exception(
+                        "failed saving XML Schema to %s: reason %s. "
+                        "Due to --metadata-xsd-required in use, bailing" %
+                        (write_path, e))
+                logger.warn("failed writing XML Schema to %s: reason %s.  Disabling check." %
                             (write_path, e))
-                    logger.warn("failed writing XML Schema to %s: reason %s.  Disabling check." %
-                                (write_path, e))
-                    self.validator = noop_validator
-                    return
+                self.validator = noop_validator
+                return
 
-            base_check.schema = etree.XMLSchema(etree.parse(read_path))
-
-        self.pkgref_cache = {}
+        base_check.schema = etree.XMLSchema(etree.parse(read_path))
+        with open(read_path, 'rb') as f:
+            base_check.schema_digest = hashlib.sha256(f.read()).hexdigest()
 
     def feed(self, thing, reporter):
         raise NotImplementedError(self.feed)
 
     def check_doc(self, doc):
-        """Perform additional document structure checks."""
+        """Extract data for additional document structure checks.
+
+        :return: tuple of empty elements as (tag, line) tuples, category
+            references, and package references
+        """
         # find all root descendant elements that are empty
+        empty = []
         for el in doc.getroot().iterdescendants():
             if (not el.getchildren() and (el.text is None or not el.text.strip())
                     and not el.tag == 'stabilize-allarches'):
-                yield partial(self.empty_element, el.tag, el.sourceline)
-
-        for el in doc.findall('.//cat'):
-            c = el.text.strip()
-            if c not in self.options.search_repo.categories:
-                yield partial(self.catref_error, c)
+                empty.append((el.tag, el.sourceline))
+        cats = tuple(el.text.strip() for el in doc.findall('.//cat'))
+        pkgs = tuple(el.text.strip() for el in doc.findall('.//pkg'))
+        return tuple(empty), cats, pkgs
 
-        for el in doc.findall('.//pkg'):
-            p = el.text.strip()
-            if p not in self.pkgref_cache:
-                try:
-                    a = atom(p)
-                    found = self.options.search_repo.has_match(a)
-                except Exception:
-                    # invalid atom
-                    found = False
-                self.pkgref_cache[p] = found
+    def check_whitespace(self, data):
+        """Check for indentation consistency.
 
-            if not self.pkgref_cache[p]:
-                yield partial(self.pkgref_error, p)
-
-    def check_whitespace(self, loc):
-        """Check for indentation consistency."""
+        :return: sorted tuple of lines with inconsistent indentation
+        """
         orig_indent = None
         indents = set()
-        with open(loc) as f:
+        with io.TextIOWrapper(io.BytesIO(data), encoding='utf8', errors='replace') as f:
             for lineno, line in enumerate(f):
                 for i in line[:-len(line.lstrip())]:
                     if i != orig_indent:
@@ -397,23 +434,77 @@ class base_check(base.Template):
                             orig_indent = i
                         else:
                             indents.update([lineno + 1])
-        if indents:
-            yield partial(self.indent_error, indents)
+        return tuple(sorted(indents))
 
-    def check_file(self, loc):
+    def parse_file(self, data):
+        """Parse and validate the content of a metadata.xml file.
+
+        :return: :class:`_XmlData` tuple
+        """
         try:
-            doc = etree.parse(loc)
-        except (IOError, OSError):
-            return (self.missing_error,)
+            doc = etree.ElementTree(etree.fromstring(data))
         except etree.XMLSyntaxError:
-            return (self.misformed_error,)
+            return _XmlData(True, (), (), (), (), ())
 
         # note: while doc is available, do not pass it here as it may
         # trigger undefined behavior due to incorrect structure
-        if not self.schema.validate(doc):
-            return (partial(self.invalid_error, self.schema.error_log),)
+        if self.schema is not None and not self.schema.validate(doc):
+            errors = tuple(
+                _XmlError(l.line, l.column, l.type_name, l.message)
+                for l in self.schema.error_log)
+            return _XmlData(False, errors, (), (), (), ())
 
-        return chain.from_iterable((self.check_doc(doc), self.check_whitespace(loc)))
+        empty, cats, pkgs = self.check_doc(doc)
+        return _XmlData(False, (), empty, cats, pkgs, self.check_whitespace(data))
+
+    def check_file(self, loc):
+        try:
+            with open(loc, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return (self.missing_error,)
+
+        key = hashlib.sha256(data).hexdigest()
+        xml = self.xml_cache.get(key)
+        if xml is None:
+            xml = self.xml_cache[key] = self.parse_file(data)
+        return self.check_data(xml)
+
+    def check_data(self, xml):
+        """Generate reports for parsed metadata.xml data.
+
+        Category and package references are checked against the current
+        repo since they can change independently of the file.
+        """
+        if xml.misformed:
+            yield self.misformed_error
+            return
+        if xml.errors:
+            yield partial(self.invalid_error, xml.errors)
+            return
+
+        for tag, line in xml.empty_elements:
+            yield partial(self.empty_element, tag, line)
+
+        for c in xml.cat_refs:
+            if c not in self.options.search_repo.categories:
+                yield partial(self.catref_error, c)
+
+        for p in xml.pkg_refs:
+            if p not in self.pkgref_cache:
+                try:
+                    a = atom(p)
+                    found = self.repo_index.has_match(a)
+                except Exception:
+                    # invalid atom
+                    found = False
+                self.pkgref_cache[p] = found
+
+            if not self.pkgref_cache[p]:
+                yield partial(self.pkgref_error, p)
+
+        if xml.indents:
+            yield partial(self.indent_error, xml.indents)
 
 
 class PackageMetadataXmlCheck(base_check):
@@ -434,13 +525,24 @@ class PackageMetadataXmlCheck(base_check):
         PkgMetadataXmlInvalidPkgRef, PkgMetadataXmlInvalidCatRef,
         PkgMetadataXmlIndentation, PkgMetadataXmlEmptyElement)
 
+    required_addons = base_check.required_addons + (addons.PkgDirAddon,)
+
+    def __init__(self, options, repo_index, pkgdir):
+        super().__init__(options, repo_index)
+        self.pkgdir = pkgdir
+
     def feed(self, pkgs, reporter):
         # package with no ebuilds, skipping check
         if not pkgs:
             return
         pkg = pkgs[0]
-        loc = pjoin(os.path.dirname(pkg.ebuild.path), "metadata.xml")
-        for report in self.check_file(loc):
+        snapshot = self.pkgdir.snapshot(pkgs)
+        loc = pjoin(snapshot.path, "metadata.xml")
+        if "metadata.xml" in snapshot.entries:
+            reports = self.check_file(loc)
+        else:
+            reports = (self.missing_error,)
+        for report in reports:
             reporter.add_report(report(loc, pkg.category, pkg.package))
 
 
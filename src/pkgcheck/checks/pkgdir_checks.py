@@ -1,16 +1,21 @@
-import codecs
 from collections import defaultdict, deque
 import os
 import stat
 
 from pkgcore.ebuild.atom import MalformedAtom, atom
+from snakeoil.cli.arghparse import StoreBool
 from snakeoil.demandload import demandload
-from snakeoil.osutils import listdir, pjoin, sizeof_fmt
+from snakeoil.osutils import pjoin, sizeof_fmt
 from snakeoil.strings import pluralism as _pl
 
+from .. import addons, cache
 from ..base import Error, Warning, Template, package_feed
+from ..feeds import read_text
 
-demandload('snakeoil.chksum:get_chksums')
+demandload(
+    'concurrent.futures:ThreadPoolExecutor',
+    'pkgcore.log:logger',
+)
 
 allowed_filename_chars = "a-zA-Z0-9._-+:"
 allowed_filename_chars_set = set()
@@ -164,9 +169,7 @@ class InvalidUtf8(Error):
 
 def utf8_check(pkg, base, filename, reporter):
     try:
-        codecs.open(
-            pjoin(base, filename), mode="rb",
-            encoding="utf8", buffering=8192).read()
+        read_text(pjoin(base, filename))
     except UnicodeDecodeError as e:
         reporter.add_report(InvalidUtf8(pkg, filename, str(e)))
         del e
@@ -176,6 +179,7 @@ class PkgDirReport(Template):
     """Actual ebuild directory scans; file size, glep31 rule enforcement."""
 
     feed_type = package_feed
+    cacheable = True
 
     ignore_dirs = set(["cvs", ".svn", ".bzr"])
     known_results = (
@@ -183,19 +187,54 @@ class PkgDirReport(Template):
         Glep31Violation, InvalidUtf8, MismatchedPN, InvalidPN,
     )
 
+    required_addons = (addons.PkgDirAddon,)
+
     # TODO: put some 'preferred algorithms by purpose' into snakeoil?
     digest_algo = 'sha256'
 
+    @staticmethod
+    def mangle_argparser(parser):
+        parser.plugin.add_argument(
+            '--digest-cache', action=StoreBool, default=True,
+            help='cache checksums of FILESDIR files across runs',
+            docs="""
+                Store the checksums calculated to find duplicate files in
+                FILESDIR in the pkgcheck user cache directory so unchanged
+                files aren't rehashed on future runs. Enabled by default.
+            """)
+
+    def __init__(self, options, pkgdir):
+        super().__init__(options)
+        self.pkgdir = pkgdir
+        self.digests = None
+        self.executor = None
+
+    def start(self, reporter):
+        path = None
+        if getattr(self.options, 'digest_cache', False):
+            path = pjoin(cache.CACHE_DIR, 'digests', f'{self.digest_algo}.pickle')
+        self.digests = cache.DigestCache(path, self.digest_algo)
+        self.executor = ThreadPoolExecutor()
+
+    def finish(self, reporter):
+        self.executor.shutdown()
+        try:
+            self.digests.save()
+        except OSError as e:
+            logger.warn('failed dumping digest cache: %r: %s', self.digests.path, e.strerror)
+        self.executor = self.digests = None
+
     def feed(self, pkgset, reporter):
         pkg = pkgset[0]
-        base = os.path.dirname(pkg.path)
+        snapshot = self.pkgdir.snapshot(pkgset)
+        base = snapshot.path
         category = os.path.basename(
             os.path.dirname(os.path.dirname(pkg.path)))
         ebuild_ext = '.ebuild'
         mismatched = []
         invalid = []
         # note we don't use os.walk, we need size info also
-        for filename in listdir(base):
+        for filename in snapshot.listdir():
             # while this may seem odd, written this way such that the
             # filtering happens all in the genexp.  if the result was being
             # handed to any, it's a frame switch each
@@ -206,7 +245,8 @@ class PkgDirReport(Template):
 
             if (filename.endswith(ebuild_ext) or filename in
                     ("Manifest", "metadata.xml")):
-                if os.stat(pjoin(base, filename)).st_mode & 0o111:
+                st = snapshot.entries[filename]
+                if stat.S_ISREG(st.st_mode) and st.st_mode & 0o111:
                     reporter.add_report(ExecutableFile(pkg, filename))
 
             if filename.endswith(ebuild_ext):
@@ -225,15 +265,14 @@ class PkgDirReport(Template):
         if invalid:
             reporter.add_report(InvalidPN(pkg, invalid))
 
-        if not os.path.exists(pjoin(base, 'files')):
+        if 'files' not in snapshot.dirs:
             return
         unprocessed_dirs = deque(["files"])
         files_by_size = defaultdict(list)
         while unprocessed_dirs:
             cwd = unprocessed_dirs.pop()
-            for fn in listdir(pjoin(base, cwd)):
-                afn = pjoin(base, cwd, fn)
-                st = os.lstat(afn)
+            for fn in snapshot.listdir(cwd):
+                st = snapshot.entries[pjoin(cwd, fn)]
 
                 if stat.S_ISDIR(st.st_mode):
                     if fn not in self.ignore_dirs:
@@ -252,12 +291,14 @@ class PkgDirReport(Template):
                         if any(True for x in fn if x not in allowed_filename_chars_set):
                             reporter.add_report(Glep31Violation(pkg, pjoin(cwd, fn)))
 
+        files = [
+            f for size_files in files_by_size.values()
+            if len(size_files) > 1 for f in size_files]
+        digests = self.digests.digest_files(
+            ((pjoin(base, f), snapshot.entries[f]) for f in files), self.executor)
         files_by_digest = defaultdict(list)
-        for size, files in files_by_size.items():
-            if len(files) > 1:
-                for f in files:
-                    digest = get_chksums(pjoin(base, f), self.digest_algo)[0]
-                    files_by_digest[digest].append(f)
+        for f in files:
+            files_by_digest[digests[pjoin(base, f)]].append(f)
 
         for digest, files in files_by_digest.items():
             if len(files) > 1:
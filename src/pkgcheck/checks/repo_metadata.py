@@ -733,7 +733,7 @@ class RepoProfilesReport(base.Template):
     def __init__(self, options, profile_filters):
         super().__init__(options)
         self.arches = options.target_repo.known_arches
-        self.profiles = iter(options.target_repo.config.arch_profiles.values())
+        self.profiles = tuple(options.target_repo.config.arch_profiles.values())
         self.repo = options.target_repo
         self.profiles_dir = pjoin(self.repo.location, 'profiles')
         self.non_profile_dirs = profile_filters.non_profile_dirs
@@ -941,9 +941,9 @@ class GlobalUSECheck(base.Template):
             flag: desc for matcher, (flag, desc) in options.target_repo.config.use_desc}
         self.use_expand = {
             flag: desc for matcher, (flag, desc) in options.target_repo.config.use_expand_desc}
-        self.global_flag_usage = defaultdict(set)
 
     def start(self, reporter):
+        self.global_flag_usage = defaultdict(set)
         master_flags = self.unused_master_flags = set()
         for repo in self.options.target_repo.masters:
             master_flags.update(flag for matcher, (flag, desc) in repo.config.use_desc)
@@ -959,12 +959,13 @@ class GlobalUSECheck(base.Template):
         local_use = set(pkgs[0].local_use.keys())
         for pkg in pkgs:
             pkg_global_use = pkg.iuse_stripped.difference(local_use)
+            # only store package keys so package objects can be freed
             for flag in pkg_global_use:
-                self.global_flag_usage[flag].add(pkg.unversioned_atom)
+                self.global_flag_usage[flag].add(pkg.key)
 
             # report flags used in the pkg but not in any pkg from the master repo(s)
             if self.unused_master_flags:
-                flags = self.unused_master_flags.intersection(non_local_use)
+                flags = self.unused_master_flags.intersection(pkg_global_use)
                 if flags:
                     reporter.add_report(UnusedInMastersGlobalUSE(pkg, flags))
 
@@ -29,6 +29,7 @@ class UnstableOnlyReport(base.Template):
     """Scan for packages that have just unstable keywords."""
 
     feed_type = base.package_feed
+    cacheable = True
     required_addons = (addons.StableArchesAddon,)
     known_results = (UnstableOnly,)
 
@@ -64,6 +65,3 @@ class UnstableOnlyReport(base.Template):
         # collapse reports by available versions
         for pkgs in unstable_arches.keys():
             reporter.add_report(UnstableOnly(pkgs, unstable_arches[pkgs]))
-
-    def finish(self, reporter):
-        self.arch_restricts.clear()
@@ -1,12 +1,20 @@
+from collections import deque
+from itertools import chain
+
 from pkgcore.ebuild.atom import atom
 from pkgcore.restrictions.packages import OrRestriction
 
 from snakeoil import klass
-from snakeoil.iterables import caching_iter
-from snakeoil.sequences import stable_unique, iflatten_instance, iflatten_func
+from snakeoil.demandload import demandload
+from snakeoil.sequences import stable_unique, iflatten_instance
 from snakeoil.strings import pluralism as _pl
 
-from .. import base, addons
+from .. import base, addons, errors, reporters
+
+demandload(
+    'multiprocessing',
+    'traceback',
+)
 
 
 class FakeConfigurable(object):
@@ -15,22 +23,18 @@ class FakeConfigurable(object):
     configurable = True
     __slots__ = ('use', 'iuse', '_forced_use', '_masked_use', '_pkg_use', '_raw_pkg', '_profile')
 
-    def __init__(self, pkg, profile):
+    def __init__(self, pkg, profile, use_state=None):
         object.__setattr__(self, '_raw_pkg', pkg)
         object.__setattr__(self, '_profile', profile)
 
-        object.__setattr__(
-            self, '_forced_use', self._profile.forced_use.pull_data(self._raw_pkg))
-        object.__setattr__(
-            self, '_masked_use', self._profile.masked_use.pull_data(self._raw_pkg))
-        object.__setattr__(
-            self, '_pkg_use', self._profile.pkg_use.pull_data(self._raw_pkg))
-        use_defaults = set(x[1:] for x in pkg.iuse if x[0] == '+')
-        enabled_use = (use_defaults | profile.use | self._pkg_use | self._forced_use) - self._masked_use
-        object.__setattr__(
-            self, 'use', frozenset(enabled_use & (profile.iuse_effective | pkg.iuse_effective)))
-        object.__setattr__(
-            self, 'iuse', frozenset(profile.iuse_effective.union(pkg.iuse_stripped)))
+        if use_state is None:
+            use_state = addons.UseStateAddon.use_state(pkg, profile)
+        forced_use, masked_use, pkg_use, use, iuse = use_state
+        object.__setattr__(self, '_forced_use', forced_use)
+        object.__setattr__(self, '_masked_use', masked_use)
+        object.__setattr__(self, '_pkg_use', pkg_use)
+        object.__setattr__(self, 'use', use)
+        object.__setattr__(self, 'iuse', iuse)
 
     def request_enable(self, attr, *vals):
         if attr != 'use':
@@ -67,26 +71,17 @@ class FakeConfigurable(object):
     def __setattr__(self, attr, val):
         raise AttributeError(self, 'is immutable')
 
-class _BlockMemoryExhaustion(Exception):
-    pass
-
 
-# This is fast path code, hence the seperated implementations.
-if getattr(atom, '_TRANSITIVE_USE_ATOM_BUG_IS_FIXED', False):
-    def _eapi2_flatten(val, atom_kls=atom, transitive_use_atom=atom._transitive_use_atom):
-        return isinstance(val, atom_kls) and not isinstance(val, transitive_use_atom)
-else:
-    def _eapi2_flatten(val, atom_kls=atom, transitive_use_atom=atom._transitive_use_atom):
-        if isinstance(val, transitive_use_atom):
-            if len([x for x in val.use if x.endswith("?")]) > 16:
-                raise _BlockMemoryExhaustion(val)
-        return isinstance(val, atom_kls) and not isinstance(val, transitive_use_atom)
 
+def visit_atoms(stream):
+    """Iterate over the atoms in a depset.
 
-def visit_atoms(pkg, stream):
-    if not pkg.eapi.options.transitive_use_atoms:
-        return iflatten_instance(stream, atom)
-    return iflatten_func(stream, _eapi2_flatten)
+    Transitive USE atoms are treated as leaves instead of being expanded into
+    their conditional forms, which grows exponentially with the number of
+    conditional flags. They're collapsed to regular atoms for each profile's
+    USE state when the depset is evaluated.
+    """
+    return iflatten_instance(stream, atom)
 
 
 def strip_atom_use(inst):
@@ -143,7 +138,11 @@ class NonExistentDeps(base.Warning):
 
 
 class UncheckableDep(base.Warning):
-    """Given dependency cannot be checked due to the number of transitive use deps in it."""
+    """Given dependency cannot be checked due to the number of transitive use deps in it.
+
+    No longer generated since transitive use deps are handled for any number
+    of flags, kept for compatibility with existing result filters.
+    """
 
     __slots__ = ("category", "package", "version", "attr")
 
@@ -193,67 +192,204 @@ class VisibilityReport(base.Template):
     feed_type = base.versioned_feed
     required_addons = (
         addons.QueryCacheAddon, addons.ProfileAddon,
-        addons.EvaluateDepSetAddon)
+        addons.EvaluateDepSetAddon, addons.RepoIndexAddon, addons.UseStateAddon)
     known_results = (VisibleVcsPkg, NonExistentDeps, NonsolvableDeps)
 
-    def __init__(self, options, query_cache, profiles, depset_cache):
+    attrs = ("bdepend", "depend", "rdepend", "pdepend")
+
+    # maximum number of packages sent to workers before waiting on results
+    pipeline_depth = 16
+
+    @staticmethod
+    def mangle_argparser(parser):
+        parser.plugin.add_argument(
+            '--visibility-jobs', type=int, default=1, metavar='JOBS',
+            help='number of processes checking dependency visibility across profiles',
+            docs="""
+                Number of worker processes used to solve dependencies across
+                profiles, each handling a subset of the profiles with the
+                stable and unstable variants of a profile handled by the same
+                worker. Workers are only used when packages are scanned in a
+                single process, i.e. when not using --jobs.
+            """)
+
+    @staticmethod
+    def check_args(parser, namespace):
+        if namespace.visibility_jobs < 1:
+            parser.error(f'invalid number of visibility jobs: {namespace.visibility_jobs}')
+
+    def __init__(self, options, query_cache, profiles, depset_cache, repo_index, use_states):
         super().__init__(options)
         self.query_cache = query_cache.query_cache
         self.depset_cache = depset_cache
         self.profiles = profiles
+        self.repo_index = repo_index
+        self.use_states = use_states
+        self.query_visibility = query_cache.query_visibility
+        self.workers = []
+        self.profile_order = None
+        # packages sent to workers along with the results found for them in
+        # the main process, waiting for the worker results
+        self.pending = deque()
+
+    def shards(self, jobs):
+        """Split the profiles into bitsets for a given number of workers.
+
+        The stable and unstable variants of a profile are kept in the same
+        shard since their solution caches are interlinked.
+        """
+        names = list(stable_unique(x.name for x in self.profiles))
+        masks = [0] * min(jobs, len(names))
+        for x in self.profiles:
+            masks[names.index(x.name) % len(masks)] |= x.bit
+        return masks
+
+    def start(self, reporter):
+        jobs = getattr(self.options, 'visibility_jobs', 1)
+        # packages are already split across processes when using --jobs
+        if jobs < 2 or getattr(self.options, 'jobs', 1) > 1:
+            return
+        masks = self.shards(jobs)
+        if len(masks) < 2:
+            return
+        # workers are forked so they inherit the warm caches and split up the
+        # profiles by their bits
+        self.profile_order = {(x.key, x.name): x.bit for x in self.profiles}
+        ctx = multiprocessing.get_context('fork')
+        for mask in masks:
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=self._worker, args=(child_conn, mask), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.workers.append((proc, conn))
+
+    def finish(self, reporter):
+        try:
+            while self.pending:
+                self._report_pending(reporter)
+        except BaseException:
+            # workers may be blocked sending results that won't be read
+            for proc, conn in self.workers:
+                proc.terminate()
+            raise
+        else:
+            for proc, conn in self.workers:
+                conn.send(None)
+        finally:
+            for proc, conn in self.workers:
+                conn.close()
+                proc.join()
+            self.workers = []
+            self.pending.clear()
+
+    def _worker(self, conn, mask):
+        """Solve the depsets of packages sent by the main process for a subset of profiles."""
+        null_reporter = reporters.NullReporter()
+        try:
+            for cpvstr, repo_id in iter(conn.recv, None):
+                pkg = next(
+                    x for x in self.repo_index.itermatch(atom(f'={cpvstr}'))
+                    if x.repo.repo_id == repo_id)
+                # results for missing deps are reported by the main process
+                self.depset_cache.feed(pkg, null_reporter)
+                self.query_depsets(pkg, null_reporter)
+                collector = reporters.CollectingReporter()
+                self.check_depsets(pkg, collector, mask)
+                conn.send(collector.results)
+        except Exception:
+            conn.send(errors.WorkerError(traceback.format_exc()))
+        conn.close()
+
+    def _send(self, conn, item):
+        """Send a package to a worker, raising its error if it failed."""
+        try:
+            conn.send(item)
+        except OSError:
+            # pull the error the worker sent before exiting
+            while True:
+                self._recv(conn)
+
+    def _recv(self, conn):
+        """Receive the results for a package from a worker."""
+        try:
+            results = conn.recv()
+        except EOFError:
+            raise errors.WorkerError('visibility worker died unexpectedly')
+        if isinstance(results, errors.WorkerError):
+            raise results
+        return results
+
+    def _report_pending(self, reporter):
+        """Report the results of the oldest package sent to the workers."""
+        main_results = self.pending.popleft()
+        results = chain.from_iterable(self._recv(conn) for proc, conn in self.workers)
+        for result in main_results:
+            reporter.add_report(result)
+        # merge worker results in a deterministic order
+        for result in sorted(results, key=lambda r: (
+                self.attrs.index(r.attr), self.profile_order[(r.keyword, r.profile)])):
+            reporter.add_report(result)
 
     def feed(self, pkg, reporter):
-        # query_cache gets caching_iter partial repo searches shoved into it-
-        # reason is simple, it's likely that versions of this pkg probably
-        # use similar deps- so we're forcing those packages that were
-        # accessed for atom matching to remain in memory.
-        # end result is less going to disk
-
+        if not self.workers:
+            if pkg.live:
+                # vcs ebuild that better not be visible
+                self.check_visibility_vcs(pkg, reporter)
+            self.query_depsets(pkg, reporter)
+            self.check_depsets(pkg, reporter)
+            return
+
+        # keep several packages in flight so workers don't idle while the
+        # main process handles the results of the previous one
+        for proc, conn in self.workers:
+            self._send(conn, (pkg.cpvstr, pkg.repo.repo_id))
+        collector = reporters.CollectingReporter()
         if pkg.live:
-            # vcs ebuild that better not be visible
-            self.check_visibility_vcs(pkg, reporter)
+            self.check_visibility_vcs(pkg, collector)
+        self.query_depsets(pkg, collector)
+        self.pending.append(collector.results)
+        while len(self.pending) > self.pipeline_depth:
+            self._report_pending(reporter)
+
+    def query_depsets(self, pkg, reporter):
+        """Prime the query cache with the matches for a package's dependencies."""
+        # query_cache gets the matches for atoms shoved into it- reason is
+        # simple, it's likely that versions of this pkg probably use similar
+        # deps- so we're forcing those packages that were accessed for atom
+        # matching to remain in memory.
+        # end result is less going to disk
 
-        suppressed_depsets = []
-        for attr in ("bdepend", "depend", "rdepend", "pdepend"):
+        for attr in self.attrs:
             nonexistent = set()
-            try:
-                for orig_node in visit_atoms(pkg, getattr(pkg, attr)):
-
-                    node = strip_atom_use(orig_node)
-                    if node not in self.query_cache:
-                        if node in self.profiles.global_insoluble:
-                            nonexistent.add(node)
-                            # insert an empty tuple, so that tight loops further
-                            # on don't have to use the slower get method
-                            self.query_cache[node] = ()
-
-                        else:
-                            matches = caching_iter(
-                                self.options.search_repo.itermatch(node))
-                            if matches:
-                                self.query_cache[node] = matches
-                                if orig_node is not node:
-                                    self.query_cache[str(orig_node)] = matches
-                            elif not node.blocks:
-                                nonexistent.add(node)
-                                self.query_cache[node] = ()
-                                self.profiles.global_insoluble.add(node)
-                    elif not self.query_cache[node]:
+            for orig_node in visit_atoms(getattr(pkg, attr)):
+                node = strip_atom_use(orig_node)
+                if node not in self.query_cache:
+                    if node in self.profiles.global_insoluble:
+                        nonexistent.add(node)
+                        # insert an empty tuple, so that tight loops further
+                        # on don't have to use the slower get method
+                        self.query_cache[node] = ()
+                    elif not self.matches(node) and not node.blocks:
                         nonexistent.add(node)
+                        self.profiles.global_insoluble.add(node)
+                elif not self.query_cache[node] and not node.blocks:
+                    nonexistent.add(node)
 
-            except _BlockMemoryExhaustion as e:
-                reporter.add_report(UncheckableDep(pkg, attr))
-                suppressed_depsets.append(attr)
             if nonexistent:
                 reporter.add_report(NonExistentDeps(pkg, attr, nonexistent))
 
-        del nonexistent
+    def check_depsets(self, pkg, reporter, mask=None):
+        """Check that a package's depsets are solvable.
 
-        for attr in ("bdepend", "depend", "rdepend", "pdepend"):
-            if attr in suppressed_depsets:
-                continue
+        :param mask: bitset of the profiles to check, defaults to all
+        """
+        for attr in self.attrs:
             for edepset, profiles in self.depset_cache.collapse_evaluate_depset(
                     pkg, attr, getattr(pkg, attr)):
+                if mask is not None:
+                    profiles = [x for x in profiles if x.bit & mask]
+                    if not profiles:
+                        continue
                 self.process_depset(pkg, attr, edepset, profiles, reporter)
 
     def check_visibility_vcs(self, pkg, reporter):
@@ -285,8 +421,33 @@ class VisibilityReport(base.Template):
         object.__setattr__(a, 'use', frozenset(use_map[x] for x in use))
         return a
 
+    def matches(self, node):
+        """Return the matches for an atom, querying the repo if they aren't cached.
+
+        Queries are cached as the positions of the matching versions in the
+        repo index so they don't keep package objects alive. They may be
+        missing from the cache if they were evicted since it was primed or
+        were never primed, e.g. for old style virtuals.
+        """
+        versions = self.repo_index.versions(node.key)
+        positions = self.query_cache.get(node)
+        if positions is None:
+            positions = self.query_cache[node] = tuple(
+                i for i, pkg in enumerate(versions) if node.match(pkg))
+        return [versions[i] for i in positions]
+
+    def visibility(self, node, pkgs):
+        """Return a bitset of the profiles any of the given packages are visible in."""
+        bits = self.query_visibility.get(node)
+        if bits is None:
+            bits = 0
+            for pkg in pkgs:
+                bits |= self.profiles.visibility(pkg)
+            self.query_visibility[node] = bits
+        return bits
+
     def process_depset(self, pkg, attr, depset, profiles, reporter):
-        get_cached_query = self.query_cache.get
+        get_use_state = self.use_states.get
 
         csolutions = []
         blockers = []
@@ -321,14 +482,17 @@ class VisibilityReport(base.Template):
                         if node in insoluble:
                             pass
 
-                        # get is required since there is an intermix between old style
-                        # virtuals and new style- thus the cache priming doesn't get
-                        # all of it.
-                        src = get_cached_query(strip_atom_use(node), ())
-                        if node.use:
-                            src = (FakeConfigurable(pkg, profile) for pkg in src)
-                            src = (pkg for pkg in src if node.force_True(pkg))
-                        if any(True for pkg in src if visible(pkg)):
+                        src = self.matches(strip_atom_use(node))
+                        if node.use or blockers:
+                            if node.use:
+                                src = (FakeConfigurable(pkg, profile, get_use_state(pkg, profile))
+                                       for pkg in src)
+                                src = (pkg for pkg in src if node.force_True(pkg))
+                            found = any(True for pkg in src if visible(pkg))
+                        else:
+                            # plain atoms only depend on profile visibility
+                            found = self.visibility(node, src) & profile.bit
+                        if found:
                             cache.add(node)
                             break
                         else:
@@ -1,9 +1,6 @@
-from snakeoil.demandload import demand_compile_regexp
 from snakeoil.strings import pluralism as _pl
 
-from .. import base
-
-demand_compile_regexp('indent_regexp', '^\t* \t+')
+from .. import addons, base
 
 
 class base_whitespace(base.Warning):
@@ -95,31 +92,34 @@ class WhitespaceCheck(base.Template):
     """Scan ebuild for useless whitespace."""
 
     feed_type = base.ebuild_feed
+    cacheable = True
+    required_addons = (addons.LineScannerAddon,)
     known_results = (
         WhitespaceFound, WrongIndentFound, DoubleEmptyLine,
         TrailingEmptyLine, NoFinalNewline)
 
+    def __init__(self, options, scanner):
+        super().__init__(options)
+        self.scanner = scanner
+        self.trailing_pattern = self.scanner.register(r'[ \t]$')
+        self.leading_pattern = self.scanner.register(r'^ ')
+        self.indent_pattern = self.scanner.register(r'^\t* \t+')
+        self.empty_pattern = self.scanner.register(r'^\n')
+
     def feed(self, entry, reporter):
         pkg, lines = entry
-        lastlineempty = False
-        trailing = []
-        leading = []
-        indent = []
-        double_empty = []
-
-        for lineno, line in enumerate(lines):
-            if line != '\n':
-                lastlineempty = False
-                if line[-2:-1] == ' ' or line[-2:-1] == '\t':
-                    trailing.append(lineno + 1)
-                elif line[0] == ' ':
-                    leading.append(lineno + 1)
-                if indent_regexp.match(line):
-                    indent.append(lineno + 1)
-            elif lastlineempty:
-                double_empty.append(lineno + 1)
-            else:
-                lastlineempty = True
+        results = self.scanner.scan(entry)
+
+        trailing = [lineno for lineno, _ in results[self.trailing_pattern]]
+        # lines with trailing whitespace aren't flagged for leading whitespace
+        leading = sorted(
+            set(lineno for lineno, _ in results[self.leading_pattern]).difference(trailing))
+        indent = [lineno for lineno, _ in results[self.indent_pattern]]
+        empty = [lineno for lineno, _ in results[self.empty_pattern]]
+        # empty lines directly following another empty line
+        double_empty = [y for x, y in zip(empty, empty[1:]) if y == x + 1]
+        lastlineempty = bool(empty) and empty[-1] == len(lines)
+
         if trailing:
             reporter.add_report(
                 WhitespaceFound(pkg, "trailing", trailing))
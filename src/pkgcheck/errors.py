@@ -3,3 +3,7 @@
 
 class ReporterInitError(Exception):
     """Raise this if a reporter factory fails."""
+
+
+class WorkerError(Exception):
+    """Raise this if a worker process fails, passing on its traceback."""
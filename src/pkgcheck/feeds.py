@@ -1,14 +1,136 @@
 """Feed classes: pass groups of packages to other addons."""
 
+from bisect import bisect_right
+from collections.abc import Sequence
+from functools import lru_cache
 from operator import attrgetter
 
-from pkgcore.restrictions import util
+from pkgcore.restrictions import packages, util
+from pkgcore.restrictions.values import StrExactMatch
+
+from snakeoil.demandload import demandload
 
 from . import base
 
+demandload(
+    'mmap',
+    'os',
+    're',
+)
+
+
+@lru_cache(maxsize=1024)
+def _read_text(path, encoding, mtime, size):
+    if not size:
+        # empty files can't be mapped
+        return '', None
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        try:
+            return str(m, encoding), None
+        except UnicodeDecodeError as e:
+            return None, e
+
+
+def read_text(path, encoding='utf8'):
+    """Read and decode a file, sharing the content across consumers.
+
+    Decoded files are cached keyed by their path, modification time, and
+    size so ebuilds are only read once per scan even if they're used by
+    multiple feeds and checks.
+
+    :raises UnicodeDecodeError: file can't be decoded with the encoding
+    """
+    st = os.stat(path)
+    text, err = _read_text(path, encoding, st.st_mtime_ns, st.st_size)
+    if err is not None:
+        raise err.with_traceback(None)
+    return text
+
+
+class EbuildText(Sequence):
+    """Read-only sequence of the lines of an ebuild.
+
+    The file is decoded as a whole on first access via :func:`read_text`,
+    lines are only sliced out of the text when requested. Line start offsets
+    are similarly computed on demand. Newlines are translated in the same
+    manner as for text file objects so the lines match those read from
+    :meth:`text_fileobj`.
+
+    :param source: data source of the ebuild, e.g. ``pkg.ebuild``
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._text = None
+        self._offsets = None
+
+    @property
+    def text(self):
+        """Decoded text of the entire ebuild."""
+        if self._text is None:
+            path = getattr(self.source, 'path', None)
+            if path is None:
+                with self.source.text_fileobj() as f:
+                    text = f.read()
+            else:
+                encoding = getattr(self.source, 'encoding', None) or 'utf8'
+                text = read_text(path, encoding)
+                if '\r' in text:
+                    text = text.replace('\r\n', '\n').replace('\r', '\n')
+            self._text = text
+        return self._text
+
+    @property
+    def offsets(self):
+        """Offsets of the start of each line in the text."""
+        if self._offsets is None:
+            text = self.text
+            offsets = [0]
+            offsets.extend(m.end() for m in re.finditer('\n', text))
+            if offsets[-1] == len(text):
+                offsets.pop()
+            self._offsets = offsets
+        return self._offsets
+
+    def lineno(self, offset):
+        """Return the 1-based line number for a given text offset."""
+        return bisect_right(self.offsets, offset)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offsets = self.offsets
+        if index < 0:
+            index += len(offsets)
+            if index < 0:
+                raise IndexError('line index out of range')
+        start = offsets[index]
+        end = offsets[index + 1] if index + 1 < len(offsets) else None
+        return self.text[start:end]
+
+    def __iter__(self):
+        text = self.text
+        start = 0
+        end = len(text)
+        while start < end:
+            pos = text.find('\n', start, end)
+            stop = end if pos == -1 else pos + 1
+            yield text[start:stop]
+            start = stop
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.source!r}>'
+
 
 class VersionToEbuild(base.Transform):
-    """Convert from just a package to a (package, list_of_lines) tuple."""
+    """Convert from just a package to a (package, list_of_lines) tuple.
+
+    The lines are passed as a lazy :class:`EbuildText` sequence.
+    """
 
     source = base.versioned_feed
     dest = base.ebuild_feed
@@ -16,7 +138,7 @@ class VersionToEbuild(base.Transform):
     cost = 20
 
     def feed(self, pkg, reporter):
-        self.child.feed((pkg, tuple(pkg.ebuild.text_fileobj())), reporter)
+        self.child.feed((pkg, EbuildText(pkg.ebuild)), reporter)
 
 
 class EbuildToVersion(base.Transform):
@@ -57,13 +179,17 @@ class _Collapse(base.Transform):
             self.chunk = [pkg]
             self.key = key
 
-    def finish(self, reporter):
+    def flush(self, reporter):
         # Deal with empty runs.
         if self.chunk is not None:
             self.child.feed(tuple(self.chunk), reporter)
-        base.Transform.finish(self, reporter)
         self.chunk = None
         self.key = None
+        base.Transform.flush(self, reporter)
+
+    def finish(self, reporter):
+        self.flush(reporter)
+        base.Transform.finish(self, reporter)
 
 
 class VersionToPackage(_Collapse):
@@ -87,18 +213,15 @@ class VersionToCategory(_Collapse):
 
 
 class _PackageOrCategoryToRepo(base.Transform):
+    """Stream package or category chunks to repository feed consumers.
 
-    def start(self, reporter):
-        base.Transform.start(self, reporter)
-        self.repo = []
+    Chunks are passed on as they come in instead of collecting the entire
+    repo in memory, repository feed checks are expected to keep whatever
+    they need from them and do their real work when finished.
+    """
 
     def feed(self, item, reporter):
-        self.repo.append(item)
-
-    def finish(self, reporter):
-        self.child.feed(self.repo, reporter)
-        base.Transform.finish(self, reporter)
-        self.repo = None
+        self.child.feed(item, reporter)
 
 
 class PackageToRepo(_PackageOrCategoryToRepo):
@@ -139,12 +262,16 @@ class PackageToCategory(base.Transform):
             self.chunk = list(item)
             self.category = category
 
-    def finish(self, reporter):
+    def flush(self, reporter):
         if self.chunk is not None:
             self.child.feed(tuple(self.chunk), reporter)
-        base.Transform.finish(self, reporter)
         self.category = None
         self.chunk = None
+        base.Transform.flush(self, reporter)
+
+    def finish(self, reporter):
+        self.flush(reporter)
+        base.Transform.finish(self, reporter)
 
 
 class RestrictedRepoSource(object):
@@ -165,3 +292,97 @@ class RestrictedRepoSource(object):
 
     def feed(self):
         return self.repo.itermatch(self.limiter, sorter=sorted)
+
+
+class PackageChunkSource(RestrictedRepoSource):
+    """Restricted repo source limited to a given sequence of packages.
+
+    Used to split up scanning a restriction by package, e.g. across multiple
+    processes. The scope is still determined by the original restriction so
+    the same pipelines are plugged together.
+
+    :param keys: sorted sequence of (category, package) tuples
+    """
+
+    def __init__(self, repo, limiter, keys):
+        super().__init__(repo, limiter)
+        self.keys = keys
+
+    def feed(self):
+        for category, package in self.keys:
+            restrict = packages.AndRestriction(
+                packages.PackageRestriction('category', StrExactMatch(category)),
+                packages.PackageRestriction('package', StrExactMatch(package)),
+                self.limiter)
+            yield from self.repo.itermatch(restrict, sorter=sorted)
+
+
+class BatchedRepoSource(RestrictedRepoSource):
+    """Restricted repo source combining the restrictions of multiple targets.
+
+    All targets are scanned in a single pass over the repo while tracking
+    which target matched each package so results can be split up per target
+    afterwards. Packages matching multiple targets are only assigned to the
+    first one.
+
+    :param limiters: sequence of target restrictions sharing the same scope
+    """
+
+    def __init__(self, repo, limiters):
+        super().__init__(repo, packages.OrRestriction(*limiters))
+        self.limiters = tuple(limiters)
+        self._targets = {}
+
+    def feed(self):
+        targets = {}
+        for pkg in super().feed():
+            self._map_target(targets, pkg)
+            yield pkg
+        self._targets = targets
+
+    def _map_target(self, targets, pkg):
+        for i, limiter in enumerate(self.limiters):
+            if limiter.match(pkg):
+                targets.setdefault((pkg.category,), i)
+                targets.setdefault((pkg.category, pkg.package), i)
+                targets.setdefault((pkg.category, pkg.package, pkg.fullver), i)
+                break
+
+    def split(self, results):
+        """Split results up by the targets they were generated for.
+
+        Targets are mapped while the source is fed so it must have been
+        iterated over in the current process. Version results for versions
+        that weren't fed, e.g. due to bad metadata, use the target of their
+        package while results not matching any target are dropped.
+
+        :return: list of result lists, one per target
+        """
+        buckets = [[] for x in self.limiters]
+        for result in results:
+            if result.threshold in (base.versioned_feed, base.ebuild_feed):
+                keys = (
+                    (result.category, result.package, result.version),
+                    (result.category, result.package))
+            elif result.threshold == base.package_feed:
+                keys = ((result.category, result.package),)
+            elif result.threshold == base.category_feed:
+                keys = ((result.category,),)
+            else:
+                keys = ()
+            for key in keys:
+                target = self._targets.get(key)
+                if target is not None:
+                    buckets[target].append(result)
+                    break
+        return buckets
+
+
+def package_keys(pkgs):
+    """Return the (category, package) keys for a sorted stream of packages."""
+    keys = []
+    for pkg in pkgs:
+        key = (pkg.category, pkg.package)
+        if not keys or keys[-1] != key:
+            keys.append(key)
+    return keys
@@ -106,6 +106,21 @@ class NullReporter(base.Reporter):
         pass
 
 
+class CollectingReporter(base.Reporter):
+    """Collect results in memory for later processing.
+
+    Used internally to pass results between processes, by default keyword
+    filtering is left to the reporter that finally outputs the results.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.results = []
+
+    def process_report(self, result):
+        self.results.append(result)
+
+
 class JsonReporter(base.Reporter):
     """Dump a json feed of reports.
 
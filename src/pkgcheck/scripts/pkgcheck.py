@@ -6,8 +6,13 @@ from portage.
 """
 
 import argparse
-from itertools import chain
+from collections import defaultdict
+from itertools import chain, groupby
+from operator import attrgetter
 
+from pkgcore.ebuild.atom import atom
+from pkgcore.ebuild.errors import MalformedAtom
+from pkgcore.package.errors import MetadataException
 from pkgcore.plugin import get_plugins, get_plugin
 from pkgcore.util import commandline, parserestrict
 from snakeoil.cli import arghparse
@@ -16,19 +21,26 @@ from snakeoil.formatters import decorate_forced_wrapping
 from snakeoil.sequences import unstable_unique
 from snakeoil.strings import pluralism as _pl
 
-from .. import plugins, base, feeds
+from .. import plugins, base, cache, feeds, reporters
 
 demandload(
+    'json',
     'logging',
+    'multiprocessing',
     'os',
+    'queue',
+    'socket',
+    'socketserver',
+    'subprocess',
     'sys',
     'textwrap',
-    'pkgcore.ebuild:repository',
+    'traceback',
+    'pkgcore.ebuild:repository,restricts',
     'pkgcore.restrictions:packages',
     'pkgcore.restrictions.values:StrExactMatch',
     'pkgcore.repository:multiplex',
     'snakeoil:pickling,formatters',
-    'snakeoil.osutils:abspath',
+    'snakeoil.osutils:abspath,pjoin',
     'snakeoil.sequences:iflatten_instance',
     'pkgcheck:errors',
 )
@@ -57,6 +69,74 @@ main_options.add_argument(
         Enable all package filtering mechanisms such as ACCEPT_KEYWORDS,
         ACCEPT_LICENSE, and package.mask.
     """)
+main_options.add_argument(
+    '-j', '--jobs', type=int, default=1,
+    help='number of processes to run checks in',
+    docs="""
+        Number of worker processes to use for scanning, defaults to 1 meaning
+        all checks are run serially in the main process.
+
+        When greater than 1, version and package level checks are run in
+        separate processes across disjoint chunks of packages while category
+        and repository level checks are run in the main process against the
+        full stream of packages. Results are reported in the same order as a
+        serial run.
+    """)
+main_options.add_argument(
+    '--commits', metavar='REF', nargs='?', const='origin',
+    help='scan packages affected by changes since a git ref',
+    docs="""
+        Determine the packages to scan from changes in the target repo's git
+        tree compared to the given ref (defaults to 'origin') instead of
+        using target arguments. All changed packages are scanned together
+        using a single combined restriction.
+
+        In addition, packages inheriting changed eclasses are scanned as well
+        as reverse dependencies of packages referenced by changed profile
+        files or removed from the repo, so visibility issues caused by those
+        changes get caught. Untracked files that aren't ignored by git are
+        treated as newly added.
+    """)
+main_options.add_argument(
+    '--results-cache', action='store_true', default=False,
+    help='reuse results from previous runs for unchanged packages',
+    docs="""
+        Store the results of package level checks that only depend on the
+        content of the package being checked in a cache, replaying them for
+        packages that haven't changed since the previous run.
+
+        The cache is located in the pkgcheck user cache directory and is
+        invalidated when the pkgcheck version, the enabled checks, selected
+        profiles or arches, or repo-wide files such as profiles change.
+    """)
+main_options.add_argument(
+    '--batch-targets', action='store_true', default=False,
+    help='scan targets of the same scope in a single pass',
+    docs="""
+        Combine all targets sharing the same scope, e.g. package atoms, into
+        a single restriction so checks are only started and finished once
+        and the repo is only iterated over once instead of once per target.
+        Repo level targets are still scanned separately.
+
+        Results are still reported per target in the order the targets were
+        given, with each package only being reported for the first target it
+        matched. Note that all targets are read before scanning starts when
+        enabled, including targets passed on stdin.
+    """)
+main_options.add_argument(
+    '--profile-checks', metavar='FORMAT', nargs='?', const='table',
+    choices=('table', 'json'),
+    help='output timing data for checks and transforms',
+    docs="""
+        Record the cumulative time spent in each check and transform class
+        while scanning along with the number of feed calls and items fed,
+        outputting the data to stderr when finished.
+
+        Time spent in a transform only covers the transform itself, not the
+        checks it feeds. The data is output as a table sorted by total time
+        by default, use 'json' as the format to output a JSON document
+        instead.
+    """)
 main_options.add_argument(
     '-s', '--suite', action=commandline.StoreConfigObject,
     config_type='pkgcheck_suite',
@@ -139,6 +219,141 @@ _known_keywords = tuple(sorted(
     key=lambda x: x.__name__))
 
 
+def _target_restrict(repo, target):
+    """Convert a target argument into a restriction.
+
+    :raises ValueError: if the target isn't a valid atom or repo path
+    """
+    try:
+        return parserestrict.parse_match(target)
+    except parserestrict.ParseError as e:
+        if os.path.exists(target):
+            return repo.path_restrict(target)
+        raise ValueError(str(e))
+
+
+def _git(parser, repo, *args):
+    """Return the output lines of a git command run in the repo."""
+    try:
+        p = subprocess.run(
+            ['git', *args], cwd=repo.location,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            encoding='utf8', check=True)
+    except FileNotFoundError:
+        parser.error('--commits requires git to be installed')
+    except subprocess.CalledProcessError as e:
+        parser.error(f'failed running git {args[0]}: {e.stderr.strip()}')
+    return p.stdout.splitlines()
+
+
+def _changed_paths(paths, categories):
+    """Sort changed repo paths into the packages and eclasses they belong to.
+
+    :return: tuple of the set of changed (category, package) keys, the set of
+        changed eclass names, and whether any profiles files changed
+    """
+    pkgs = set()
+    eclasses = set()
+    profiles_changed = False
+    for path in paths:
+        path_components = path.split('/')
+        if len(path_components) > 2 and path_components[0] in categories:
+            pkgs.add(tuple(path_components[:2]))
+        elif path_components[0] == 'eclass' and path.endswith('.eclass'):
+            eclasses.add(os.path.splitext(path_components[-1])[0])
+        elif path_components[0] == 'profiles':
+            profiles_changed = True
+    return pkgs, eclasses, profiles_changed
+
+
+def _profile_keys(lines):
+    """Return the package keys referenced by changed lines of a unified diff."""
+    keys = set()
+    for line in lines:
+        if line.startswith(('+++', '---')) or not line.startswith(('+', '-')):
+            continue
+        tokens = line[1:].split('#', 1)[0].split()
+        if tokens:
+            try:
+                keys.add(atom(tokens[0].lstrip('-')).key)
+            except MalformedAtom:
+                continue
+    return keys
+
+
+def _revdep_packages(repo, eclasses, revdep_keys, skip=()):
+    """Return the keys of packages affected by changed eclasses or packages.
+
+    :param eclasses: names of changed eclasses
+    :param revdep_keys: keys of packages with changed visibility
+    :param skip: package keys that don't need to be checked
+    """
+    pkgs = set()
+    for pkg in repo:
+        key = (pkg.category, pkg.package)
+        if key in pkgs or key in skip:
+            continue
+        try:
+            if not eclasses.isdisjoint(pkg.inherited):
+                pkgs.add(key)
+            elif revdep_keys and any(
+                    x.key in revdep_keys for x in iflatten_instance(
+                        (pkg.bdepend, pkg.depend, pkg.rdepend, pkg.pdepend), atom)):
+                pkgs.add(key)
+        except MetadataException:
+            # broken packages get flagged when scanned directly
+            continue
+    return pkgs
+
+
+def _commits_limiters(parser, repo, ref):
+    """Determine restrictions for packages affected by changes since a git ref.
+
+    Untracked files that aren't ignored are treated as newly added.
+    """
+    untracked = _git(parser, repo, 'ls-files', '--others', '--exclude-standard')
+    pkgs, eclasses, profiles_changed = _changed_paths(
+        chain(_git(parser, repo, 'diff', '--name-only', '--no-renames', ref), untracked),
+        repo.categories)
+
+    # Packages with changed visibility, either referenced by altered lines in
+    # profile files (e.g. package.mask) or removed from the repo.
+    revdep_keys = set()
+    if profiles_changed:
+        lines = _git(parser, repo, 'diff', '--unified=0', ref, '--', 'profiles')
+        for path in untracked:
+            if path.startswith('profiles/'):
+                try:
+                    with open(pjoin(repo.location, path), encoding='utf8') as f:
+                        lines.extend('+' + line for line in f)
+                except (OSError, UnicodeDecodeError):
+                    continue
+        revdep_keys.update(_profile_keys(lines))
+    for key in list(pkgs):
+        if not os.path.isdir(pjoin(repo.location, *key)):
+            pkgs.discard(key)
+            revdep_keys.add('/'.join(key))
+
+    # pull in packages inheriting changed eclasses and reverse dependencies
+    # of packages with changed visibility
+    if eclasses or revdep_keys:
+        pkgs.update(_revdep_packages(repo, eclasses, revdep_keys, skip=pkgs))
+
+    if not pkgs:
+        return []
+
+    # group restrictions by category to keep matching cheap for large sets
+    categories = defaultdict(list)
+    for category, package in sorted(pkgs):
+        categories[category].append(restricts.PackageDep(package))
+    return [packages.AndRestriction(
+        restricts.RepositoryDep(repo.repo_id),
+        packages.OrRestriction(*(
+            packages.AndRestriction(
+                restricts.CategoryDep(category), packages.OrRestriction(*pkg_restricts))
+            for category, pkg_restricts in categories.items())))]
+
+
 @scan.bind_final_check
 def _validate_args(parser, namespace):
     namespace.enabled_checks = list(_known_checks)
@@ -260,8 +475,16 @@ def _validate_args(parser, namespace):
 
     namespace.repo_bases = [abspath(repo.location) for repo in reversed(namespace.target_repo.trees)]
 
+    if namespace.jobs < 1:
+        parser.error(f'invalid number of jobs: {namespace.jobs}')
+
     namespace.default_target = None
-    if namespace.targets:
+    if namespace.commits is not None:
+        if namespace.targets:
+            parser.error('--commits cannot be used with target arguments')
+        namespace.limiters = _commits_limiters(
+            parser, namespace.target_repo, namespace.commits)
+    elif namespace.targets:
         repo = namespace.target_repo
 
         # read targets from stdin in a non-blocking manner
@@ -277,15 +500,9 @@ def _validate_args(parser, namespace):
         def limiters():
             for target in namespace.targets:
                 try:
-                    yield parserestrict.parse_match(target)
-                except parserestrict.ParseError as e:
-                    if os.path.exists(target):
-                        try:
-                            yield repo.path_restrict(target)
-                        except ValueError as e:
-                            parser.error(e)
-                    else:
-                        parser.error(e)
+                    yield _target_restrict(repo, target)
+                except ValueError as e:
+                    parser.error(e)
         namespace.limiters = limiters()
     else:
         repo_base = getattr(namespace.target_repo, 'location', None)
@@ -398,27 +615,366 @@ def _validate_args(parser, namespace):
         parser.error(str(e))
 
 
-@scan.bind_main_func
-def _scan(options, out, err):
-    if not options.repo_bases:
-        err.write(
-            'Warning: could not determine repo base for profiles, some checks will not work.')
-        err.write()
+# feed types that can be split up across processes by package
+_package_feeds = frozenset((base.versioned_feed, base.ebuild_feed, base.package_feed))
+
+# pipeline state inherited by forked worker processes
+_worker_state = None
+
+
+def _run_pipes(sinks, transforms, source, reporter, profiler=None):
+    """Run the pipelines driving the given sinks."""
+    if sinks:
+        bad_sinks, pipes = base.plug(sinks, transforms, [source])
+        for source, pipe in pipes:
+            if profiler is not None:
+                pipe = base.profile_pipe(pipe, profiler)
+            pipe.start(reporter)
+            for thing in source.feed():
+                pipe.feed(thing, reporter)
+            pipe.finish(reporter)
+
+
+class _PackageScanner(object):
+    """Run package level pipelines against chunks of packages.
+
+    Checks are only started and finished once no matter how many chunks are
+    scanned. Pipelines are flushed after each package so results can be
+    attributed to the packages they were generated for.
+
+    :param sink_groups: sequence of sink lists, each run in separate pipelines
+    """
+
+    def __init__(self, repo, limiter, sink_groups, transforms, profiler=None):
+        self.source = feeds.PackageChunkSource(repo, limiter, ())
+        self.sink_groups = sink_groups
+        self.transforms = transforms
+        self.profiler = profiler
+        self.reporter = reporters.CollectingReporter()
+        self._pipes = {}
+
+    def _results(self):
+        results = self.reporter.results
+        self.reporter.results = []
+        return results
+
+    def scan(self, group, keys):
+        """Scan the given packages using the sinks of a given group.
+
+        Results generated while starting the checks are attributed to the
+        first package scanned.
+
+        :return: iterator of (key, results) tuples
+        """
+        pipes = self._pipes.get(group)
+        if pipes is None:
+            pipes = []
+            if self.sink_groups[group]:
+                bad_sinks, pipes = base.plug(
+                    self.sink_groups[group], self.transforms, [self.source])
+                pipes = [pipe for source, pipe in pipes]
+            if self.profiler is not None:
+                pipes = [base.profile_pipe(pipe, self.profiler) for pipe in pipes]
+            for pipe in pipes:
+                pipe.start(self.reporter)
+            self._pipes[group] = pipes
+
+        for key in keys:
+            self.source.keys = (key,)
+            for pipe in pipes:
+                for pkg in self.source.feed():
+                    pipe.feed(pkg, self.reporter)
+                pipe.flush(self.reporter)
+            yield key, self._results()
+
+    def finish(self):
+        """Finish all started pipelines.
+
+        :return: list of results generated while finishing
+        """
+        for pipes in self._pipes.values():
+            for pipe in pipes:
+                pipe.finish(self.reporter)
+        self._pipes = {}
+        return self._results()
+
+
+def _scan_worker(tasks, results):
+    """Scan chunks of packages sent by the main process until told to stop."""
+    repo, limiter, sink_groups, transforms, profile = _worker_state
+    profiler = base.Profiler() if profile else None
+    try:
+        scanner = _PackageScanner(repo, limiter, sink_groups, transforms, profiler)
+        for group, index, keys in iter(tasks.get, None):
+            results.put((group, index, list(scanner.scan(group, keys))))
+        results.put((None, scanner.finish(), getattr(profiler, 'stats', None)))
+    except Exception:
+        results.put((None, None, errors.WorkerError(traceback.format_exc())))
+
+
+class _WorkerPool(object):
+    """Forked worker processes scanning chunks of packages.
+
+    Results are reassembled in the order the chunks were submitted.
+
+    :param tasks: sequence of (group, index, keys) tuples with the indexes
+        of each group counting up from zero
+    """
+
+    def __init__(self, jobs, tasks):
+        ctx = multiprocessing.get_context('fork')
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._chunks = {}
+        self.finish_results = []
+        self.stats = []
+        for task in tasks:
+            self._tasks.put(task)
+        self._procs = [
+            ctx.Process(target=_scan_worker, args=(self._tasks, self._results))
+            for i in range(jobs)]
+        for proc in self._procs:
+            self._tasks.put(None)
+            proc.start()
+        self._running = len(self._procs)
+
+    def _recv(self):
+        while True:
+            try:
+                group, index, data = self._results.get(timeout=1)
+            except queue.Empty:
+                if any(proc.exitcode for proc in self._procs):
+                    raise errors.WorkerError('worker process died unexpectedly')
+                continue
+            if isinstance(data, errors.WorkerError):
+                raise data
+            if group is None:
+                self.finish_results.extend(index)
+                if data is not None:
+                    self.stats.append(data)
+                self._running -= 1
+            else:
+                self._chunks[group, index] = data
+            return
 
-    if options.guessed_suite:
-        if options.default_suite:
-            err.write('Tried to guess a suite to use but got multiple matches')
-            err.write('and fell back to the default.')
+    def scan(self, group):
+        """Iterate over the (key, results) tuples of a given group in order."""
+        index = 0
+        while True:
+            while (group, index) not in self._chunks:
+                if not self._running:
+                    return
+                self._recv()
+            yield from self._chunks.pop((group, index))
+            index += 1
+
+    def finish(self):
+        """Wait for all workers to finish."""
+        while self._running:
+            self._recv()
+        self.close()
+
+    def close(self):
+        for proc in self._procs:
+            if proc.exitcode is None:
+                proc.terminate()
+            proc.join()
+
+
+class _OrderedSource(object):
+    """Source wrapper passing in package results in the main process.
+
+    Results gathered for packages scanned separately are passed to the
+    reporter right before the main pipelines are fed the following package,
+    keeping the same result order as running all checks in a single pipeline
+    would. Any remaining results are passed on when the source is exhausted.
+    """
+
+    def __init__(self, source, package_results, reporter):
+        self.source = source
+        self.feed_type = source.feed_type
+        self.scope = source.scope
+        self.cost = source.cost
+        self._package_results = package_results
+        self._pending = None
+        self._reporter = reporter
+
+    def report(self, key=None):
+        """Report results for all packages sorted before a given key.
+
+        Results not tied to any package, signified by a key of None, are
+        only reported when no key is given.
+        """
+        pending = self._package_results
+        if self._pending is not None:
+            pending = chain((self._pending,), pending)
+            self._pending = None
+        for pending_key, results in pending:
+            if key is not None and (pending_key is None or pending_key >= key):
+                self._pending = (pending_key, results)
+                return
+            for result in results:
+                self._reporter.add_report(result)
+
+    def feed(self):
+        for pkg in self.source.feed():
+            self.report((pkg.category, pkg.package))
+            yield pkg
+        self.report()
+
+
+def _split_scan(options, reporter, results_cache, sinks, transforms, source,
+                profiler=None):
+    """Run the pipelines driving the given sinks, splitting up work by package.
+
+    Splittable version and package level sinks are run across chunks of
+    packages, using a pool of worker processes if multiple jobs are enabled,
+    while the remaining sinks are run in the main process against the entire
+    stream of packages. Results are passed to the reporter in the same order
+    as when running all sinks in the main process.
+
+    When a results cache is used, cacheable sinks are only run against
+    packages lacking current cache entries.
+    """
+    global _worker_state
+
+    cached_sinks = []
+    package_sinks = []
+    other_sinks = []
+    for sink in sinks:
+        if (sink.feed_type in _package_feeds and sink.scope <= base.package_scope
+                and sink.splittable):
+            if results_cache is not None and sink.cacheable:
+                cached_sinks.append(sink)
+            elif options.jobs > 1:
+                package_sinks.append(sink)
+            else:
+                other_sinks.append(sink)
         else:
-            err.write('using suite guessed from working directory')
+            other_sinks.append(sink)
+
+    # determine which packages lack current cache entries
+    keys = []
+    digests = {}
+    cached_results = {}
+    # packages are pulled from the source so batched sources map their targets
+    if cached_sinks:
+        for key, versions in groupby(source.feed(), key=attrgetter('category', 'package')):
+            keys.append(key)
+            digest = digests[key] = results_cache.digest(list(versions))
+            cached_results[key] = results_cache.get(key, digest)
+    elif package_sinks:
+        keys = feeds.package_keys(source.feed())
+    uncached_keys = [k for k, v in cached_results.items() if v is None]
+
+    # split packages into chunks small enough to keep all workers busy
+    tasks = []
+    if options.jobs > 1:
+        all_keys = (keys if package_sinks else [], uncached_keys)
+        chunksize = max(1, sum(map(len, all_keys)) // (options.jobs * 16))
+        for group, group_keys in enumerate(all_keys):
+            tasks.extend(
+                (group, index, group_keys[i:i + chunksize])
+                for index, i in enumerate(range(0, len(group_keys), chunksize)))
+
+    pool = None
+    scanner = None
+    if tasks:
+        # workers are forked so they inherit the pipeline state
+        _worker_state = (
+            source.repo, source.limiter, (package_sinks, cached_sinks),
+            transforms, profiler is not None)
+        try:
+            pool = _WorkerPool(min(options.jobs, len(tasks)), tasks)
+        finally:
+            _worker_state = None
+        package_results, fresh_results = pool.scan(0), pool.scan(1)
+    else:
+        scanner = _PackageScanner(
+            source.repo, source.limiter, ((), cached_sinks), transforms, profiler)
+        package_results, fresh_results = iter(()), scanner.scan(1, uncached_keys)
+
+    def iter_results():
+        """Yield the results of the sinks run separately for each package."""
+        for key in keys:
+            results = cached_results.get(key)
+            if key in cached_results and results is None:
+                fresh_key, results = next(fresh_results)
+                assert fresh_key == key, f'{fresh_key} results for {key}'
+                results_cache.update(key, digests[key], results)
+            if package_sinks:
+                package_key, package = next(package_results)
+                assert package_key == key, f'{package_key} results for {key}'
+                results = chain(results or (), package)
+            yield key, results or ()
+
+        if pool is not None:
+            pool.finish()
+            finish_results = pool.finish_results
+            if profiler is not None:
+                for stats in pool.stats:
+                    profiler.update(stats)
+        else:
+            finish_results = scanner.finish()
+        yield None, finish_results
 
     try:
-        reporter = options.reporter(
-            out, keywords=options.filtered_keywords, verbosity=options.verbosity)
-    except errors.ReporterInitError as e:
-        err.write(f'{scan.prog}: failed initializing reporter: {e}')
-        return 1
+        ordered = _OrderedSource(source, iter_results(), reporter)
+        if other_sinks:
+            _run_pipes(other_sinks, transforms, ordered, reporter, profiler)
+        ordered.report()
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def _write_profile(profiler, fmt, err):
+    """Output the timing data gathered while scanning."""
+    stats = sorted(
+        ((name, sum(values[:3]), *values) for name, values in profiler.stats.items()),
+        key=lambda x: (-x[1], x[0]))
+    if fmt == 'json':
+        fields = ('total', 'start', 'feed', 'finish', 'calls', 'items')
+        err.write(json.dumps(
+            {name: dict(zip(fields, values)) for name, *values in stats}, indent=2))
+        return
+
+    width = max(chain((len('class'),), (len(x[0]) for x in stats)))
+    header = ('total', 'start', 'feed', 'finish', 'calls', 'items')
+    err.write(f"{'class':<{width}}  " + '  '.join(f'{x:>10}' for x in header))
+    for name, total, start, feed, finish, calls, items in stats:
+        err.write(
+            f'{name:<{width}}  {total:>10.3f}  {start:>10.3f}  {feed:>10.3f}  '
+            f'{finish:>10.3f}  {calls:>10}  {items:>10}')
+
+
+def _batch_targets(repo, limiters):
+    """Group target restrictions sharing the same scope to be scanned together.
+
+    Repo level targets are always scanned separately.
+
+    :return: mapping of limiter indexes to (source, target index) tuples
+    """
+    scopes = defaultdict(list)
+    for i, limiter in enumerate(limiters):
+        scope = feeds.RestrictedRepoSource(repo, limiter).scope
+        if scope < base.repository_scope:
+            scopes[scope].append(i)
 
+    batches = {}
+    for indexes in scopes.values():
+        if len(indexes) > 1:
+            source = feeds.BatchedRepoSource(repo, [limiters[i] for i in indexes])
+            for target_index, i in enumerate(indexes):
+                batches[i] = (source, target_index)
+    return batches
+
+
+def _init_addons(options):
+    """Initialize all enabled addons and their dependencies.
+
+    :return: mapping of addon classes to their instances
+    """
     addons_map = {}
 
     def init_addon(klass):
@@ -432,28 +988,22 @@ def _scan(options, out, err):
     for addon in options.addons:
         # Ignore the return value, we just need to populate addons_map.
         init_addon(addon)
+    return addons_map
 
-    if options.verbosity > 1:
-        err.write(
-            f"target repo: {options.target_repo.repo_id!r} "
-            f"at {options.target_repo.location!r}")
-        err.write('base dirs: ', ', '.join(options.repo_bases))
-        for filterer in options.limiters:
-            err.write('limiter: ', filterer)
-        debug = logging.debug
-    else:
-        debug = None
 
+def _run_scan(options, reporter, err, sinks, limiters,
+              results_cache=None, profiler=None, debug=None):
+    """Scan the given target restrictions, passing results to a reporter."""
     transforms = list(get_plugins('transform', plugins))
-    # XXX this is pretty horrible.
-    sinks = list(addon for addon in addons_map.values()
-                 if getattr(addon, 'feed_type', False))
 
     reporter.start()
 
-    for filterer in options.limiters:
-        sources = [feeds.RestrictedRepoSource(options.target_repo, filterer)]
-        bad_sinks, pipes = base.plug(sinks, transforms, sources, debug)
+    def scan_source(source, filterer, reporter):
+        """Run the pipelines for a given source.
+
+        :return: list of the check classes run or None if no checks matched
+        """
+        bad_sinks, pipes = base.plug(sinks, transforms, [source], debug)
         if bad_sinks:
             # We want to report the ones that would work if this was a
             # full repo scan separately from the ones that are
@@ -471,11 +1021,25 @@ def _scan(options, out, err):
             if options.verbosity > 1 and out_of_scope:
                 err.warn('skipping repo checks (not a full repo scan)')
 
-        if pipes:
-            if options.debug:
-                err.write(f'Running {len(sinks) - len(bad_sinks)} tests')
-            err.flush()
+        if not pipes:
+            return None
+
+        if options.debug:
+            err.write(f'Running {len(sinks) - len(bad_sinks)} tests')
+        err.flush()
+        runners = [pipe for source, pipe in pipes]
+        if options.jobs > 1 or results_cache is not None:
+            reporter.start_check(
+                list(base.collect_checks_classes(runners)), filterer)
+            _split_scan(
+                options, reporter, results_cache,
+                list(base.collect_checks(runners)), transforms, source,
+                profiler)
+            reporter.end_check()
+        else:
             for source, pipe in pipes:
+                if profiler is not None:
+                    pipe = base.profile_pipe(pipe, profiler)
                 pipe.start(reporter)
                 reporter.start_check(
                     list(base.collect_checks_classes(pipe)), filterer)
@@ -483,17 +1047,299 @@ def _scan(options, out, err):
                     pipe.feed(thing, reporter)
                 pipe.finish(reporter)
                 reporter.end_check()
+        return list(base.collect_checks_classes(runners))
+
+    batches = {}
+    if options.batch_targets:
+        limiters = list(limiters)
+        batches = _batch_targets(options.target_repo, limiters)
+
+    batch_results = {}
+    for i, filterer in enumerate(limiters):
+        batch = batches.get(i)
+        if batch is None:
+            source = feeds.RestrictedRepoSource(options.target_repo, filterer)
+            checks = scan_source(source, filterer, reporter)
         else:
+            # run all targets in the batch at once, splitting up the results
+            source, index = batch
+            if source not in batch_results:
+                collector = reporters.CollectingReporter()
+                checks = scan_source(source, source.limiter, collector)
+                buckets = source.split(collector.results) if checks else None
+                batch_results[source] = (checks, buckets)
+            checks, buckets = batch_results[source]
+            if checks:
+                reporter.start_check(checks, filterer)
+                for result in buckets[index]:
+                    reporter.add_report(result)
+                reporter.end_check()
+                buckets[index] = None
+        if checks is None:
             err.write(f'{scan.prog}: no matching checks available for current scope')
 
     reporter.finish()
 
+
+@scan.bind_main_func
+def _scan(options, out, err):
+    if not options.repo_bases:
+        err.write(
+            'Warning: could not determine repo base for profiles, some checks will not work.')
+        err.write()
+
+    if options.guessed_suite:
+        if options.default_suite:
+            err.write('Tried to guess a suite to use but got multiple matches')
+            err.write('and fell back to the default.')
+        else:
+            err.write('using suite guessed from working directory')
+
+    try:
+        reporter = options.reporter(
+            out, keywords=options.filtered_keywords, verbosity=options.verbosity)
+    except errors.ReporterInitError as e:
+        err.write(f'{scan.prog}: failed initializing reporter: {e}')
+        return 1
+
+    addons_map = _init_addons(options)
+
+    if options.verbosity > 1:
+        err.write(
+            f"target repo: {options.target_repo.repo_id!r} "
+            f"at {options.target_repo.location!r}")
+        err.write('base dirs: ', ', '.join(options.repo_bases))
+        for filterer in options.limiters:
+            err.write('limiter: ', filterer)
+        debug = logging.debug
+    else:
+        debug = None
+
+    # XXX this is pretty horrible.
+    sinks = list(addon for addon in addons_map.values()
+                 if getattr(addon, 'feed_type', False))
+
+    results_cache = None
+    if options.results_cache:
+        results_cache = cache.ResultsCache(options)
+
+    profiler = base.Profiler() if options.profile_checks else None
+
+    _run_scan(options, reporter, err, sinks, options.limiters,
+              results_cache, profiler, debug)
+
+    if results_cache is not None:
+        try:
+            results_cache.save()
+        except OSError as e:
+            err.error(f'failed dumping results cache: {results_cache.path!r}: {e.strerror}')
+        if options.verbosity > 0:
+            err.write(
+                f'results cache: {results_cache.hits} hit{_pl(results_cache.hits)}, '
+                f'{results_cache.misses} miss{_pl(results_cache.misses, plural="es")}')
+
+    if options.verbosity > 0:
+        # note that caches populated in worker processes aren't included
+        for addon in addons_map.values():
+            for name, lru in getattr(addon, 'caches', ()):
+                if lru.hits or lru.misses:
+                    err.write(f'{name}: {lru.stats}')
+
+    if profiler is not None:
+        _write_profile(profiler, options.profile_checks, err)
+
     # flush stdout first; if they're directing it all to a file, this makes
     # results not get the final message shoved in midway
     out.stream.flush()
     return 0
 
 
+daemon = subparsers.add_parser(
+    'daemon', description='serve scan requests over a unix socket',
+    docs="""
+        Run a long-lived process serving scan requests over a unix socket.
+        Checks and all the data they require, e.g. profiles, are initialized
+        once using the given scan options and reused across requests
+        avoiding most of the startup time of running pkgcheck scan for every
+        request, making it useful for editor integration or commit hooks.
+
+        Requests are single JSON objects sent on one line, supporting the
+        following keys:
+
+        - targets: list of target atoms or paths to scan (required)
+        - checks: list of checks to limit the scan to
+        - reporter: reporter to use instead of the default one
+
+        Results are streamed back using the selected reporter and the
+        connection is closed when the scan is done. All state is reloaded if
+        any files in the profiles or eclass directories of the target repo or
+        its masters change between requests or if any packages or ebuilds
+        are added or removed.
+
+        Example using socat::
+
+            echo '{"targets": ["dev-util/pkgcheck"]}' | socat - UNIX-CONNECT:/path/to/socket
+    """)
+daemon.add_argument(
+    '--socket', metavar='PATH',
+    help='path of the socket to listen on',
+    docs="""
+        Path of the unix socket to listen on, defaults to pkgcheck.sock
+        inside $XDG_RUNTIME_DIR if set, otherwise inside the pkgcheck user
+        cache directory.
+    """)
+daemon.add_argument(
+    'scan_args', metavar='SCAN_ARG', nargs=argparse.REMAINDER,
+    help='scan options used to initialize checks')
+
+
+def _daemon_signature(repo):
+    """Return the state of the repo files that require reloading when changed.
+
+    Besides the files in the profiles and eclass directories, this covers the
+    category and package directories whose modification times change when
+    packages or ebuilds are added or removed, invalidating the listings
+    cached by the repo. Changes to existing ebuilds are picked up without
+    reloading.
+    """
+    stats = []
+    for tree in repo.trees:
+        for subdir in ('profiles', 'eclass'):
+            for path in cache.iter_files(pjoin(tree.location, subdir)):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                stats.append((path, st.st_mtime_ns, st.st_size))
+        for category in sorted(tree.categories):
+            path = pjoin(tree.location, category)
+            try:
+                stats.append((path, os.stat(path).st_mtime_ns))
+                with os.scandir(path) as it:
+                    for entry in sorted(it, key=attrgetter('name')):
+                        if entry.is_dir():
+                            stats.append((entry.path, entry.stat().st_mtime_ns))
+            except FileNotFoundError:
+                continue
+    return stats
+
+
+class _ScanDaemon(object):
+    """Scanning state kept around between daemon requests."""
+
+    def __init__(self, scan_args, err):
+        self.scan_args = scan_args
+        self.err = err
+        self.options = None
+        self.sinks = None
+        self.caches = None
+        self.signature = None
+
+    def load(self):
+        """Parse the scan options and initialize all checks."""
+        self.options = argparser.parse_args(['scan'] + self.scan_args)
+        addons_map = _init_addons(self.options)
+        self.sinks = list(addon for addon in addons_map.values()
+                          if getattr(addon, 'feed_type', False))
+        self.caches = [
+            lru for addon in addons_map.values() for _name, lru in getattr(addon, 'caches', ())]
+        self.signature = _daemon_signature(self.options.target_repo)
+
+    def _reporter(self, name):
+        """Find the reporter factory for a given name."""
+        if name is None:
+            return self.options.reporter
+        func = self.options.config.pkgcheck_reporter_factory.get(name)
+        if func is None:
+            func = list(base.Whitelist([name]).filter(get_plugins('reporter', plugins)))
+            if len(func) != 1:
+                raise ValueError(f'reporter {name!r} matches {len(func)} reporters')
+            func = func[0]
+        return func
+
+    def scan(self, request, stream):
+        """Run a scan request, streaming the results to a binary stream."""
+        if _daemon_signature(self.options.target_repo) != self.signature:
+            self.err.write(f'{daemon.prog}: repo changed, reloading')
+            self.load()
+        else:
+            # ebuilds may have changed since the previous request
+            for lru in self.caches:
+                lru.clear()
+
+        options = self.options
+        targets = request.get('targets')
+        if not targets or not isinstance(targets, list):
+            raise ValueError('no targets specified')
+        limiters = [_target_restrict(options.target_repo, target) for target in targets]
+
+        sinks = self.sinks
+        if request.get('checks'):
+            checks = set(base.Whitelist(request['checks']).filter(options.enabled_checks))
+            if not checks:
+                raise ValueError('no matching checks enabled')
+            # addons feeding on packages, e.g. caches, are always kept
+            sinks = [sink for sink in sinks
+                     if not isinstance(sink, base.Template) or sink.__class__ in checks]
+
+        out = formatters.PlainTextFormatter(stream, encoding='utf8')
+        reporter = self._reporter(request.get('reporter'))(
+            out, keywords=options.filtered_keywords, verbosity=options.verbosity)
+        _run_scan(options, reporter, self.err, sinks, limiters)
+        stream.flush()
+
+
+@daemon.bind_main_func
+def _daemon(options, out, err):
+    path = options.socket
+    if path is None:
+        path = pjoin(os.environ.get('XDG_RUNTIME_DIR', cache.CACHE_DIR), 'pkgcheck.sock')
+
+    state = _ScanDaemon(options.scan_args, err)
+    state.load()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode())
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+                state.scan(request, self.wfile)
+            except (ValueError, errors.ReporterInitError) as e:
+                self.wfile.write(f'{daemon.prog}: error: {e}\n'.encode())
+            except SystemExit:
+                # option parsing failed while reloading
+                self.wfile.write(f'{daemon.prog}: error: failed reloading\n'.encode())
+
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            # stale socket left behind by a previous instance
+            os.unlink(path)
+        else:
+            err.write(f'{daemon.prog}: already running on {path!r}')
+            return 1
+        finally:
+            sock.close()
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    server = socketserver.UnixStreamServer(path, RequestHandler)
+    if options.verbosity > 0:
+        err.write(f'{daemon.prog}: listening on {path!r}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+    return 0
+
+
 replay = subparsers.add_parser(
     'replay',
     description='replay results streams',
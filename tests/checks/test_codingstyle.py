@@ -2,6 +2,7 @@ from itertools import chain
 
 from pkgcore.ebuild.eapi import EAPI
 
+from pkgcheck import addons
 from pkgcheck.checks import codingstyle
 
 from .. import misc
@@ -36,7 +37,7 @@ class TestBadInsIntoUsage(misc.ReportTestCase):
             "/usr/share/applications", "/usr/share/applications",
             "//usr/share//applications", "/etc/cron.d", "/etc/cron.hourly",
             "/etc/cron.daily", "/etc/cron.weekly")
-        check = self.check_kls(options=None)
+        check = self.check_kls(None, addons.LineScannerAddon(None))
 
         reports = self.assertReports(check, [fake_pkg, fake_src])
         dirs = [x.insintodir for x in reports]
@@ -74,7 +75,7 @@ class TestAbsoluteSymlink(misc.ReportTestCase):
             fake_src.append(f"\tdosym {src} {dest}\n")
         fake_src.append("# That's it for now\n")
 
-        check = self.check_kls(options=None)
+        check = self.check_kls(None, addons.LineScannerAddon(None))
         reports = self.assertReports(check, [fake_pkg, fake_src])
         abspaths = [x.abspath for x in reports]
 
@@ -85,7 +86,7 @@ class TestAbsoluteSymlink(misc.ReportTestCase):
 class TestPathVariablesCheck(misc.ReportTestCase):
 
     check_kls = codingstyle.PathVariablesCheck
-    check = check_kls(options=None)
+    check = check_kls(None, addons.LineScannerAddon(None))
 
     def _found(self, cls, suffix=''):
         # check single and multiple matches across all specified variables
@@ -86,7 +86,8 @@ class TestKeywordsReport(iuse_options, misc.ReportTestCase):
         options = self.get_options()
         profiles = [misc.FakeProfile()]
         iuse_handler = addons.UseAddon(options, profiles, silence_warnings=True)
-        self.check = metadata_checks.KeywordsReport(options, iuse_handler)
+        self.check = metadata_checks.KeywordsReport(
+            options, iuse_handler, addons.RepoIndexAddon(options))
 
     def mk_pkg(self, keywords=""):
         return misc.FakePkg("dev-util/diffball-0.7.1", data={"KEYWORDS": keywords})
@@ -154,7 +155,8 @@ class TestRequiredUSEMetadataReport(iuse_options, misc.ReportTestCase):
         options = self.get_options(verbosity=1)
         profiles = {'x86': [misc.FakeProfile(name='default/linux/x86')]}
         self.check = metadata_checks.RequiredUSEMetadataReport(
-            options, addons.UseAddon(options, profiles['x86']), profiles)
+            options, addons.UseAddon(options, profiles['x86']), profiles,
+            addons.UseStateAddon(options))
 
     def mk_pkg(self, eapi="4", iuse="", required_use="", keywords="x86"):
         return FakePkg(
@@ -319,6 +321,12 @@ class TestDependencyReport(use_based(), misc.ReportTestCase):
         (x, x.upper())
         for x in ("depend", "rdepend", "pdepend"))
 
+    def mk_check(self, **kwargs):
+        options = self.get_options(**kwargs)
+        profiles = [misc.FakeProfile(iuse_effective=["x86"])]
+        iuse_handler = addons.UseAddon(options, profiles, silence_warnings=True)
+        return self.check_kls(options, iuse_handler, addons.RepoIndexAddon(options))
+
     def mk_pkg(self, attr, data='', eapi='0', iuse=''):
         return misc.FakePkg(
             'dev-util/diffball-2.7.1',
@@ -0,0 +1,136 @@
+import os
+import pickle
+
+from lxml import etree
+from pkgcore.repository.util import SimpleTree
+from snakeoil.fileutils import write_file
+from snakeoil.osutils import pjoin
+import pytest
+
+from pkgcheck import addons, cache
+from pkgcheck.checks import metadata_xml
+
+from ..misc import Options, Tmpdir
+
+
+xsd = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="catmetadata">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="longdescription" type="xs:string" minOccurs="0"/>
+        <xs:element name="cat" type="xs:string" minOccurs="0" maxOccurs="unbounded"/>
+        <xs:element name="pkg" type="xs:string" minOccurs="0" maxOccurs="unbounded"/>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+refs_xml = b"""<?xml version="1.0" encoding="UTF-8"?>
+<catmetadata>
+\t<longdescription></longdescription>
+\t<cat>dev-util</cat>
+  <pkg>dev-util/diffball</pkg>
+</catmetadata>
+"""
+
+
+class TestMetadataXmlCheck(Tmpdir):
+
+    @pytest.fixture(autouse=True)
+    def _schema(self, monkeypatch):
+        schema = etree.XMLSchema(etree.XML(xsd.encode()))
+        monkeypatch.setattr(metadata_xml.base_check, 'schema', schema)
+        monkeypatch.setattr(metadata_xml.base_check, 'schema_digest', 'digest')
+        monkeypatch.setattr(cache, 'CACHE_DIR', pjoin(self.dir, 'cache'))
+
+    def mk_check(self, repo, **kwargs):
+        options = Options(
+            target_repo=Options(location=self.dir),
+            search_repo=Options(categories=tuple(repo.categories)),
+            metadata_xml_cache=True, **kwargs)
+        check = metadata_xml.CategoryMetadataXmlCheck(
+            options, addons.RepoIndexAddon(Options(search_repo=repo)))
+        check.start(None)
+        return check
+
+    def run_check(self, check, data):
+        loc = pjoin(self.dir, 'metadata.xml')
+        write_file(loc, 'wb', data)
+        return [report(loc, 'dev-util') for report in check.check_file(loc)]
+
+    def test_cached_refs(self, monkeypatch):
+        repo = SimpleTree({'dev-util': {'diffball': ['1.0']}})
+        check = self.mk_check(repo)
+        reports = self.run_check(check, refs_xml)
+        assert [type(r) for r in reports] == [
+            metadata_xml.CatMetadataXmlEmptyElement, metadata_xml.CatMetadataXmlIndentation]
+        assert reports[0].element == 'longdescription'
+        assert reports[1].lines == (5,)
+        check.finish(None)
+
+        # cached data is replayed with references checked against the
+        # current repo
+        def parse_file(self, data):
+            raise AssertionError('cached metadata.xml data reparsed')
+        monkeypatch.setattr(metadata_xml.base_check, 'parse_file', parse_file)
+        repo = SimpleTree({'dev-libs': {'foo': ['1']}})
+        check = self.mk_check(repo)
+        reports = self.run_check(check, refs_xml)
+        assert [type(r) for r in reports] == [
+            metadata_xml.CatMetadataXmlEmptyElement,
+            metadata_xml.CatMetadataXmlInvalidCatRef,
+            metadata_xml.CatMetadataXmlInvalidPkgRef,
+            metadata_xml.CatMetadataXmlIndentation]
+        assert reports[1].cattext == 'dev-util'
+        assert reports[2].pkgtext == 'dev-util/diffball'
+        assert check.xml_cache.hits == 1
+
+    def test_invalid(self):
+        repo = SimpleTree({'dev-util': {'diffball': ['1.0']}})
+        check = self.mk_check(repo)
+        data = b'<catmetadata>\n<foo/>\n</catmetadata>\n'
+        xml = check.parse_file(data)
+        assert xml.errors
+        assert all(isinstance(x, metadata_xml._XmlError) for x in xml.errors)
+        # parsed data is stored in the pickled cache
+        assert pickle.loads(pickle.dumps(xml)) == xml
+
+        reports = self.run_check(check, data)
+        assert len(reports) == 1
+        r = reports[0]
+        assert isinstance(r, metadata_xml.CatInvalidXml)
+        assert len(r.message) == len(xml.errors)
+        assert r.message[0].startswith('line 2, col ')
+        assert '(SCHEMAV_' in r.message[0]
+        assert xml.errors[0].message in r.message[0]
+        assert 'violates metadata.xsd' in r.short_desc
+
+    def test_misformed(self):
+        repo = SimpleTree({'dev-util': {'diffball': ['1.0']}})
+        check = self.mk_check(repo)
+        reports = self.run_check(check, b'<catmetadata>\n')
+        assert [type(r) for r in reports] == [metadata_xml.CatBadlyFormedXml]
+
+    def test_no_schema(self, monkeypatch):
+        # failed schema fetches leave the schema unset
+        monkeypatch.setattr(metadata_xml.base_check, 'schema', None)
+        monkeypatch.setattr(metadata_xml.base_check, 'schema_digest', None)
+        monkeypatch.setattr(metadata_xml.base_check, '_load_schema', lambda self: None)
+        repo = SimpleTree({'dev-util': {'diffball': ['1.0']}})
+        check = self.mk_check(repo)
+        # documents aren't validated, while other checks are still run
+        reports = self.run_check(check, b'<catmetadata>\n<foo> </foo>\n</catmetadata>\n')
+        assert [type(r) for r in reports] == [metadata_xml.CatMetadataXmlEmptyElement]
+        assert reports[0].element == 'foo'
+        # unvalidated results aren't saved to disk
+        check.finish(None)
+        assert check.xml_cache.path is None
+        assert not os.path.exists(pjoin(self.dir, 'cache', 'metadata_xml.pickle'))
+
+    def test_whitespace_undecodable(self):
+        repo = SimpleTree({'dev-util': {'diffball': ['1.0']}})
+        check = self.mk_check(repo)
+        data = b'<catmetadata>\n\t<longdescription>\xff</longdescription>\n  <cat>dev-util</cat>\n</catmetadata>\n'
+        assert check.check_whitespace(data) == (3,)
@@ -7,6 +7,7 @@ from snakeoil import fileutils
 from snakeoil.fileutils import touch
 from snakeoil.osutils import pjoin
 
+from pkgcheck import addons
 from pkgcheck.checks import pkgdir_checks
 
 from .. import misc
@@ -16,7 +17,7 @@ class PkgDirReportBase(misc.Tmpdir, misc.ReportTestCase):
     """Various FILESDIR related test support."""
 
     check_kls = pkgdir_checks.PkgDirReport
-    check = pkgdir_checks.PkgDirReport(None, None)
+    check = pkgdir_checks.PkgDirReport(None, addons.PkgDirAddon(None))
 
     def mk_pkg(self, files={}, pkg=None):
         if pkg is None:
@@ -131,6 +132,22 @@ class TestMismatchedPN(PkgDirReportBase):
         assert 'abc-1, mismatched-0' in str(r)
 
 
+class TestInvalidUtf8(PkgDirReportBase):
+    """Check InvalidUtf8 results."""
+
+    def test_it(self):
+        pkg = self.mk_pkg()
+        ebuild = pjoin(os.path.dirname(pkg.path), f'{pkg.package}-0.ebuild')
+        fileutils.write_file(ebuild, 'wb', 'DESCRIPTION="ü"\n'.encode())
+        self.assertNoReport(self.check, [pkg])
+
+        # content changes are noticed for cached files
+        fileutils.write_file(ebuild, 'wb', b'DESCRIPTION="\xff"\n')
+        r = self.assertReport(self.check, [pkg])
+        assert isinstance(r, pkgdir_checks.InvalidUtf8)
+        assert r.filename == f'{pkg.package}-0.ebuild'
+
+
 class TestInvalidPN(PkgDirReportBase):
     """Check InvalidPN results."""
 
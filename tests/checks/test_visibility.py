@@ -0,0 +1,256 @@
+import multiprocessing
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.ebuild.conditionals import DepSet
+from pkgcore.test.misc import FakePkg, FakeRepo
+import pytest
+
+from pkgcheck import addons, errors
+from pkgcheck.checks import visibility
+
+from .. import misc
+from ..misc import FakeReporter, Options
+
+
+def test_visit_atoms():
+    flags = ','.join(f'f{i}?' for i in range(32))
+    depset = DepSet.parse(
+        f'dev-lang/python[{flags}] foo? ( dev-libs/bar )', atom,
+        transitive_use_atoms=True)
+    # transitive use atoms aren't expanded into their conditional forms
+    atoms = list(visibility.visit_atoms(depset))
+    assert len(atoms) == 2
+    assert [str(visibility.strip_atom_use(x)) for x in atoms] == [
+        'dev-lang/python', 'dev-libs/bar']
+
+
+class _UseProfile(object):
+
+    def __init__(self, enabled, immutable=()):
+        self.enabled = frozenset(enabled)
+        self.immutable = frozenset(immutable)
+
+    def identify_use(self, pkg, known_flags):
+        return self.immutable & known_flags, self.enabled & known_flags
+
+
+class _UseProfiles(object):
+
+    def __init__(self, *profiles):
+        self.profiles = profiles
+
+    def identify_profiles(self, pkg):
+        return [[x] for x in self.profiles]
+
+
+def test_evaluate_transitive_use(monkeypatch):
+    # expanding transitive use atoms into their conditional forms is
+    # exponential in the number of flags, evaluation must not rely on it
+    def convert_to_conditionals(self):
+        raise AssertionError('transitive use atom expanded')
+    monkeypatch.setattr(
+        atom._transitive_use_atom, 'convert_to_conditionals', convert_to_conditionals)
+
+    flags = [f'f{i}' for i in range(24)]
+    rdepend = 'dev-lang/python[%s,!g?]' % ','.join(f'{x}?' for x in flags)
+    pkg = misc.FakePkg(
+        'dev-util/diffball-0.1', data={'EAPI': '6', 'RDEPEND': rdepend})
+    atoms = list(visibility.visit_atoms(pkg.rdepend))
+    assert len(atoms) == 1
+
+    profiles = _UseProfiles(
+        _UseProfile(flags[::2]), _UseProfile(flags[:3] + ['g']), _UseProfile(()))
+    depsets = addons.EvaluateDepSetAddon(Options(depset_cache_size=100), profiles).collapse_evaluate_depset(
+        pkg, 'rdepend', pkg.rdepend)
+    assert len(depsets) == 3
+    results = []
+    for depset, depset_profiles in depsets:
+        atoms = list(visibility.visit_atoms(depset))
+        assert len(atoms) == 1
+        assert atoms[0].key == 'dev-lang/python'
+        results.append(set(atoms[0].use or ()))
+    assert results == [set(flags[::2]) | {'-g'}, set(flags[:3]), {'-g'}]
+
+
+class _Profile(object):
+
+    def __init__(self, name, key, bit):
+        self.name = name
+        self.key = key
+        self.bit = bit
+
+
+class _Profiles(list):
+
+    def __init__(self, names):
+        super().__init__(
+            _Profile(name, key, 1 << (i * 2 + j))
+            for i, name in enumerate(names)
+            for j, key in enumerate(('x86', '~x86')))
+        self.global_insoluble = set()
+
+
+class _RepoIndex(object):
+
+    def __init__(self, pkgs):
+        self.pkgs = pkgs
+
+    def itermatch(self, restrict):
+        return (x for x in self.pkgs if restrict.match(x))
+
+    def match(self, restrict):
+        return list(self.itermatch(restrict))
+
+    def versions(self, key):
+        return tuple(sorted(x for x in self.pkgs if x.key == key))
+
+
+class _DepsetCache(object):
+
+    def feed(self, pkg, reporter):
+        pass
+
+
+class _VisibilityReport(visibility.VisibilityReport):
+    """Report nonsolvable deps for every profile without solving anything."""
+
+    def query_depsets(self, pkg, reporter):
+        pass
+
+    def check_depsets(self, pkg, reporter, mask=None):
+        if pkg.package == 'broken':
+            raise ValueError('failed solving depsets')
+        for attr in self.attrs:
+            for profile in self.profiles:
+                if mask is None or profile.bit & mask:
+                    reporter.add_report(visibility.NonsolvableDeps(
+                        pkg, attr, profile.key, profile.name, [atom('dev-libs/foo')]))
+
+
+class TestVisibilityJobs(object):
+
+    repo = FakeRepo(repo_id='test')
+    profiles = _Profiles(['default', 'default/desktop', 'hardened'])
+
+    def mk_check(self, jobs, pkgs, scan_jobs=1):
+        options = Options(visibility_jobs=jobs, jobs=scan_jobs)
+        query_cache = Options(
+            query_cache=addons.LRUCache(10), query_visibility=addons.LRUCache(10))
+        return _VisibilityReport(
+            options, query_cache, self.profiles, _DepsetCache(), _RepoIndex(pkgs), None)
+
+    def _run(self, check, pkgs):
+        results = []
+        reporter = FakeReporter(results.append)
+        check.start(reporter)
+        try:
+            for pkg in pkgs:
+                check.feed(pkg, reporter)
+        finally:
+            check.finish(reporter)
+        return [(r.package, r.version, r.attr, r.keyword, r.profile) for r in results]
+
+    def test_shards(self):
+        check = self.mk_check(2, [])
+        assert check.shards(2) == [0b110011, 0b001100]
+        # stable and unstable variants of a profile are never split up
+        assert check.shards(8) == [0b000011, 0b001100, 0b110000]
+
+    def test_results(self, monkeypatch):
+        pkgs = [
+            FakePkg(f'dev-util/pkg{i}-{v}', repo=self.repo)
+            for i in range(5) for v in (1, 2)]
+        # results match serial runs, including packages still in flight
+        monkeypatch.setattr(_VisibilityReport, 'pipeline_depth', 3)
+        serial = self._run(self.mk_check(1, pkgs), pkgs)
+        assert len(serial) == len(pkgs) * len(self.profiles) * len(visibility.VisibilityReport.attrs)
+        for jobs in (2, 3):
+            check = self.mk_check(jobs, pkgs)
+            assert self._run(check, pkgs) == serial
+            assert not check.workers
+
+    def test_scan_jobs(self, monkeypatch):
+        pkgs = [FakePkg(f'dev-util/pkg{i}-1', repo=self.repo) for i in range(3)]
+        serial = self._run(self.mk_check(1, pkgs), pkgs)
+
+        # no nested workers are started when packages are scanned in
+        # multiple processes
+        def get_context(method):
+            raise AssertionError('visibility workers started')
+        monkeypatch.setattr(multiprocessing, 'get_context', get_context)
+        check = self.mk_check(2, pkgs, scan_jobs=2)
+        assert self._run(check, pkgs) == serial
+
+    def test_worker_error(self):
+        pkgs = [FakePkg('dev-util/broken-1', repo=self.repo)]
+        check = self.mk_check(2, pkgs)
+        with pytest.raises(errors.WorkerError, match='failed solving depsets'):
+            self._run(check, pkgs)
+        assert not check.workers
+
+
+class _SolveProfile(object):
+
+    def __init__(self, bit):
+        self.name = 'default'
+        self.key = 'x86'
+        self.bit = bit
+        self.use = set()
+        self.cache = set()
+        self.insoluble = set()
+
+    def provides_has_match(self, node):
+        return False
+
+    def visible(self, pkg):
+        return True
+
+
+class _SolveProfiles(list):
+
+    def visibility(self, pkg):
+        bits = 0
+        for profile in self:
+            bits |= profile.bit
+        return bits
+
+
+class TestProcessDepset(object):
+
+    def test_query_cache_eviction(self):
+        repo = FakeRepo(repo_id='test')
+        pkgs = [FakePkg(f'dev-libs/{x}-1', repo=repo) for x in ('a', 'b', 'c')]
+        profiles = _SolveProfiles([_SolveProfile(1)])
+        # a single entry query cache evicts queries between their use
+        query_cache = Options(
+            query_cache=addons.LRUCache(1), query_visibility=addons.LRUCache(10))
+        check = visibility.VisibilityReport(
+            Options(visibility_jobs=1, jobs=1), query_cache, profiles,
+            _DepsetCache(), _RepoIndex(pkgs), addons.UseStateAddon(Options()))
+        depset = DepSet.parse('dev-libs/a dev-libs/b dev-libs/c', atom)
+        pkg = FakePkg('dev-util/diffball-1', repo=repo)
+
+        for i in range(2):
+            # fresh profile caches force solving the depset again
+            profiles[:] = [_SolveProfile(1)]
+            results = []
+            check.process_depset(pkg, 'depend', depset, profiles, FakeReporter(results.append))
+            assert results == []
+            assert query_cache.query_cache.evictions > 0
+            for x in ('a', 'b', 'c'):
+                assert query_cache.query_visibility.get(atom(f'dev-libs/{x}')) == 1
+
+    def test_query_cache_positions(self):
+        repo = FakeRepo(repo_id='test')
+        pkgs = [FakePkg(f'dev-libs/a-{v}', repo=repo) for v in (1, 2, 3)]
+        query_cache = Options(
+            query_cache=addons.LRUCache(10), query_visibility=addons.LRUCache(10))
+        check = visibility.VisibilityReport(
+            Options(visibility_jobs=1, jobs=1), query_cache, _SolveProfiles(),
+            _DepsetCache(), _RepoIndex(pkgs), addons.UseStateAddon(Options()))
+        node = atom('>=dev-libs/a-2')
+        assert check.matches(node) == pkgs[1:]
+        # cached queries don't hold onto package objects
+        assert query_cache.query_cache[node] == (1, 2)
+        assert check.matches(node) == pkgs[1:]
+        assert query_cache.query_cache.hits == 1
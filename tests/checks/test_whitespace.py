@@ -1,3 +1,4 @@
+from pkgcheck import addons
 from pkgcheck.checks import whitespace
 
 from .. import misc
@@ -7,7 +8,7 @@ class WhitespaceCheckTest(misc.ReportTestCase):
     """Various whitespace related test support."""
 
     check_kls = whitespace.WhitespaceCheck
-    check = whitespace.WhitespaceCheck(None, None)
+    check = whitespace.WhitespaceCheck(None, addons.LineScannerAddon(None))
 
 
 class TestWhitespaceFound(WhitespaceCheckTest):
@@ -38,6 +39,21 @@ class TestWhitespaceFound(WhitespaceCheckTest):
         assert r.lines == (2,)
         assert 'trailing whitespace' in str(r)
 
+    def test_trailing_final_line(self):
+        # final lines lacking a newline are checked as well
+        fake_pkg = misc.FakePkg("dev-util/diffball-0.5")
+        fake_src = [
+            "# This is our first fake ebuild\n",
+            "# That's it for now\t",
+        ]
+
+        reports = self.assertReports(self.check, [fake_pkg, fake_src])
+        assert len(reports) == 2
+        r = [x for x in reports if isinstance(x, whitespace.WhitespaceFound)][0]
+        assert r.lines == (2,)
+        assert 'trailing whitespace' in str(r)
+        assert any(isinstance(x, whitespace.NoFinalNewline) for x in reports)
+
 
 class TestWrongIndentFound(WhitespaceCheckTest):
 
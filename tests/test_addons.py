@@ -4,15 +4,20 @@ import os
 import shutil
 import sys
 
+import pytest
+
 from pkgcore.ebuild import repo_objs, repository
+from pkgcore.ebuild.atom import atom
+from pkgcore.repository.util import SimpleTree
 from pkgcore.restrictions import packages
+from pkgcore.test.misc import FakePkg as FakeRepoPkg, FakeRepo
 from pkgcore.util import commandline
 from snakeoil.fileutils import write_file
 from snakeoil.osutils import pjoin, ensure_dirs
 
-from pkgcheck import addons, base
+from pkgcheck import addons, base, cache
 
-from .misc import FakePkg, FakeProfile, Options, Tmpdir
+from .misc import FakeFilesDirPkg, FakePkg, FakeProfile, Options, Tmpdir
 
 
 class ArgparseCheck(object):
@@ -66,28 +71,186 @@ class TestArchesAddon(ArgparseCheck):
 class TestQueryCacheAddon(ArgparseCheck):
 
     addon_kls = addons.QueryCacheAddon
-    default_feed = base.package_feed
 
     def test_opts(self):
         for val, ret in (('version', base.versioned_feed),
                          ('package', base.package_feed),
-                         ('category', base.repository_feed)):
+                         ('category', base.category_feed)):
             self.process_check(
                 ['--reset-caching-per', val],
                 query_caching_freq=ret, silence=True)
+        for val, ret in (('100', 100),
+                         ('1M', 1024 * 1024 // self.addon_kls.entry_size),
+                         ('2mb', 2 * 1024 * 1024 // self.addon_kls.entry_size)):
+            self.process_check(
+                ['--query-cache-size', val],
+                query_cache_size=ret, silence=True)
 
     def test_default(self):
         self.process_check(
-            [], silence=True, query_caching_freq=self.default_feed)
+            [], silence=True, query_caching_freq=None, query_cache_size=50000)
 
     def test_feed(self):
-        options = self.process_check([], silence=True)
+        # the cache persists across packages by default
+        options = self.process_check(['--query-cache-size', '1'], silence=True)
+        check = self.addon_kls(options)
+        assert check.feed_type is None
+        check.query_cache["boobies"] = "hooray for"
+        assert "boobies" in check.query_cache
+        check.query_cache["foo"] = "bar"
+        assert "boobies" not in check.query_cache
+        assert check.query_cache.evictions == 1
+
+        options = self.process_check(['--reset-caching-per', 'package'], silence=True)
         check = self.addon_kls(options)
         check.start(None)
-        assert check.feed_type == self.default_feed
+        assert check.feed_type == base.package_feed
         check.query_cache["boobies"] = "hooray for"
+        check.query_visibility["boobies"] = 1
         check.feed(None, None)
         assert not check.query_cache
+        # data derived from the queries is reset along with them
+        assert not check.query_visibility
+
+
+class TestRepoIndexAddon(object):
+
+    def test_it(self):
+        repo = SimpleTree({
+            'dev-util': {'diffball': ['1.0', '0.9', '1.1']},
+            'dev-libs': {'foo': ['2']},
+        })
+        index = addons.RepoIndexAddon(Options(search_repo=repo))
+        assert [x.fullver for x in index.versions('dev-util/diffball')] == ['0.9', '1.0', '1.1']
+        assert index.versions('dev-libs/bar') == ()
+        assert [x.cpvstr for x in index.match(atom('>=dev-util/diffball-1.0'))] == \
+            ['dev-util/diffball-1.0', 'dev-util/diffball-1.1']
+        assert index.has_match(atom('dev-libs/foo'))
+        assert not index.has_match(atom('dev-libs/bar'))
+        # non-atom restrictions fall back to querying the repo
+        assert len(index.match(packages.AlwaysTrue)) == 4
+
+    def test_maxsize(self, monkeypatch):
+        repo = SimpleTree({
+            'dev-util': {'diffball': ['1.0'], 'bsdiff': ['0.4']},
+            'dev-libs': {'foo': ['2']},
+        })
+        monkeypatch.setattr(addons.RepoIndexAddon, 'maxsize', 2)
+        index = addons.RepoIndexAddon(Options(search_repo=repo))
+        for key in ('dev-util/diffball', 'dev-util/bsdiff', 'dev-libs/foo'):
+            assert len(index.versions(key)) == 1
+        # least recently used packages are dropped
+        assert len(index._pkgs) == 2
+        assert index._pkgs.evictions == 1
+        assert 'dev-util/diffball' not in index._pkgs
+        assert [x.cpvstr for x in index.match(atom('dev-util/diffball'))] == \
+            ['dev-util/diffball-1.0']
+
+
+class TestUseStateAddon(object):
+
+    def test_it(self):
+        addon = addons.UseStateAddon(Options())
+        profile = FakeProfile(
+            use=['foo'], iuse_effective=['foo'],
+            forced_use={'dev-util/diffball': ['bar']},
+            masked_use={'dev-util/diffball': ['baz']})
+        pkg = FakeRepoPkg('dev-util/diffball-0.1', iuse=['baz', 'bar', 'qux'])
+        forced, masked, pkg_use, use, iuse = addon.get(pkg, profile)
+        assert forced == {'bar'}
+        assert masked == {'baz'}
+        assert use == {'foo', 'bar'}
+        assert iuse == {'foo', 'bar', 'baz', 'qux'}
+        assert addon.get(pkg, profile) is addon.get(pkg, profile)
+        assert addon.use_states.hits == 2
+
+    def test_iuse_keying(self):
+        # packages sharing a cpv and repo, e.g. an ebuild modified between
+        # scans in the same process, don't share USE states
+        addon = addons.UseStateAddon(Options())
+        profile = FakeProfile(use=['foo', 'bar'], iuse_effective=[])
+        repo = FakeRepo(repo_id='repo')
+        pkg1 = FakeRepoPkg('dev-util/diffball-0.1', iuse=['foo'], repo=repo)
+        pkg2 = FakeRepoPkg('dev-util/diffball-0.1', iuse=['foo', 'bar'], repo=repo)
+        assert addon.get(pkg1, profile)[3:] == ({'foo'}, {'foo'})
+        assert addon.get(pkg2, profile)[3:] == ({'foo', 'bar'}, {'foo', 'bar'})
+        assert addon.use_states.hits == 0
+
+
+class TestLRUCache(object):
+
+    def test_it(self):
+        lru = addons.LRUCache(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        assert 'a' in lru
+        lru['c'] = 3
+        # least recently used entry is evicted
+        assert 'b' not in lru
+        assert lru.get('a') == 1
+        assert lru['c'] == 3
+        assert lru.get('b') is None
+        assert len(lru) == 2
+        assert (lru.hits, lru.misses, lru.evictions) == (2, 2, 1)
+        assert lru.stats == '2 hits, 2 misses, 1 eviction (50.0% hit rate)'
+        lru.clear()
+        assert not lru
+
+
+class TestLineScannerAddon(object):
+
+    def test_it(self):
+        scanner = addons.LineScannerAddon(Options())
+        foo = scanner.register(r'foo')
+        empty = scanner.register(r'^\n')
+        entry = (None, ('foo foo\n', '\n', 'bar\n', 'foo'))
+        # only the first match on each line is returned
+        assert [(i, m.group()) for i, m in scanner.matches(entry, foo)] == [(1, 'foo'), (4, 'foo')]
+        assert [i for i, m in scanner.matches(entry, empty)] == [2]
+        # results are shared for the same entry
+        assert scanner.scan(entry) is scanner.scan(entry)
+        assert scanner.scan(entry) is not scanner.scan((None, ('foo\n',)))
+
+    def test_prefilter(self):
+        scanner = addons.LineScannerAddon(Options())
+        foo = scanner.register(r'f.o', prefilter=('foo', 'fao'))
+        bar = scanner.register(r'bar', prefilter=('baz',))
+        entry = (None, ('fao\n', 'fuo bar\n'))
+        # patterns are matched if any token is present
+        assert [i for i, m in scanner.matches(entry, foo)] == [1, 2]
+        # and skipped otherwise
+        assert scanner.matches(entry, bar) == []
+
+
+class TestPkgDirAddon(Tmpdir):
+
+    def test_snapshot(self):
+        pkgdir = pjoin(self.dir, 'dev-util', 'foo')
+        ensure_dirs(pjoin(pkgdir, 'files', 'sub'))
+        ensure_dirs(pjoin(pkgdir, 'other'))
+        write_file(pjoin(pkgdir, 'foo-0.ebuild'), 'w', 'EAPI=6\n')
+        write_file(pjoin(pkgdir, 'files', 'sub', 'foo.patch'), 'w', 'patch\n')
+        write_file(pjoin(pkgdir, 'other', 'foo'), 'w', 'foo\n')
+        os.symlink('foo-0.ebuild', pjoin(pkgdir, 'link'))
+
+        addon = addons.PkgDirAddon(Options())
+        repo = FakeRepo(repo_id='repo', location=self.dir)
+        pkgs = (FakeFilesDirPkg('dev-util/foo-0', repo=repo),)
+        snapshot = addon.snapshot(pkgs)
+        assert snapshot.path == pkgdir
+        assert snapshot.listdir() == ['files', 'foo-0.ebuild', 'link', 'other']
+        assert snapshot.listdir('files') == ['sub']
+        assert snapshot.listdir('files/sub') == ['foo.patch']
+        # only files/ is recursed into
+        assert snapshot.listdir('other') == []
+        assert snapshot.entries['files/sub/foo.patch'].st_size == 6
+        # symlinks aren't followed
+        assert os.path.islink(pjoin(pkgdir, 'link'))
+        assert snapshot.entries['link'].st_size == len('foo-0.ebuild')
+
+        # snapshots are shared for the same package feed item
+        assert addon.snapshot(pkgs) is snapshot
+        assert addon.snapshot(list(pkgs)) is not snapshot
 
 
 class Test_profile_data(object):
@@ -107,6 +270,19 @@ class Test_profile_data(object):
         assert immutable == set(required_immutable)
         assert enabled == set(required_forced)
 
+    def test_visible(self):
+        profile = FakeProfile()
+        profile_data = addons.profile_data(
+            "test-profile", "x86", profile.provides_repo,
+            packages.AlwaysFalse, profile.iuse_effective,
+            profile.use, profile.pkg_use, profile.masked_use, profile.forced_use, {}, set(),
+            keywords=("x86",), masked_keys={"dev-util/masked"})
+        # unmasked packages only depend on keywords
+        assert profile_data.visible(FakePkg("dev-util/diffball-0.1", data={'KEYWORDS': 'x86'}))
+        assert not profile_data.visible(FakePkg("dev-util/diffball-0.1", data={'KEYWORDS': 'ppc'}))
+        # masked packages use the full filter
+        assert not profile_data.visible(FakePkg("dev-util/masked-0.1", data={'KEYWORDS': 'x86'}))
+
     def test_identify_use(self):
         profile = FakeProfile()
         self.assertResults(profile, [], [], [])
@@ -211,6 +387,28 @@ class TestProfileAddon(ProfilesMixin):
         assert sorted(check.profile_evaluate_dict) == ['x86', '~x86']
         self.assertProfiles(check, 'x86', 'profile1', 'profile1/2')
 
+    def test_visibility(self):
+        self.mk_profiles({
+            "profile1": ["x86"],
+            "profile2": ["ppc"]},
+            base='profiles')
+        options = self.process_check(None, [], profiles=None)
+        check = self.addon_kls(options)
+        bits = {(x.key, x.name): x.bit for x in check}
+        assert sorted(bits.values()) == [1, 2, 4, 8]
+        pkg = FakeFilesDirPkg(
+            'dev-util/foo-1', options.target_repo, data={'KEYWORDS': '~x86 ppc'})
+        assert check.visibility(pkg) == (
+            bits[('~x86', 'profile1')] | bits[('ppc', 'profile2')] | bits[('~ppc', 'profile2')])
+        # repeated lookups are cached
+        assert check.visibility(pkg) == (
+            bits[('~x86', 'profile1')] | bits[('ppc', 'profile2')] | bits[('~ppc', 'profile2')])
+        assert check._visibility.hits == 1
+        # package objects aren't kept alive by the cache
+        key, = check._visibility._data
+        assert key[:2] == ('dev-util/foo-1', options.target_repo.repo_id)
+        assert sorted(key[2]) == ['ppc', '~x86']
+
     def test_fallback_defaults(self):
         self.mk_profiles({
             "default-linux/dep": ["x86", False, True],
@@ -403,6 +601,98 @@ class TestProfileAddon(ProfilesMixin):
         self.assertProfiles(check, 'x86', 'default-linux', 'default-linux/x86')
         assert len(check.profile_evaluate_dict['x86']) == 1
 
+    def test_profile_cache(self):
+        self.mk_profiles({
+            "profile1": ["x86"],
+            "profile1/2": ["x86"]},
+            base='profiles')
+        options = self.process_check(None, [], profiles=None)
+        options.cache = None
+        options.cache_file = pjoin(self.dir, 'cache', 'profiles.pickle')
+        self.addon_kls(options)
+        digests = {k: v[0] for k, v in cache.load(options.cache_file).items()}
+        assert sorted(digests) == ['profile1', 'profile1/2']
+
+        # unchanged profiles don't trigger cache updates
+        mtime = os.stat(options.cache_file).st_mtime_ns
+        check = self.addon_kls(options)
+        self.assertProfiles(check, 'x86', 'profile1', 'profile1/2')
+        assert os.stat(options.cache_file).st_mtime_ns == mtime
+
+        # only changed profiles are rebuilt
+        write_file(pjoin(self.dir, 'profiles', 'profile1', '2', 'use.mask'), 'w', 'foo\n')
+        check = self.addon_kls(options)
+        self.assertProfiles(check, 'x86', 'profile1', 'profile1/2')
+        new_digests = {k: v[0] for k, v in cache.load(options.cache_file).items()}
+        assert new_digests['profile1'] == digests['profile1']
+        assert new_digests['profile1/2'] != digests['profile1/2']
+
+        # directory-form profile files are tracked as well
+        os.mkdir(pjoin(self.dir, 'profiles', 'profile1', 'package.mask'))
+        write_file(
+            pjoin(self.dir, 'profiles', 'profile1', 'package.mask', 'foo'), 'w', 'cat/pkg\n')
+        self.addon_kls(options)
+        dir_digests = {k: v[0] for k, v in cache.load(options.cache_file).items()}
+        assert dir_digests['profile1'] != new_digests['profile1']
+        assert dir_digests['profile1/2'] != new_digests['profile1/2']
+
+    def test_profile_cache_forced(self):
+        self.mk_profiles({
+            "profile1": ["x86"],
+            "profile1/2": ["x86"]},
+            base='profiles')
+        options = self.process_check(None, [], profiles=None)
+        options.cache = None
+        options.cache_file = pjoin(self.dir, 'cache', 'profiles.pickle')
+        self.addon_kls(options)
+        digests = {k: v[0] for k, v in cache.load(options.cache_file).items()}
+
+        # forced refreshes of selected profiles keep all other entries
+        write_file(pjoin(self.dir, 'profiles', 'profile1', 'use.mask'), 'w', 'foo\n')
+        options = self.process_check(None, ['--profiles', 'profile1'])
+        options.cache = True
+        options.forced_cache = True
+        options.cache_file = pjoin(self.dir, 'cache', 'profiles.pickle')
+        check = self.addon_kls(options)
+        self.assertProfiles(check, 'x86', 'profile1')
+        new_digests = {k: v[0] for k, v in cache.load(options.cache_file).items()}
+        assert sorted(new_digests) == ['profile1', 'profile1/2']
+        assert new_digests['profile1'] != digests['profile1']
+        assert new_digests['profile1/2'] == digests['profile1/2']
+
+    def test_profile_jobs(self):
+        self.mk_profiles({
+            "profile1": ["x86"],
+            "profile1/2": ["x86"],
+            "profile1/3": ["x86"],
+            "profile2": ["ppc"]},
+            base='profiles', arches=('x86', 'ppc'))
+        write_file(pjoin(self.dir, 'profiles', 'profile1', 'use.mask'), 'w', 'foo\n')
+        write_file(pjoin(self.dir, 'profiles', 'profile1', '2', 'use.force'), 'w', 'bar\n')
+        write_file(
+            pjoin(self.dir, 'profiles', 'profile1', '3', 'package.use.mask'), 'w',
+            'dev-util/diffball bar\n')
+        write_file(pjoin(self.dir, 'profiles', 'profile2', 'use.stable.mask'), 'w', 'foo\n')
+
+        # invalid number of jobs
+        with pytest.raises(SystemExit):
+            self.process_check(None, ['--profile-jobs', '0'], silence=True)
+
+        def flags(check):
+            pkg = FakePkg('dev-util/diffball-0.1', data={'KEYWORDS': 'x86 ppc'})
+            known_flags = {'foo', 'bar', 'x86', 'ppc'}
+            return {
+                key: sorted(
+                    (p.name, tuple(map(sorted, p.identify_use(pkg, known_flags))))
+                    for p in profiles)
+                for key, profiles in check.profile_filters.items()}
+
+        # filters generated in parallel match serially generated ones
+        serial = flags(self.addon_kls(self.process_check(None, [])))
+        for jobs in ('2', '8'):
+            options = self.process_check(None, ['--profile-jobs', jobs])
+            assert flags(self.addon_kls(options)) == serial
+
 
 class TestEvaluateDepSetAddon(ProfilesMixin):
 
@@ -515,6 +805,14 @@ class TestEvaluateDepSetAddon(ProfilesMixin):
         assert sorted(x.name for x in l1) == ["3"]
         assert sorted(x.name for x in l2) == ["1", "2"]
 
+        # evaluated depsets are reused across versions
+        check.feed(None, None)
+        hits = check.evaluated_depsets.hits
+        l = get_rets("2", "depend", KEYWORDS="ppc x86",
+            DEPEND="ppc? ( dev-util/ppc ) !ppc? ( dev-util/x86 )")
+        assert len(l) == 2, f"should be len 2, got {l!r}"
+        assert check.evaluated_depsets.hits == hits + 2
+
 
 class TestUseAddon(ArgparseCheck, Tmpdir):
 
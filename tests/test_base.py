@@ -1,3 +1,7 @@
+import pickle
+
+import pytest
+
 from pkgcheck import base
 
 
@@ -17,6 +21,39 @@ class TestUtilities(object):
         assert not base.convert_check_filter('bar.foo')('foo.bar.baz')
 
 
+class _SlottedResult(base.Warning):
+
+    __slots__ = ('category', 'package')
+    threshold = base.package_feed
+
+    def __init__(self, category, package, extra):
+        super().__init__()
+        self.category = category
+        self.package = package
+        self.extra = extra
+
+
+class TestResult(object):
+
+    def test_pickle(self):
+        result = _SlottedResult('dev-util', 'diffball', ('a', 'b'))
+        result._verbosity = 1
+        restored = pickle.loads(pickle.dumps(result))
+        assert restored.category == 'dev-util'
+        assert restored.package == 'diffball'
+        # extra attributes are preserved, reporter settings are not
+        assert restored.extra == ('a', 'b')
+        assert not hasattr(restored, '_verbosity')
+
+    def test_incomplete_state(self):
+        result = _SlottedResult.__new__(_SlottedResult)
+        with pytest.raises(TypeError):
+            result.__setstate__({'category': 'dev-util'})
+        with pytest.raises(TypeError):
+            result.__setstate__(
+                {'category': 'dev-util', 'package': 'diffball', 'extra': None})
+
+
 class DummySource(object):
 
     """Dummy source object just "producing" itself.
@@ -290,3 +327,88 @@ class TestPlug(object):
             [source],
             (source, base.CheckRunner([
                 trans_fast(base.CheckRunner([sinks[2]]))])))
+
+    def test_cached_plan(self):
+        transforms = [trans(0, 1), trans(1, 2)]
+        bad, first = base.plug([sinks[2]], transforms, [sources[0]])
+        bad, second = base.plug([sinks[2]], transforms, [sources[0]])
+        assert first == second
+        # pipelines are rebuilt using fresh transform instances
+        first_trans = first[0][1].checks[0]
+        second_trans = second[0][1].checks[0]
+        assert first_trans is not second_trans
+        assert first_trans.child.checks[0].child is not second_trans.child.checks[0].child
+
+    def test_cached_plan_debug(self):
+        transforms = [trans(0, 1), trans(1, 2)]
+        first = []
+        base.plug([sinks[2]], transforms, [sources[0]], first.append)
+        second = []
+        base.plug([sinks[2]], transforms, [sources[0]], second.append)
+        # plans are logged even when cached
+        assert first
+        assert first == second
+
+    def test_many_transforms(self):
+        # planning doesn't grow combinatorially with transforms and sinks
+        self.assertPipes(
+            list(sinks),
+            trans_everything,
+            [sources[0]],
+            (sources[0], base.CheckRunner(
+                [sinks[0]] + [trans(0, i)(base.CheckRunner([sinks[i]]))
+                              for i in range(1, len(dummies))])))
+
+
+class _Doubler(base.Transform):
+
+    source = base.versioned_feed
+    dest = base.package_feed
+    scope = base.package_scope
+
+    def feed(self, item, reporter):
+        self.child.feed((item, item), reporter)
+
+
+class _Collector(base.Template):
+
+    feed_type = base.package_feed
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.items = []
+
+    def feed(self, item, reporter):
+        self.items.append(item)
+
+
+class TestProfiler(object):
+
+    def test_profile_pipe(self):
+        sink = _Collector(None)
+        pipe = base.CheckRunner([_Doubler(base.CheckRunner([sink]))])
+        profiler = base.Profiler()
+        pipe = base.profile_pipe(pipe, profiler)
+        assert list(base.collect_checks(pipe)) == [sink]
+
+        pipe.start(None)
+        for item in range(3):
+            pipe.feed(item, None)
+        pipe.finish(None)
+
+        # pipeline behavior is unchanged
+        assert sink.items == [(0, 0), (1, 1), (2, 2)]
+        assert set(profiler.stats) == {'_Doubler', '_Collector'}
+        # single versions are fed to the transform, package tuples to the sink
+        assert profiler.stats['_Doubler'][3:] == [3, 3]
+        assert profiler.stats['_Collector'][3:] == [3, 6]
+        assert all(x >= 0 for x in profiler.stats['_Doubler'][:3])
+
+    def test_update(self):
+        profiler = base.Profiler()
+        profiler.update({'Check': [1.0, 2.0, 3.0, 4, 5]})
+        profiler.update({'Check': [1.0, 2.0, 3.0, 4, 5], 'Other': [0.5, 0, 0, 1, 1]})
+        assert profiler.stats == {
+            'Check': [2.0, 4.0, 6.0, 8, 10],
+            'Other': [0.5, 0, 0, 1, 1],
+        }
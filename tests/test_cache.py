@@ -0,0 +1,131 @@
+import hashlib
+import os
+
+from snakeoil.fileutils import write_file
+from snakeoil.osutils import pjoin, ensure_dirs
+
+from pkgcheck import cache
+
+from .misc import Tmpdir
+
+
+class TestPickling(Tmpdir):
+
+    def test_dump_load(self):
+        path = pjoin(self.dir, 'subdir', 'data.pickle')
+        cache.dump({'foo': ('bar', 1)}, path)
+        assert cache.load(path) == {'foo': ('bar', 1)}
+        # no leftover temporary files
+        assert os.listdir(os.path.dirname(path)) == ['data.pickle']
+
+    def test_load_missing(self):
+        assert cache.load(pjoin(self.dir, 'nonexistent')) is None
+
+    def test_load_corrupted(self):
+        path = pjoin(self.dir, 'data.pickle')
+        write_file(path, 'wb', b'\x80\x04garbage')
+        assert cache.load(path) is None
+        write_file(path, 'wb', b'')
+        assert cache.load(path) is None
+
+
+class TestHashing(Tmpdir):
+
+    def _digest(self, path):
+        chksum = hashlib.sha256()
+        cache.hash_files(chksum, cache.iter_files(path), path)
+        return chksum.hexdigest()
+
+    def test_hash_files(self):
+        pkgdir = pjoin(self.dir, 'pkg')
+        ensure_dirs(pjoin(pkgdir, 'files'))
+        write_file(pjoin(pkgdir, 'pkg-0.ebuild'), 'w', 'EAPI=6\n')
+        write_file(pjoin(pkgdir, 'files', 'foo.patch'), 'w', 'patch\n')
+        digest = self._digest(pkgdir)
+        assert digest == self._digest(pkgdir)
+
+        # content changes
+        write_file(pjoin(pkgdir, 'files', 'foo.patch'), 'w', 'patch2\n')
+        assert digest != self._digest(pkgdir)
+        digest = self._digest(pkgdir)
+
+        # renames
+        os.rename(pjoin(pkgdir, 'files', 'foo.patch'), pjoin(pkgdir, 'files', 'bar.patch'))
+        assert digest != self._digest(pkgdir)
+
+
+class TestContentCache(Tmpdir):
+
+    def test_it(self):
+        path = pjoin(self.dir, 'cache.pickle')
+        data = cache.ContentCache(path, config='foo')
+        assert data.get('key') is None
+        data['key'] = ('value',)
+        data.save()
+
+        data = cache.ContentCache(path, config='foo')
+        assert data.get('key') == ('value',)
+        assert (data.hits, data.misses) == (1, 0)
+
+        # config changes invalidate all entries
+        data = cache.ContentCache(path, config='bar')
+        assert data.get('key') is None
+
+    def test_merge(self):
+        path = pjoin(self.dir, 'cache.pickle')
+        data1 = cache.ContentCache(path)
+        data2 = cache.ContentCache(path)
+        data1['foo'] = 1
+        data2['bar'] = 2
+        data1.save()
+        data2.save()
+        data = cache.ContentCache(path)
+        assert (data.get('foo'), data.get('bar')) == (1, 2)
+
+    def test_prune(self):
+        path = pjoin(self.dir, 'cache.pickle')
+        data = cache.ContentCache(path, maxsize=2)
+        for x in range(3):
+            data[x] = x
+        data.save()
+        data = cache.ContentCache(path, maxsize=2)
+        assert data.get(0) == 0
+        data[3] = 3
+        data.save()
+        # entries unused during the run are dropped when the limit is exceeded
+        assert cache.ContentCache(path).entries == {0: 0, 3: 3}
+
+
+class TestDigestCache(Tmpdir):
+
+    def test_it(self):
+        cache_path = pjoin(self.dir, 'cache', 'digests.pickle')
+        path = pjoin(self.dir, 'foo')
+        write_file(path, 'w', 'foo\n')
+        digest = hashlib.sha256(b'foo\n').digest()
+
+        digests = cache.DigestCache(cache_path)
+        assert digests.digest_files([(path, os.stat(path))]) == {path: digest}
+        assert (digests.hits, digests.misses) == (0, 1)
+        digests.save()
+
+        # unchanged files aren't rehashed
+        digests = cache.DigestCache(cache_path)
+        digests._hash = None
+        assert digests.digest_files([(path, os.stat(path))]) == {path: digest}
+        assert (digests.hits, digests.misses) == (1, 0)
+
+        # modified files are
+        write_file(path, 'w', 'foobar\n')
+        digests = cache.DigestCache(cache_path)
+        assert digests.digest_files([(path, os.stat(path))]) == {
+            path: hashlib.sha256(b'foobar\n').digest()}
+        assert (digests.hits, digests.misses) == (0, 1)
+
+    def test_memory_only(self):
+        path = pjoin(self.dir, 'foo')
+        write_file(path, 'w', 'foo\n')
+        digests = cache.DigestCache(None)
+        digests.digest_files([(path, os.stat(path))])
+        digests.save()
+        assert os.listdir(self.dir) == ['foo']
@@ -0,0 +1,109 @@
+from pkgcore.ebuild.atom import atom
+from pkgcore.repository.util import SimpleTree
+from pkgcore.restrictions import packages
+import pytest
+from snakeoil.data_source import local_source, text_data_source
+from snakeoil.fileutils import write_file
+from snakeoil.osutils import pjoin
+
+from pkgcheck import base, feeds
+
+from .misc import Tmpdir
+
+
+class TestEbuildText(Tmpdir):
+
+    def _text(self, data):
+        path = pjoin(self.dir, 'foo-0.ebuild')
+        write_file(path, 'wb', data)
+        return feeds.EbuildText(local_source(path, encoding='utf8'))
+
+    def test_lines(self):
+        data = 'EAPI=6\n\nDESCRIPTION="ü"\nfoo'
+        text = self._text(data.encode())
+        assert text.text == data
+        assert text.offsets == [0, 7, 8, 24]
+        assert len(text) == 4
+        assert list(text) == data.splitlines(keepends=True)
+        assert text[1] == '\n'
+        assert text[-1] == 'foo'
+        assert text[1:3] == ['\n', 'DESCRIPTION="ü"\n']
+        assert text.lineno(9) == 3
+
+    def test_empty(self):
+        text = self._text(b'')
+        assert text.text == ''
+        assert not text
+        assert list(text) == []
+
+    def test_newlines(self):
+        # newlines are translated as for text file objects
+        text = self._text(b'foo\r\nbar\rbaz\n')
+        assert list(text) == ['foo\n', 'bar\n', 'baz\n']
+
+    def test_unmapped_source(self):
+        text = feeds.EbuildText(text_data_source('foo\nbar\n'))
+        assert list(text) == ['foo\n', 'bar\n']
+
+
+class TestReadText(Tmpdir):
+
+    def test_it(self):
+        path = pjoin(self.dir, 'foo')
+        write_file(path, 'w', 'foo\n')
+        assert feeds.read_text(path) == 'foo\n'
+        assert feeds.read_text(path) is feeds.read_text(path)
+        write_file(path, 'w', 'foobar\n')
+        assert feeds.read_text(path) == 'foobar\n'
+        write_file(path, 'wb', b'\xff\n')
+        with pytest.raises(UnicodeDecodeError):
+            feeds.read_text(path)
+
+
+class _Result(object):
+
+    def __init__(self, threshold, category=None, package=None, version=None):
+        self.threshold = threshold
+        self.category = category
+        self.package = package
+        self.version = version
+
+
+class TestBatchedRepoSource(object):
+
+    def test_split(self):
+        repo = SimpleTree({
+            'dev-util': {'foo': ['1', '2']},
+            'dev-libs': {'bar': ['1', '2']},
+            'dev-lang': {'baz': ['1']},
+        })
+        source = feeds.BatchedRepoSource(
+            repo, [atom('dev-util/foo'), atom('=dev-libs/bar-1'), atom('dev-util/foo')])
+        assert [x.cpvstr for x in source.feed()] == \
+            ['dev-libs/bar-1', 'dev-util/foo-1', 'dev-util/foo-2']
+
+        foo = _Result(base.versioned_feed, 'dev-util', 'foo', '2')
+        bar = _Result(base.package_feed, 'dev-libs', 'bar')
+        # versions that weren't fed use the target of their package
+        masked = _Result(base.versioned_feed, 'dev-libs', 'bar', '2')
+        category = _Result(base.category_feed, 'dev-libs')
+        # results not matching any target are dropped
+        unmatched = [
+            _Result(base.versioned_feed, 'dev-lang', 'baz', '1'),
+            _Result(base.package_feed, 'dev-util', 'bar'),
+            _Result(base.repository_feed),
+        ]
+        buckets = source.split([foo, bar, masked, category] + unmatched)
+        assert buckets == [[foo], [bar, masked, category], []]
+
+    def test_split_unfed(self):
+        repo = SimpleTree({'dev-util': {'foo': ['1']}})
+        source = feeds.BatchedRepoSource(repo, [atom('dev-util/foo')])
+        result = _Result(base.versioned_feed, 'dev-util', 'foo', '1')
+        assert source.split([result]) == [[]]
+
+
+def test_package_keys():
+    repo = SimpleTree({'dev-util': {'foo': ['1', '2'], 'bar': ['1']}})
+    pkgs = repo.itermatch(packages.AlwaysTrue, sorter=sorted)
+    assert feeds.package_keys(pkgs) == [('dev-util', 'bar'), ('dev-util', 'foo')]
@@ -1,7 +1,20 @@
+import os
+import shutil
+import subprocess
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.repository.util import SimpleTree
+from pkgcore.restrictions import packages
 from pkgcore.test.scripts import helpers
+from snakeoil.fileutils import touch, write_file
+from snakeoil.osutils import pjoin
+import pytest
 
+from pkgcheck import base, errors, feeds, reporters
 from pkgcheck.scripts import pkgcheck
 
+from .misc import Options, Tmpdir
+
 
 class TestCommandline(helpers.ArgParseMixin):
 
@@ -11,3 +24,291 @@ class TestCommandline(helpers.ArgParseMixin):
         self.assertError(
             "argument -r/--repo: couldn't find repo 'spork'",
             '-r', 'spork')
+
+
+class _Pkg(object):
+
+    def __init__(self, cpv, inherited=(), bdepend=(), depend=(), rdepend=()):
+        self.category, self.package = cpv.split('/')
+        self.inherited = inherited
+        self.bdepend = tuple(map(atom, bdepend))
+        self.depend = tuple(map(atom, depend))
+        self.rdepend = tuple(map(atom, rdepend))
+        self.pdepend = ()
+
+
+class _GitRepo(object):
+
+    def __init__(self, location, pkgs=()):
+        self.location = location
+        self.repo_id = 'test'
+        self.categories = ('dev-libs', 'dev-util')
+        self.pkgs = pkgs
+
+    def __iter__(self):
+        return iter(self.pkgs)
+
+
+class TestCommits(Tmpdir):
+
+    def test_changed_paths(self):
+        pkgs, eclasses, profiles_changed = pkgcheck._changed_paths([
+            'dev-util/foo/foo-1.ebuild', 'dev-util/foo/files/foo.patch',
+            'dev-libs/bar/metadata.xml', 'eclass/foo.eclass', 'eclass/README',
+            'metadata/layout.conf', 'unknown/baz/baz-1.ebuild',
+        ], ('dev-libs', 'dev-util'))
+        assert pkgs == {('dev-util', 'foo'), ('dev-libs', 'bar')}
+        assert eclasses == {'foo'}
+        assert not profiles_changed
+        assert pkgcheck._changed_paths(['profiles/package.mask'], ())[2]
+
+    def test_profile_keys(self):
+        lines = [
+            '--- a/profiles/package.mask',
+            '+++ b/profiles/package.mask',
+            '@@ -1,0 +2,4 @@',
+            '+# masked for removal',
+            '+>=dev-util/foo-2 # trailing comment',
+            '-dev-libs/bar',
+            '+-dev-libs/baz',
+            '+not an atom',
+            ' dev-util/unchanged',
+            '+',
+        ]
+        assert pkgcheck._profile_keys(lines) == {'dev-util/foo', 'dev-libs/bar', 'dev-libs/baz'}
+
+    def test_revdep_packages(self):
+        repo = [
+            _Pkg('dev-util/foo', inherited=('eutils',)),
+            _Pkg('dev-util/bar', depend=['>=dev-libs/removed-1']),
+            _Pkg('dev-util/baz', rdepend=['dev-libs/other']),
+            _Pkg('dev-util/qux', bdepend=['dev-libs/removed']),
+            _Pkg('dev-libs/skipped', inherited=('eutils',)),
+        ]
+        assert pkgcheck._revdep_packages(
+            repo, {'eutils'}, {'dev-libs/removed'}, skip={('dev-libs', 'skipped')}) == \
+            {('dev-util', 'foo'), ('dev-util', 'bar'), ('dev-util', 'qux')}
+        assert pkgcheck._revdep_packages(repo, set(), set()) == set()
+
+    @pytest.mark.skipif(shutil.which('git') is None, reason='requires git')
+    def test_untracked(self):
+        def git(*args):
+            subprocess.run(
+                ['git', '-c', 'user.name=test', '-c', 'user.email=test@test',
+                 *args], cwd=self.dir, check=True, stdout=subprocess.DEVNULL)
+        git('init', '-q')
+        os.makedirs(pjoin(self.dir, 'profiles'))
+        touch(pjoin(self.dir, 'profiles', 'repo_name'))
+        git('add', '.')
+        git('commit', '-q', '-m', 'init')
+
+        repo = _GitRepo(self.dir)
+        assert pkgcheck._commits_limiters(pkgcheck.scan, repo, 'HEAD') == []
+        # new packages get scanned before being added to git
+        os.makedirs(pjoin(self.dir, 'dev-util', 'foo'))
+        touch(pjoin(self.dir, 'dev-util', 'foo', 'foo-1.ebuild'))
+        assert pkgcheck._commits_limiters(pkgcheck.scan, repo, 'HEAD')
+
+
+class _DaemonTree(object):
+
+    def __init__(self, location):
+        self.location = location
+        self.categories = ('dev-util',)
+        self.trees = (self,)
+
+
+class TestScanDaemon(Tmpdir):
+
+    def test_changed_tree(self, monkeypatch):
+        for path in ('profiles', 'eclass', 'dev-util/foo'):
+            os.makedirs(pjoin(self.dir, path))
+        touch(pjoin(self.dir, 'eclass', 'foo.eclass'))
+        touch(pjoin(self.dir, 'dev-util', 'foo', 'foo-1.ebuild'))
+
+        loads = []
+        scans = []
+
+        def parse_args(args):
+            loads.append(args)
+            return Options(
+                target_repo=_DaemonTree(self.dir), reporter=self._reporter,
+                filtered_keywords=None, verbosity=0, enabled_checks=[])
+
+        monkeypatch.setattr(pkgcheck.argparser, 'parse_args', parse_args)
+        monkeypatch.setattr(pkgcheck, '_init_addons', lambda options: {})
+        monkeypatch.setattr(
+            pkgcheck, '_run_scan',
+            lambda options, reporter, err, sinks, limiters: scans.append(options))
+
+        state = pkgcheck._ScanDaemon(['--checks', 'foo'], _Output())
+        state.load()
+        assert loads == [['scan', '--checks', 'foo']]
+
+        def scan():
+            state.scan({'targets': ['dev-util/foo']}, _Output())
+            return scans[-1]
+
+        # unchanged trees reuse the loaded state
+        options = scan()
+        assert scan() is options
+        assert len(loads) == 1
+
+        # added ebuilds, packages, and changed eclasses trigger reloads
+        pkgdir = pjoin(self.dir, 'dev-util', 'foo')
+        changes = (
+            (pkgdir, lambda: touch(pjoin(pkgdir, 'foo-2.ebuild'))),
+            (pjoin(self.dir, 'dev-util'),
+             lambda: os.makedirs(pjoin(self.dir, 'dev-util', 'bar'))),
+            (pkgdir, lambda: os.remove(pjoin(pkgdir, 'foo-1.ebuild'))),
+            (pjoin(self.dir, 'eclass', 'foo.eclass'),
+             lambda: write_file(pjoin(self.dir, 'eclass', 'foo.eclass'), 'w', 'foo\n')),
+        )
+        for i, (path, change) in enumerate(changes, 2):
+            st = os.stat(path)
+            change()
+            # make sure the modification time changes
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            new_options = scan()
+            assert new_options is not options
+            assert len(loads) == i
+            options = new_options
+            assert scan() is options
+
+    @staticmethod
+    def _reporter(out, **kwargs):
+        return reporters.CollectingReporter()
+
+
+class _Output(object):
+
+    def write(self, *args):
+        pass
+
+    def flush(self):
+        pass
+
+
+class _VersionResult(base.Warning):
+
+    __slots__ = ('category', 'package', 'version')
+    threshold = base.versioned_feed
+
+    def __init__(self, pkg):
+        super().__init__()
+        self._store_cpv(pkg)
+
+
+class _PackageResult(base.Warning):
+
+    __slots__ = ('category', 'package', 'versions')
+    threshold = base.package_feed
+
+    def __init__(self, pkgs):
+        super().__init__()
+        self._store_cp(pkgs[0])
+        self.versions = len(pkgs)
+
+
+class _CategoryResult(base.Warning):
+
+    __slots__ = ('category', 'versions')
+    threshold = base.category_feed
+
+    def __init__(self, pkgs):
+        super().__init__()
+        self.category = pkgs[0].category
+        self.versions = len(pkgs)
+
+
+class _RepoResult(base.Warning):
+
+    __slots__ = ('versions',)
+    threshold = base.repository_feed
+
+    def __init__(self, versions):
+        super().__init__()
+        self.versions = versions
+
+
+class _VersionCheck(base.Template):
+
+    feed_type = base.versioned_feed
+
+    def feed(self, pkg, reporter):
+        reporter.add_report(_VersionResult(pkg))
+
+
+class _PackageCheck(base.Template):
+
+    feed_type = base.package_feed
+    scope = base.package_scope
+
+    def feed(self, pkgs, reporter):
+        reporter.add_report(_PackageResult(pkgs))
+
+
+class _CategoryCheck(base.Template):
+
+    feed_type = base.category_feed
+    scope = base.category_scope
+
+    def feed(self, pkgs, reporter):
+        reporter.add_report(_CategoryResult(pkgs))
+
+
+class _FinishCheck(base.Template):
+    """Version check reporting for all packages when finished."""
+
+    feed_type = base.versioned_feed
+    splittable = False
+
+    def start(self, reporter):
+        self.versions = 0
+
+    def feed(self, pkg, reporter):
+        self.versions += 1
+
+    def finish(self, reporter):
+        reporter.add_report(_RepoResult(self.versions))
+
+
+class _FailingCheck(base.Template):
+
+    feed_type = base.versioned_feed
+
+    def feed(self, pkg, reporter):
+        raise ValueError(f'failed checking {pkg}')
+
+
+class TestSplitScan(object):
+
+    repo = SimpleTree({
+        'dev-libs': {'foo': ['1', '2'], 'bar': ['1']},
+        'dev-util': {'diffball': ['1'], 'bsdiff': ['1', '2', '3']},
+    })
+    transforms = [feeds.VersionToPackage, feeds.VersionToCategory]
+
+    def _scan(self, jobs, sinks):
+        reporter = reporters.CollectingReporter()
+        source = feeds.RestrictedRepoSource(self.repo, packages.AlwaysTrue)
+        profiler = base.Profiler()
+        pkgcheck._split_scan(
+            Options(jobs=jobs), reporter, None, sinks, self.transforms, source, profiler)
+        return [(x.__class__, x.__getstate__()) for x in reporter.results], profiler
+
+    def test_jobs(self):
+        sinks = [_VersionCheck(None), _PackageCheck(None),
+                 _CategoryCheck(None), _FinishCheck(None)]
+        serial, serial_profiler = self._scan(1, sinks)
+        parallel, parallel_profiler = self._scan(2, sinks)
+        assert len(serial) == 7 + 4 + 2 + 1
+        assert serial[-1] == (_RepoResult, {'versions': 7})
+        # results match a serial scan including their order
+        assert parallel == serial
+        assert parallel_profiler.stats['_VersionCheck'][3:] == [7, 7]
+        assert parallel_profiler.stats['_PackageCheck'][3:] == [4, 7]
+
+    def test_worker_error(self):
+        with pytest.raises(errors.WorkerError, match='failed checking'):
+            self._scan(2, [_FailingCheck(None), _CategoryCheck(None)])